@@ -1,12 +1,362 @@
+#include <algorithm>
+#include <cstdint>
+#include <string>
+
 #include "pybind11/pybind11.h"
 #include "pybind11/stl.h"
+#include "pybind11/numpy.h"
 #include "tracer.hpp"
+#include "bvh.hpp"
+#include "packet.hpp"
 
 namespace py = pybind11;
 
+// Arrays are only accepted as they are (no forcecast) so the overload whose
+// dtype matches is picked without copying; anything else is converted once.
+template<typename T>
+using carray = py::array_t<T, py::array::c_style>;
+
+namespace {
+
+int countItems(const py::array& data, int attrs, const char* name) {
+	if(data.size() % attrs != 0)
+		throw py::value_error(
+			std::string(name) + " size must be a multiple of " + std::to_string(attrs));
+	return data.size() / attrs;
+}
+
+template<typename Real>
+py::tuple computeArrays(
+	carray<Real> rays,
+	carray<int32_t> triangleIds,
+	carray<Real> triangles,
+	bool parallel
+) {
+	int numRays = countItems(rays, 6, "rays");
+	int numTriangles = countItems(triangles, 9, "triangles");
+	if(triangleIds.size() < numTriangles)
+		throw py::value_error("one triangle id is required per triangle");
+
+	carray<int32_t> outIds(numRays);
+	carray<Real> outInter(numRays);
+	const Real* rayData = rays.data();
+	const int32_t* idData = triangleIds.data();
+	const Real* triData = triangles.data();
+	int32_t* idOut = outIds.mutable_data();
+	Real* interOut = outInter.mutable_data();
+	{
+		py::gil_scoped_release release;
+		intersectArrays(rayData, numRays, idData, triData, numTriangles, idOut, interOut, parallel);
+	}
+	return py::make_tuple(outIds, outInter);
+}
+
+int countDistances(const py::array& maxDistances, int numRays) {
+	if(maxDistances.size() != numRays)
+		throw py::value_error("one maximum distance is required per ray");
+	return numRays;
+}
+
+// Boolean array written by the occlusion kernels through a uint8_t pointer
+uint8_t* hitData(carray<bool>& outHit) {
+	return reinterpret_cast<uint8_t*>(outHit.mutable_data());
+}
+
+template<typename Real>
+carray<bool> occludedArrays(
+	carray<Real> rays,
+	carray<Real> maxDistances,
+	carray<Real> triangles,
+	bool parallel
+) {
+	int numRays = countDistances(maxDistances, countItems(rays, 6, "rays"));
+	int numTriangles = countItems(triangles, 9, "triangles");
+
+	carray<bool> outHit(numRays);
+	const Real* rayData = rays.data();
+	const Real* maxData = maxDistances.data();
+	const Real* triData = triangles.data();
+	uint8_t* hitOut = hitData(outHit);
+	{
+		py::gil_scoped_release release;
+		::occludedArrays(rayData, maxData, numRays, triData, numTriangles, hitOut, parallel);
+	}
+	return outHit;
+}
+
+template<typename Real>
+BVH* buildBVH(carray<int32_t> triangleIds, carray<Real> triangles) {
+	int numTriangles = countItems(triangles, 9, "triangles");
+	if(triangleIds.size() < numTriangles)
+		throw py::value_error("one triangle id is required per triangle");
+
+	const int32_t* idData = triangleIds.data();
+	const Real* triData = triangles.data();
+	py::gil_scoped_release release;
+	return new BVH(idData, triData, numTriangles);
+}
+
+template<typename T>
+carray<T> copyArray(const std::vector<T>& data) {
+	carray<T> out(data.size());
+	std::copy(data.begin(), data.end(), out.mutable_data());
+	return out;
+}
+
+template<typename T>
+std::vector<T> copyVector(const carray<T>& data) {
+	return std::vector<T>(data.data(), data.data() + data.size());
+}
+
+// Node bounds (6 per node), node links (leftFirst, count per node), triangle
+// data, ids and original indices in leaf order, all as flat arrays
+py::tuple bvhArrays(const BVH& bvh) {
+	const std::vector<BVHNode>& nodes = bvh.nodeData();
+	carray<double> bounds(nodes.size()*6);
+	carray<int32_t> links(nodes.size()*2);
+	double* boundsOut = bounds.mutable_data();
+	int32_t* linksOut = links.mutable_data();
+	for(size_t i = 0; i < nodes.size(); i++)
+	{
+		std::copy(nodes[i].boundsMin, nodes[i].boundsMin + 3, boundsOut + i*6);
+		std::copy(nodes[i].boundsMax, nodes[i].boundsMax + 3, boundsOut + i*6 + 3);
+		linksOut[i*2] = nodes[i].leftFirst;
+		linksOut[i*2 + 1] = nodes[i].count;
+	}
+	return py::make_tuple(bounds, links,
+		copyArray(bvh.triangleData()), copyArray(bvh.triangleIds()), copyArray(bvh.triangleIndex()));
+}
+
+BVH* restoreBVH(
+	carray<double> bounds,
+	carray<int32_t> links,
+	carray<double> triangles,
+	carray<int32_t> triangleIds,
+	carray<int32_t> triangleIndex
+) {
+	int numNodes = countItems(bounds, 6, "bounds");
+	if(links.size() != numNodes*2)
+		throw py::value_error("one (leftFirst, count) pair is required per node");
+
+	std::vector<BVHNode> nodes(numNodes);
+	const double* boundsIn = bounds.data();
+	const int32_t* linksIn = links.data();
+	for(int i = 0; i < numNodes; i++)
+	{
+		std::copy(boundsIn + i*6, boundsIn + i*6 + 3, nodes[i].boundsMin);
+		std::copy(boundsIn + i*6 + 3, boundsIn + i*6 + 6, nodes[i].boundsMax);
+		nodes[i].leftFirst = linksIn[i*2];
+		nodes[i].count = linksIn[i*2 + 1];
+	}
+	return new BVH(std::move(nodes),
+		copyVector(triangles), copyVector(triangleIds), copyVector(triangleIndex));
+}
+
+template<typename Real>
+PackedTriangles* packTriangles(carray<int32_t> triangleIds, carray<Real> triangles, int width) {
+	int numTriangles = countItems(triangles, 9, "triangles");
+	if(triangleIds.size() < numTriangles)
+		throw py::value_error("one triangle id is required per triangle");
+	return new PackedTriangles(triangleIds.data(), triangles.data(), numTriangles, width);
+}
+
+py::tuple packetArrays(const PackedTriangles& packed, carray<float> rays, bool parallel) {
+	int numRays = countItems(rays, 6, "rays");
+
+	carray<int32_t> outIds(numRays);
+	carray<float> outInter(numRays);
+	const float* rayData = rays.data();
+	int32_t* idOut = outIds.mutable_data();
+	float* interOut = outInter.mutable_data();
+	{
+		py::gil_scoped_release release;
+		packed.intersectArrays(rayData, numRays, idOut, interOut, parallel);
+	}
+	return py::make_tuple(outIds, outInter);
+}
+
+carray<bool> packetOccluded(
+	const PackedTriangles& packed,
+	carray<float> rays,
+	carray<float> maxDistances,
+	bool parallel
+) {
+	int numRays = countDistances(maxDistances, countItems(rays, 6, "rays"));
+
+	carray<bool> outHit(numRays);
+	const float* rayData = rays.data();
+	const float* maxData = maxDistances.data();
+	uint8_t* hitOut = hitData(outHit);
+	{
+		py::gil_scoped_release release;
+		packed.occludedArrays(rayData, maxData, numRays, hitOut, parallel);
+	}
+	return outHit;
+}
+
+template<typename Real>
+carray<bool> traverseOccluded(
+	const BVH& bvh,
+	carray<Real> rays,
+	carray<Real> maxDistances,
+	bool parallel
+) {
+	int numRays = countDistances(maxDistances, countItems(rays, 6, "rays"));
+
+	carray<bool> outHit(numRays);
+	const Real* rayData = rays.data();
+	const Real* maxData = maxDistances.data();
+	uint8_t* hitOut = hitData(outHit);
+	{
+		py::gil_scoped_release release;
+		bvh.occludedArrays(rayData, maxData, numRays, hitOut, parallel);
+	}
+	return outHit;
+}
+
+template<typename Real>
+py::tuple traverseArrays(const BVH& bvh, carray<Real> rays, bool parallel) {
+	int numRays = countItems(rays, 6, "rays");
+
+	carray<int32_t> outIds(numRays);
+	carray<Real> outInter(numRays);
+	const Real* rayData = rays.data();
+	int32_t* idOut = outIds.mutable_data();
+	Real* interOut = outInter.mutable_data();
+	{
+		py::gil_scoped_release release;
+		bvh.intersectArrays(rayData, numRays, idOut, interOut, parallel);
+	}
+	return py::make_tuple(outIds, outInter);
+}
+
+}
+
 PYBIND11_MODULE(tracer, m) {
 	m.doc() = "pybind11 example plugin"; // optional module docstring
 
 	m.def("compute", &computeIntersections, "A function which adds two numbers");
 	m.def("computeParallel", &computeIntersectionsParallel, "A function which adds two numbers");
-}
\ No newline at end of file
+
+	const char* arraysDoc =
+		"Closest hit of each ray against the triangles. Takes contiguous float64 or "
+		"float32 rays/triangles and int32 ids without copying and returns "
+		"(int32 ids, distances) arrays of the input precision";
+	m.def("computeArrays",
+		[](carray<double> rays, carray<int32_t> ids, carray<double> tris) {
+			return computeArrays(rays, ids, tris, false);
+		}, arraysDoc, py::arg("rays"), py::arg("triangleIds"), py::arg("triangles"));
+	m.def("computeArrays",
+		[](carray<float> rays, carray<int32_t> ids, carray<float> tris) {
+			return computeArrays(rays, ids, tris, false);
+		}, arraysDoc, py::arg("rays"), py::arg("triangleIds"), py::arg("triangles"));
+	m.def("computeArraysParallel",
+		[](carray<double> rays, carray<int32_t> ids, carray<double> tris) {
+			return computeArrays(rays, ids, tris, true);
+		}, "Same as computeArrays, using OpenMP over the rays",
+		py::arg("rays"), py::arg("triangleIds"), py::arg("triangles"));
+	m.def("computeArraysParallel",
+		[](carray<float> rays, carray<int32_t> ids, carray<float> tris) {
+			return computeArrays(rays, ids, tris, true);
+		}, "Same as computeArrays, using OpenMP over the rays",
+		py::arg("rays"), py::arg("triangleIds"), py::arg("triangles"));
+
+	const char* occludedDoc =
+		"Any-hit query for shadow rays: boolean array telling for each ray if it "
+		"hits a triangle closer than its maximum distance. Stops at the first hit "
+		"found. Takes float64 or float32 rays, distances and triangles";
+	m.def("occludedArrays",
+		[](carray<double> rays, carray<double> maxDistances, carray<double> tris) {
+			return occludedArrays(rays, maxDistances, tris, false);
+		}, occludedDoc, py::arg("rays"), py::arg("maxDistances"), py::arg("triangles"));
+	m.def("occludedArrays",
+		[](carray<float> rays, carray<float> maxDistances, carray<float> tris) {
+			return occludedArrays(rays, maxDistances, tris, false);
+		}, occludedDoc, py::arg("rays"), py::arg("maxDistances"), py::arg("triangles"));
+	m.def("occludedArraysParallel",
+		[](carray<double> rays, carray<double> maxDistances, carray<double> tris) {
+			return occludedArrays(rays, maxDistances, tris, true);
+		}, "Same as occludedArrays, using OpenMP over the rays",
+		py::arg("rays"), py::arg("maxDistances"), py::arg("triangles"));
+	m.def("occludedArraysParallel",
+		[](carray<float> rays, carray<float> maxDistances, carray<float> tris) {
+			return occludedArrays(rays, maxDistances, tris, true);
+		}, "Same as occludedArrays, using OpenMP over the rays",
+		py::arg("rays"), py::arg("maxDistances"), py::arg("triangles"));
+
+	py::class_<BVH>(m, "BVH", "SAH bounding volume hierarchy built once over a triangle set")
+		.def(py::init(&buildBVH<double>), py::arg("triangleIds"), py::arg("triangleData"))
+		.def(py::init(&buildBVH<float>), py::arg("triangleIds"), py::arg("triangleData"))
+		.def("compute", &BVH::intersect, "Closest hit of each ray against the BVH triangles")
+		.def("computeParallel", &BVH::intersectParallel, "Same as compute, using OpenMP over the rays")
+		.def("computeArrays",
+			[](const BVH& bvh, carray<double> rays) { return traverseArrays(bvh, rays, false); },
+			"Array version of compute, see tracer.computeArrays", py::arg("rays"))
+		.def("computeArrays",
+			[](const BVH& bvh, carray<float> rays) { return traverseArrays(bvh, rays, false); },
+			"Array version of compute, see tracer.computeArrays", py::arg("rays"))
+		.def("computeArraysParallel",
+			[](const BVH& bvh, carray<double> rays) { return traverseArrays(bvh, rays, true); },
+			"Array version of computeParallel", py::arg("rays"))
+		.def("computeArraysParallel",
+			[](const BVH& bvh, carray<float> rays) { return traverseArrays(bvh, rays, true); },
+			"Array version of computeParallel", py::arg("rays"))
+		.def("occludedArrays",
+			[](const BVH& bvh, carray<double> rays, carray<double> maxDistances) {
+				return traverseOccluded(bvh, rays, maxDistances, false);
+			}, "Any-hit query, see tracer.occludedArrays", py::arg("rays"), py::arg("maxDistances"))
+		.def("occludedArrays",
+			[](const BVH& bvh, carray<float> rays, carray<float> maxDistances) {
+				return traverseOccluded(bvh, rays, maxDistances, false);
+			}, "Any-hit query, see tracer.occludedArrays", py::arg("rays"), py::arg("maxDistances"))
+		.def("occludedArraysParallel",
+			[](const BVH& bvh, carray<double> rays, carray<double> maxDistances) {
+				return traverseOccluded(bvh, rays, maxDistances, true);
+			}, "Same as occludedArrays, using OpenMP over the rays",
+			py::arg("rays"), py::arg("maxDistances"))
+		.def("occludedArraysParallel",
+			[](const BVH& bvh, carray<float> rays, carray<float> maxDistances) {
+				return traverseOccluded(bvh, rays, maxDistances, true);
+			}, "Same as occludedArrays, using OpenMP over the rays",
+			py::arg("rays"), py::arg("maxDistances"))
+		.def("toArrays", &bvhArrays,
+			"(bounds, links, triangles, ids, indices) flat arrays describing the tree, see fromArrays")
+		.def_static("fromArrays", &restoreBVH,
+			"Restore a BVH from the arrays returned by toArrays, checking that they form a valid tree",
+			py::arg("bounds"), py::arg("links"), py::arg("triangles"),
+			py::arg("triangleIds"), py::arg("triangleIndex"))
+		.def_property_readonly("numNodes", &BVH::numNodes)
+		.def_property_readonly("numTriangles", &BVH::numTriangles)
+		.def_property_readonly("depth", &BVH::depth)
+		.def_property_readonly("nbytes", &BVH::memoryUsage);
+
+	py::class_<PackedTriangles>(m, "PackedTriangles",
+		"Triangles laid out for the float32 SIMD kernel, testing one ray against "
+		"simdWidth() triangles at once")
+		.def(py::init(&packTriangles<double>),
+			py::arg("triangleIds"), py::arg("triangleData"), py::arg("width") = 0)
+		.def(py::init(&packTriangles<float>),
+			py::arg("triangleIds"), py::arg("triangleData"), py::arg("width") = 0)
+		.def("computeArrays",
+			[](const PackedTriangles& packed, carray<float> rays) { return packetArrays(packed, rays, false); },
+			"Closest hit of each float32 ray, see tracer.computeArrays", py::arg("rays"))
+		.def("computeArraysParallel",
+			[](const PackedTriangles& packed, carray<float> rays) { return packetArrays(packed, rays, true); },
+			"Same as computeArrays, using OpenMP over the rays", py::arg("rays"))
+		.def("occludedArrays",
+			[](const PackedTriangles& packed, carray<float> rays, carray<float> maxDistances) {
+				return packetOccluded(packed, rays, maxDistances, false);
+			}, "Any-hit query of float32 rays, see tracer.occludedArrays",
+			py::arg("rays"), py::arg("maxDistances"))
+		.def("occludedArraysParallel",
+			[](const PackedTriangles& packed, carray<float> rays, carray<float> maxDistances) {
+				return packetOccluded(packed, rays, maxDistances, true);
+			}, "Same as occludedArrays, using OpenMP over the rays",
+			py::arg("rays"), py::arg("maxDistances"))
+		.def_property_readonly("numTriangles", &PackedTriangles::numTriangles)
+		.def_property_readonly("width", &PackedTriangles::width)
+		.def_property_readonly("nbytes", &PackedTriangles::memoryUsage);
+
+	m.def("simdWidth", &simdWidth, "Triangles tested at once by the SIMD kernel on this CPU");
+	m.def("simdTarget", &simdTarget, "Instruction set used by the SIMD kernel on this CPU");
+}
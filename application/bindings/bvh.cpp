@@ -0,0 +1,496 @@
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+#include <utility>
+#include <vector>
+
+#include "bvh.hpp"
+#include "intersect.hpp"
+
+#define NUM_BINS 16
+#define MIN_LEAF_SIZE 2
+#define MAX_LEAF_SIZE 8
+#define MAX_DEPTH 64
+#define TRAVERSAL_COST 1.0
+#define INTERSECTION_COST 1.0
+// Boxes are slightly inflated so rounding in the slab test never culls a
+// triangle that the Möller test would accept.
+#define BOX_PADDING 1.0e-9
+
+namespace {
+
+struct Bounds {
+	double lo[3];
+	double hi[3];
+
+	Bounds() {
+		for(int i = 0; i < 3; i++)
+		{
+			lo[i] = HUGE_VAL;
+			hi[i] = -HUGE_VAL;
+		}
+	}
+
+	void grow(const double* p) {
+		for(int i = 0; i < 3; i++)
+		{
+			lo[i] = std::min(lo[i], p[i]);
+			hi[i] = std::max(hi[i], p[i]);
+		}
+	}
+
+	void grow(const Bounds& b) {
+		for(int i = 0; i < 3; i++)
+		{
+			lo[i] = std::min(lo[i], b.lo[i]);
+			hi[i] = std::max(hi[i], b.hi[i]);
+		}
+	}
+
+	double area() const {
+		if(lo[0] > hi[0]) return 0.0;
+		double dx = hi[0] - lo[0], dy = hi[1] - lo[1], dz = hi[2] - lo[2];
+		return 2.0 * (dx*dy + dy*dz + dz*dx);
+	}
+};
+
+struct BuildTriangle {
+	Bounds bounds;
+	double centroid[3];
+};
+
+struct Builder {
+	std::vector<BVHNode>& nodes;
+	std::vector<BuildTriangle> buildData;
+	std::vector<int> buildOrder;
+
+	Builder(std::vector<BVHNode>& nodes) : nodes(nodes) {}
+
+	int split(int node, int first, int count, int level);
+};
+
+// Slab test that ignores NaNs produced by 0 * inf, which keeps it
+// conservative for axis-aligned rays touching a box face.
+template<typename Real>
+inline bool hitBox(
+	const BVHNode& node,
+	const Real* origin,
+	const double* invDir,
+	double tMax,
+	double& tNear
+) {
+	double t0 = 0.0, t1 = tMax;
+	for(int i = 0; i < 3; i++)
+	{
+		double tLo = (node.boundsMin[i] - origin[i]) * invDir[i];
+		double tHi = (node.boundsMax[i] - origin[i]) * invDir[i];
+		if(tLo > tHi) std::swap(tLo, tHi);
+		t0 = tLo > t0 ? tLo : t0;
+		t1 = tHi < t1 ? tHi : t1;
+	}
+	tNear = t0;
+	return t0 <= t1;
+}
+
+int Builder::split(int node, int first, int count, int level) {
+	Bounds bounds, centroids;
+	for(int i = first; i < first + count; i++)
+	{
+		bounds.grow(buildData[buildOrder[i]].bounds);
+		centroids.grow(buildData[buildOrder[i]].centroid);
+	}
+
+	for(int i = 0; i < 3; i++)
+	{
+		double pad = BOX_PADDING * (1.0 + std::max(fabs(bounds.lo[i]), fabs(bounds.hi[i])));
+		nodes[node].boundsMin[i] = count > 0 ? bounds.lo[i] - pad : 0.0;
+		nodes[node].boundsMax[i] = count > 0 ? bounds.hi[i] + pad : -1.0;
+	}
+	nodes[node].leftFirst = first;
+	nodes[node].count = count;
+
+	if(count <= MIN_LEAF_SIZE || level >= MAX_DEPTH)
+		return level;
+
+	// binned SAH search over the three axes
+	double bestCost = INTERSECTION_COST * count;
+	int bestAxis = -1, bestBin = 0;
+	double nodeArea = bounds.area();
+
+	for(int axis = 0; axis < 3; axis++)
+	{
+		double extent = centroids.hi[axis] - centroids.lo[axis];
+		if(extent <= 0.0) continue;
+
+		Bounds binBounds[NUM_BINS];
+		int binCount[NUM_BINS] = {0};
+		double scale = NUM_BINS / extent;
+		for(int i = first; i < first + count; i++)
+		{
+			const BuildTriangle& bt = buildData[buildOrder[i]];
+			int bin = std::min(NUM_BINS - 1, (int)((bt.centroid[axis] - centroids.lo[axis]) * scale));
+			binCount[bin]++;
+			binBounds[bin].grow(bt.bounds);
+		}
+
+		double rightArea[NUM_BINS];
+		int rightCount[NUM_BINS];
+		Bounds acc;
+		int accCount = 0;
+		for(int bin = NUM_BINS - 1; bin > 0; bin--)
+		{
+			acc.grow(binBounds[bin]);
+			accCount += binCount[bin];
+			rightArea[bin] = acc.area();
+			rightCount[bin] = accCount;
+		}
+
+		acc = Bounds();
+		accCount = 0;
+		for(int bin = 1; bin < NUM_BINS; bin++)
+		{
+			acc.grow(binBounds[bin - 1]);
+			accCount += binCount[bin - 1];
+			if(accCount == 0 || rightCount[bin] == 0) continue;
+			double cost = TRAVERSAL_COST + INTERSECTION_COST *
+				(acc.area()*accCount + rightArea[bin]*rightCount[bin]) / nodeArea;
+			if(cost < bestCost)
+			{
+				bestCost = cost;
+				bestAxis = axis;
+				bestBin = bin;
+			}
+		}
+	}
+
+	int middle;
+	if(bestAxis >= 0)
+	{
+		double lo = centroids.lo[bestAxis];
+		double scale = NUM_BINS / (centroids.hi[bestAxis] - lo);
+		int* mid = std::partition(
+			&buildOrder[first],
+			&buildOrder[first] + count,
+			[&](int tri) {
+				int bin = std::min(NUM_BINS - 1, (int)((buildData[tri].centroid[bestAxis] - lo) * scale));
+				return bin < bestBin;
+			});
+		middle = mid - &buildOrder[0];
+	}
+	else if(count > MAX_LEAF_SIZE)
+	{
+		// SAH prefers a leaf but it would be too large: median split
+		int axis = 0;
+		for(int i = 1; i < 3; i++)
+			if(centroids.hi[i] - centroids.lo[i] > centroids.hi[axis] - centroids.lo[axis])
+				axis = i;
+		middle = first + count / 2;
+		std::nth_element(
+			&buildOrder[first],
+			&buildOrder[middle],
+			&buildOrder[first] + count,
+			[&](int a, int b) {
+				return buildData[a].centroid[axis] < buildData[b].centroid[axis];
+			});
+	}
+	else
+	{
+		return level;
+	}
+
+	int left = nodes.size();
+	nodes.push_back(BVHNode());
+	nodes.push_back(BVHNode());
+	nodes[node].leftFirst = left;
+	nodes[node].count = 0;
+
+	int leftDepth  = split(left, first, middle - first, level + 1);
+	int rightDepth = split(left + 1, middle, first + count - middle, level + 1);
+	return std::max(leftDepth, rightDepth);
+}
+
+}
+
+BVH::BVH(
+	const std::vector<int>& triangleIds,
+	const std::vector<double>& triangleData
+) : BVH(triangleIds.data(), triangleData.data(), triangleData.size() / TRIANGLE_ATTR_NUMBER) {
+}
+
+template<typename Real>
+BVH::BVH(
+	const int* triangleIds,
+	const Real* triangleData,
+	int numTriangles
+) : tris(triangleData, triangleData + numTriangles*TRIANGLE_ATTR_NUMBER),
+	ids(triangleIds, triangleIds + numTriangles),
+	treeDepth(0) {
+	build();
+}
+
+template BVH::BVH(const int*, const float*, int);
+template BVH::BVH(const int*, const double*, int);
+
+BVH::BVH(
+	std::vector<BVHNode> nodes,
+	std::vector<double> tris,
+	std::vector<int> ids,
+	std::vector<int> triIndex
+) : nodes(std::move(nodes)),
+	tris(std::move(tris)),
+	ids(std::move(ids)),
+	triIndex(std::move(triIndex)),
+	treeDepth(0) {
+	validate();
+}
+
+void BVH::validate() {
+	long long numTriangles = ids.size();
+	if((long long)tris.size() != numTriangles*TRIANGLE_ATTR_NUMBER || triIndex.size() != ids.size())
+		throw std::invalid_argument("BVH triangle arrays have inconsistent sizes");
+	for(int index : triIndex)
+		if(index < 0 || index >= numTriangles)
+			throw std::invalid_argument("BVH triangle index out of range");
+	if(numTriangles == 0)
+	{
+		// nothing to restore, an empty tree is a single empty leaf
+		build();
+		return;
+	}
+	if(nodes.empty())
+		throw std::invalid_argument("BVH has no nodes");
+
+	// children are always stored after their parent, which rules out
+	// cycles, and the depth must fit the traversal stack
+	std::vector<int> level(nodes.size(), 0);
+	level[0] = 1;
+	for(size_t node = 0; node < nodes.size(); node++)
+	{
+		const BVHNode& n = nodes[node];
+		if(n.count > 0)
+		{
+			if(n.leftFirst < 0 || (long long)n.leftFirst + n.count > numTriangles)
+				throw std::invalid_argument("BVH leaf out of the triangle range");
+		}
+		else
+		{
+			if(n.count < 0 || n.leftFirst <= (long long)node || (size_t)n.leftFirst + 1 >= nodes.size())
+				throw std::invalid_argument("BVH node with invalid children");
+			level[n.leftFirst] = std::max(level[n.leftFirst], level[node] + 1);
+			level[n.leftFirst + 1] = std::max(level[n.leftFirst + 1], level[node] + 1);
+		}
+		treeDepth = std::max(treeDepth, level[node]);
+	}
+	if(treeDepth > MAX_DEPTH)
+		throw std::invalid_argument("BVH deeper than the traversal stack");
+}
+
+void BVH::build() {
+	int numTriangles = ids.size();
+
+	Builder builder(nodes);
+	builder.buildData.resize(numTriangles);
+	builder.buildOrder.resize(numTriangles);
+	for(int tri = 0; tri < numTriangles; tri++)
+	{
+		const double* v = &(tris[tri*TRIANGLE_ATTR_NUMBER]);
+		BuildTriangle& bt = builder.buildData[tri];
+		for(int i = 0; i < 3; i++)
+			bt.bounds.grow(v + i*COORDS);
+		for(int i = 0; i < 3; i++)
+			bt.centroid[i] = (v[i] + v[COORDS + i] + v[2*COORDS + i]) / 3.0;
+		builder.buildOrder[tri] = tri;
+	}
+
+	nodes.clear();
+	nodes.reserve(std::max(1, 2*numTriangles - 1));
+	nodes.push_back(BVHNode());
+	treeDepth = builder.split(0, 0, numTriangles, 1);
+
+	// store the triangles in leaf order so each leaf is a contiguous block
+	std::vector<double> orderedTris(tris.size());
+	std::vector<int> orderedIds(numTriangles);
+	triIndex.resize(numTriangles);
+	for(int i = 0; i < numTriangles; i++)
+	{
+		int tri = builder.buildOrder[i];
+		std::copy(
+			tris.begin() + tri*TRIANGLE_ATTR_NUMBER,
+			tris.begin() + (tri + 1)*TRIANGLE_ATTR_NUMBER,
+			orderedTris.begin() + i*TRIANGLE_ATTR_NUMBER);
+		orderedIds[i] = ids[tri];
+		triIndex[i] = tri;
+	}
+	tris.swap(orderedTris);
+	ids.swap(orderedIds);
+}
+
+template<typename Real>
+void BVH::closestHit(const Real* ray, int& outId, double& outInter) const {
+	const Real* origin = ray;
+	const Real* direction = ray + COORDS;
+	double invDir[3];
+	for(int i = 0; i < 3; i++)
+		invDir[i] = 1.0 / direction[i];
+
+	int bestIndex = -1;
+	outId = -1;
+	outInter = MAX_DISTANCE;
+
+	struct StackEntry { int node; double tNear; };
+	StackEntry stack[MAX_DEPTH + 2];
+	int top = 0;
+
+	double tNear;
+	if(nodes.empty() || !hitBox(nodes[0], origin, invDir, outInter, tNear))
+		return;
+	stack[top++] = {0, tNear};
+
+	while(top > 0)
+	{
+		StackEntry entry = stack[--top];
+		// ties are still visited so the lowest triangle index wins, as in
+		// the brute-force loop
+		if(entry.tNear > outInter) continue;
+
+		const BVHNode& node = nodes[entry.node];
+		if(node.count > 0)
+		{
+			for(int i = node.leftFirst; i < node.leftFirst + node.count; i++)
+			{
+				double t;
+				if(rayTriangleIntersect(t, origin, direction, &(tris[i*TRIANGLE_ATTR_NUMBER])))
+				if(t > EPSILON && (t < outInter || (t == outInter && bestIndex >= 0 && triIndex[i] < bestIndex)))
+				{
+					outInter = t;
+					outId = ids[i];
+					bestIndex = triIndex[i];
+				}
+			}
+			continue;
+		}
+
+		double tLeft, tRight;
+		bool hitLeft  = hitBox(nodes[node.leftFirst], origin, invDir, outInter, tLeft);
+		bool hitRight = hitBox(nodes[node.leftFirst + 1], origin, invDir, outInter, tRight);
+		// push the far child first so the near one is popped next
+		if(hitLeft && hitRight)
+		{
+			if(tLeft <= tRight)
+			{
+				stack[top++] = {node.leftFirst + 1, tRight};
+				stack[top++] = {node.leftFirst, tLeft};
+			}
+			else
+			{
+				stack[top++] = {node.leftFirst, tLeft};
+				stack[top++] = {node.leftFirst + 1, tRight};
+			}
+		}
+		else if(hitLeft)
+		{
+			stack[top++] = {node.leftFirst, tLeft};
+		}
+		else if(hitRight)
+		{
+			stack[top++] = {node.leftFirst + 1, tRight};
+		}
+	}
+}
+
+// Stops at the first triangle closer than maxDistance, children are visited
+// in any order since no closer hit is needed
+template<typename Real>
+bool BVH::anyHit(const Real* ray, double maxDistance) const {
+	const Real* origin = ray;
+	const Real* direction = ray + COORDS;
+	double invDir[3];
+	for(int i = 0; i < 3; i++)
+		invDir[i] = 1.0 / direction[i];
+
+	int stack[MAX_DEPTH + 2];
+	int top = 0;
+
+	double tNear;
+	if(nodes.empty() || !hitBox(nodes[0], origin, invDir, maxDistance, tNear))
+		return false;
+	stack[top++] = 0;
+
+	while(top > 0)
+	{
+		const BVHNode& node = nodes[stack[--top]];
+		if(node.count > 0)
+		{
+			for(int i = node.leftFirst; i < node.leftFirst + node.count; i++)
+			{
+				double t;
+				if(rayTriangleIntersect(t, origin, direction, &(tris[i*TRIANGLE_ATTR_NUMBER])))
+				if(t > EPSILON && t < maxDistance)
+					return true;
+			}
+			continue;
+		}
+
+		if(hitBox(nodes[node.leftFirst], origin, invDir, maxDistance, tNear))
+			stack[top++] = node.leftFirst;
+		if(hitBox(nodes[node.leftFirst + 1], origin, invDir, maxDistance, tNear))
+			stack[top++] = node.leftFirst + 1;
+	}
+	return false;
+}
+
+template<typename Real>
+void BVH::occludedArrays(
+	const Real* rayData,
+	const Real* maxDistances,
+	int numRays,
+	uint8_t* outHit,
+	bool parallel
+) const {
+	#pragma omp parallel for schedule(dynamic, 64) if(parallel)
+	for(int ray = 0; ray < numRays; ray++)
+		outHit[ray] = anyHit(&(rayData[ray*RAY_ATTR_NUMBER]), maxDistances[ray]);
+}
+
+template void BVH::occludedArrays<float>(const float*, const float*, int, uint8_t*, bool) const;
+template void BVH::occludedArrays<double>(const double*, const double*, int, uint8_t*, bool) const;
+
+template<typename Real>
+void BVH::intersectArrays(
+	const Real* rayData,
+	int numRays,
+	int* outIds,
+	Real* outInter,
+	bool parallel
+) const {
+	#pragma omp parallel for schedule(dynamic, 64) if(parallel)
+	for(int ray = 0; ray < numRays; ray++)
+	{
+		double closestInter;
+		closestHit(&(rayData[ray*RAY_ATTR_NUMBER]), outIds[ray], closestInter);
+		outInter[ray] = closestInter;
+	}
+}
+
+template void BVH::intersectArrays<float>(const float*, int, int*, float*, bool) const;
+template void BVH::intersectArrays<double>(const double*, int, int*, double*, bool) const;
+
+intersectResults BVH::intersect(const std::vector<double>& rayData) const {
+	int numRays = rayData.size() / RAY_ATTR_NUMBER;
+
+	std::vector<int> outIds(numRays);
+	std::vector<double> outInter(numRays);
+	intersectArrays(rayData.data(), numRays, outIds.data(), outInter.data(), false);
+
+	return std::make_pair(outIds, outInter);
+}
+
+intersectResults BVH::intersectParallel(const std::vector<double>& rayData) const {
+	int numRays = rayData.size() / RAY_ATTR_NUMBER;
+
+	std::vector<int> outIds(numRays);
+	std::vector<double> outInter(numRays);
+	intersectArrays(rayData.data(), numRays, outIds.data(), outInter.data(), true);
+
+	return std::make_pair(outIds, outInter);
+}
@@ -0,0 +1,87 @@
+#ifndef _BVH_H_
+#define _BVH_H_
+
+#include <vector>
+#include "tracer.hpp"
+
+struct BVHNode {
+	double boundsMin[3];
+	double boundsMax[3];
+	// Interior nodes: index of the left child (the right one follows it).
+	// Leaves: index of the first triangle in the BVH triangle order.
+	int leftFirst;
+	// Number of triangles in a leaf, 0 for interior nodes
+	int count;
+};
+
+class BVH {
+public:
+	BVH(
+		const std::vector<int>& triangleIds,
+		const std::vector<double>& triangleData);
+
+	template<typename Real>
+	BVH(
+		const int* triangleIds,
+		const Real* triangleData,
+		int numTriangles);
+
+	// Restores a BVH from the arrays of another one (see the accessors
+	// below), e.g. read back from a file. Throws std::invalid_argument
+	// when they don't describe a tree that can be traversed safely.
+	BVH(
+		std::vector<BVHNode> nodes,
+		std::vector<double> tris,
+		std::vector<int> ids,
+		std::vector<int> triIndex);
+
+	intersectResults intersect(const std::vector<double>& rayData) const;
+	intersectResults intersectParallel(const std::vector<double>& rayData) const;
+
+	// Pointer based traversal used by the NumPy entry points
+	template<typename Real>
+	void intersectArrays(
+		const Real* rayData,
+		int numRays,
+		int* outIds,
+		Real* outInter,
+		bool parallel) const;
+
+	// Any-hit traversal, see occludedArrays in tracer.hpp
+	template<typename Real>
+	void occludedArrays(
+		const Real* rayData,
+		const Real* maxDistances,
+		int numRays,
+		uint8_t* outHit,
+		bool parallel) const;
+
+	int numNodes() const { return nodes.size(); }
+	int numTriangles() const { return triIndex.size(); }
+	int depth() const { return treeDepth; }
+	const std::vector<BVHNode>& nodeData() const { return nodes; }
+	const std::vector<double>& triangleData() const { return tris; }
+	const std::vector<int>& triangleIds() const { return ids; }
+	const std::vector<int>& triangleIndex() const { return triIndex; }
+	size_t memoryUsage() const {
+		return nodes.size()*sizeof(BVHNode) + tris.size()*sizeof(double)
+			+ (ids.size() + triIndex.size())*sizeof(int);
+	}
+
+private:
+	void build();
+	void validate();
+	template<typename Real>
+	void closestHit(const Real* ray, int& outId, double& outInter) const;
+	template<typename Real>
+	bool anyHit(const Real* ray, double maxDistance) const;
+
+	std::vector<BVHNode> nodes;
+	// Triangle data, ids and original positions stored in BVH leaf order
+	std::vector<double> tris;
+	std::vector<int> ids;
+	std::vector<int> triIndex;
+	int treeDepth;
+};
+
+#endif
@@ -0,0 +1,76 @@
+#ifndef _INTERSECT_H_
+#define _INTERSECT_H_
+
+#include <cmath>
+
+#define EPSILON 1.0e-6
+#define MAX_DISTANCE 1.0e9
+#define TRIANGLE_ATTR_NUMBER 9
+#define RAY_ATTR_NUMBER 6
+
+#define COORDS 3
+#define VEC3(NAME) double NAME[COORDS]
+#define ASSIGN(VL, VR) (VL)[0] = (VR)[0]; (VL)[1] = (VR)[1]; (VL)[2] = (VR)[2]
+#define DOT(V1, V2) (V1[0]*V2[0] + V1[1]*V2[1] + V1[2]*V2[2])
+#define CROSS(VR, V1, V2) \
+	VR[0] = V1[1] * V2[2] - V1[2] * V2[1], \
+	VR[1] = V1[2] * V2[0] - V1[0] * V2[2], \
+	VR[2] = V1[0] * V2[1] - V1[1] * V2[0]
+#define SUB(VR, V1, V2) 	\
+	VR[0] = V1[0] - V2[0]; 	\
+	VR[1] = V1[1] - V2[1]; 	\
+	VR[2] = V1[2] - V2[2]
+
+// Möller-Trumbore test of one ray against one triangle. Shared by the
+// brute-force loops and the BVH leaves so both paths produce bit-identical
+// distances. Inputs may be stored as float or double, the test itself
+// always runs in double precision.
+template<typename RayReal, typename TriReal>
+inline bool rayTriangleIntersect(
+	double& t,
+	const RayReal* origin,
+	const RayReal* direction,
+	const TriReal* tri
+) {
+	VEC3(v0); VEC3(v1); VEC3(v2);
+	ASSIGN(v0, tri);
+	ASSIGN(v1, tri + COORDS);
+	ASSIGN(v2, tri + 2*COORDS);
+
+	VEC3(edge1); VEC3(edge2);
+	SUB(edge1, v1, v0);
+	SUB(edge2, v2, v0);
+
+	VEC3(h);
+	CROSS(h, direction, edge2);
+	double a = DOT(edge1, h);
+
+	if(fabs(a) < EPSILON)
+	{
+		return false;
+	}
+
+	double f = 1.0 / a;
+	VEC3(s);
+	SUB(s, origin, v0);
+	double u = f * DOT(s, h);
+
+	if(u < 0.0 || u > 1.0)
+	{
+		return false;
+	}
+
+	VEC3(q);
+	CROSS(q, s, edge1);
+	double v = f * DOT(direction, q);
+
+	if(v < 0.0 || u + v > 1.0)
+	{
+		return false;
+	}
+
+	t = f * DOT(edge2, q);
+	return true;
+}
+
+#endif
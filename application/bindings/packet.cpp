@@ -0,0 +1,329 @@
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include "packet.hpp"
+#include "intersect.hpp"
+
+#if defined(__x86_64__) || defined(__i386__)
+#define X86_DISPATCH
+#endif
+
+#define PACKET_ATTRS 9
+// rays handed to a thread at a time
+#define RAY_BLOCK 64
+// packets tested by a shadow ray between checks for a hit
+#define OCCLUSION_STRIDE 8
+
+namespace {
+
+// Tests one ray against the W triangles of a packet. Every lane keeps its
+// own closest hit, the branchless body lets the compiler turn the lane loop
+// into vector instructions.
+template<int W>
+inline __attribute__((always_inline)) void intersectPacket(
+	const float* origin,
+	const float* direction,
+	const float* packet,
+	int firstTriangle,
+	float* bestT,
+	int* bestIndex
+) {
+	const float* v0x = packet;
+	const float* v0y = packet + W;
+	const float* v0z = packet + 2*W;
+	const float* e1x = packet + 3*W;
+	const float* e1y = packet + 4*W;
+	const float* e1z = packet + 5*W;
+	const float* e2x = packet + 6*W;
+	const float* e2y = packet + 7*W;
+	const float* e2z = packet + 8*W;
+	const float ox = origin[0], oy = origin[1], oz = origin[2];
+	const float dx = direction[0], dy = direction[1], dz = direction[2];
+
+	#pragma omp simd
+	for(int lane = 0; lane < W; lane++)
+	{
+		float hx = dy*e2z[lane] - dz*e2y[lane];
+		float hy = dz*e2x[lane] - dx*e2z[lane];
+		float hz = dx*e2y[lane] - dy*e2x[lane];
+		float a = e1x[lane]*hx + e1y[lane]*hy + e1z[lane]*hz;
+		float f = 1.0f / a;
+
+		float sx = ox - v0x[lane];
+		float sy = oy - v0y[lane];
+		float sz = oz - v0z[lane];
+		float u = f * (sx*hx + sy*hy + sz*hz);
+
+		float qx = sy*e1z[lane] - sz*e1y[lane];
+		float qy = sz*e1x[lane] - sx*e1z[lane];
+		float qz = sx*e1y[lane] - sy*e1x[lane];
+		float v = f * (dx*qx + dy*qy + dz*qz);
+		float t = f * (e2x[lane]*qx + e2y[lane]*qy + e2z[lane]*qz);
+
+		// bitwise operators, a branch would stop the vectorization
+		bool hit = ((a > (float)EPSILON) | (a < -(float)EPSILON))
+			& (u >= 0.0f) & (u <= 1.0f) & (v >= 0.0f) & (u + v <= 1.0f)
+			& (t > (float)EPSILON) & (t < bestT[lane]);
+		bestT[lane] = hit ? t : bestT[lane];
+		bestIndex[lane] = hit ? firstTriangle + lane : bestIndex[lane];
+	}
+}
+
+// Closest hits of the rays first to last - 1. Has no OpenMP region: the
+// outlined body of one would lose the target attributes of the callers.
+template<int W>
+inline __attribute__((always_inline)) void intersectPackets(
+	const float* rayData,
+	int first,
+	int last,
+	const float* data,
+	const int* ids,
+	int numPackets,
+	int* outIds,
+	float* outInter
+) {
+	for(int ray = first; ray < last; ray++)
+	{
+		const float* origin = rayData + ray*RAY_ATTR_NUMBER;
+		alignas(64) float bestT[W];
+		alignas(64) int bestIndex[W];
+		for(int lane = 0; lane < W; lane++)
+		{
+			bestT[lane] = (float)MAX_DISTANCE;
+			bestIndex[lane] = -1;
+		}
+
+		for(int packet = 0; packet < numPackets; packet++)
+			intersectPacket<W>(origin, origin + COORDS,
+				data + packet*PACKET_ATTRS*W, packet*W, bestT, bestIndex);
+
+		// closest of the lanes, the first triangle wins ties like in the
+		// scalar kernel
+		float closestInter = (float)MAX_DISTANCE;
+		int closestIndex = -1;
+		for(int lane = 0; lane < W; lane++)
+		{
+			if(bestIndex[lane] < 0)
+				continue;
+			if(bestT[lane] < closestInter
+				|| (bestT[lane] == closestInter && bestIndex[lane] < closestIndex))
+			{
+				closestInter = bestT[lane];
+				closestIndex = bestIndex[lane];
+			}
+		}
+		outIds[ray] = closestIndex < 0 ? -1 : ids[closestIndex];
+		outInter[ray] = closestInter;
+	}
+}
+
+// Shadow rays: every lane starts from the maximum distance of the ray, so
+// any lane left with a triangle index is a hit before the light
+template<int W>
+inline __attribute__((always_inline)) void occludedPackets(
+	const float* rayData,
+	const float* maxDistances,
+	int first,
+	int last,
+	const float* data,
+	int numPackets,
+	uint8_t* outHit
+) {
+	for(int ray = first; ray < last; ray++)
+	{
+		const float* origin = rayData + ray*RAY_ATTR_NUMBER;
+		alignas(64) float bestT[W];
+		alignas(64) int bestIndex[W];
+		for(int lane = 0; lane < W; lane++)
+		{
+			bestT[lane] = maxDistances[ray];
+			bestIndex[lane] = -1;
+		}
+
+		// the lanes are checked every few packets, a check per packet
+		// costs more than the tests it saves
+		int hit = 0;
+		for(int packet = 0; packet < numPackets && !hit; packet += OCCLUSION_STRIDE)
+		{
+			int end = packet + OCCLUSION_STRIDE < numPackets ? packet + OCCLUSION_STRIDE : numPackets;
+			for(int next = packet; next < end; next++)
+				intersectPacket<W>(origin, origin + COORDS,
+					data + next*PACKET_ATTRS*W, next*W, bestT, bestIndex);
+			for(int lane = 0; lane < W; lane++)
+				hit |= bestIndex[lane] >= 0;
+		}
+		outHit[ray] = hit;
+	}
+}
+
+typedef void (*PacketKernel)(
+	const float*, int, int, const float*, const int*, int, int*, float*);
+typedef void (*OcclusionKernel)(
+	const float*, const float*, int, int, const float*, int, uint8_t*);
+
+void intersectPackets4(
+	const float* rayData, int first, int last, const float* data, const int* ids,
+	int numPackets, int* outIds, float* outInter
+) {
+	intersectPackets<4>(rayData, first, last, data, ids, numPackets, outIds, outInter);
+}
+
+void occludedPackets4(
+	const float* rayData, const float* maxDistances, int first, int last,
+	const float* data, int numPackets, uint8_t* outHit
+) {
+	occludedPackets<4>(rayData, maxDistances, first, last, data, numPackets, outHit);
+}
+
+#ifdef X86_DISPATCH
+__attribute__((target("avx2,fma")))
+void intersectPackets8(
+	const float* rayData, int first, int last, const float* data, const int* ids,
+	int numPackets, int* outIds, float* outInter
+) {
+	intersectPackets<8>(rayData, first, last, data, ids, numPackets, outIds, outInter);
+}
+
+__attribute__((target("avx512f")))
+void intersectPackets16(
+	const float* rayData, int first, int last, const float* data, const int* ids,
+	int numPackets, int* outIds, float* outInter
+) {
+	intersectPackets<16>(rayData, first, last, data, ids, numPackets, outIds, outInter);
+}
+
+__attribute__((target("avx2,fma")))
+void occludedPackets8(
+	const float* rayData, const float* maxDistances, int first, int last,
+	const float* data, int numPackets, uint8_t* outHit
+) {
+	occludedPackets<8>(rayData, maxDistances, first, last, data, numPackets, outHit);
+}
+
+__attribute__((target("avx512f")))
+void occludedPackets16(
+	const float* rayData, const float* maxDistances, int first, int last,
+	const float* data, int numPackets, uint8_t* outHit
+) {
+	occludedPackets<16>(rayData, maxDistances, first, last, data, numPackets, outHit);
+}
+#endif
+
+PacketKernel packetKernel(int width) {
+#ifdef X86_DISPATCH
+	if(width == 16)
+		return intersectPackets16;
+	if(width == 8)
+		return intersectPackets8;
+#endif
+	return intersectPackets4;
+}
+
+OcclusionKernel occlusionKernel(int width) {
+#ifdef X86_DISPATCH
+	if(width == 16)
+		return occludedPackets16;
+	if(width == 8)
+		return occludedPackets8;
+#endif
+	return occludedPackets4;
+}
+
+}
+
+int simdWidth() {
+#ifdef X86_DISPATCH
+	__builtin_cpu_init();
+	if(__builtin_cpu_supports("avx512f"))
+		return 16;
+	if(__builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma"))
+		return 8;
+#endif
+	return 4;
+}
+
+std::string simdTarget() {
+#ifdef X86_DISPATCH
+	switch(simdWidth())
+	{
+		case 16: return "avx512f";
+		case 8: return "avx2";
+		default: return "sse2";
+	}
+#elif defined(__aarch64__)
+	return "neon";
+#else
+	// 32-bit ARM included: NEON flushes denormals to zero, so GCC only
+	// vectorizes float code for it with -funsafe-math-optimizations
+	return "scalar";
+#endif
+}
+
+template<typename Real>
+PackedTriangles::PackedTriangles(
+	const int* triangleIds,
+	const Real* triangleData,
+	int numTriangles,
+	int width
+) : triangleCount(numTriangles), packetWidth(width ? width : simdWidth()) {
+	if(packetWidth != 4 && (packetWidth > simdWidth() || (packetWidth != 8 && packetWidth != 16)))
+		throw std::invalid_argument(
+			"packet width must be 4, 8 or 16 and supported by the CPU");
+	const int W = packetWidth;
+	numPackets = (numTriangles + W - 1) / W;
+	// padding lanes stay degenerate (all zero) and never hit
+	data.assign((size_t)numPackets*PACKET_ATTRS*W, 0.0f);
+	ids.assign((size_t)numPackets*W, -1);
+
+	for(int tri = 0; tri < numTriangles; tri++)
+	{
+		const Real* v = triangleData + tri*TRIANGLE_ATTR_NUMBER;
+		float* packet = &data[(size_t)(tri / W)*PACKET_ATTRS*W];
+		int lane = tri % W;
+		for(int axis = 0; axis < COORDS; axis++)
+		{
+			packet[axis*W + lane] = (float)v[axis];
+			// edges from the single precision vertices, as the scalar
+			// float path computes them
+			packet[(3 + axis)*W + lane] = (float)v[COORDS + axis] - (float)v[axis];
+			packet[(6 + axis)*W + lane] = (float)v[2*COORDS + axis] - (float)v[axis];
+		}
+		ids[tri] = triangleIds[tri];
+	}
+}
+
+template PackedTriangles::PackedTriangles(const int*, const float*, int, int);
+template PackedTriangles::PackedTriangles(const int*, const double*, int, int);
+
+void PackedTriangles::intersectArrays(
+	const float* rayData,
+	int numRays,
+	int* outIds,
+	float* outInter,
+	bool parallel
+) const {
+	PacketKernel kernel = packetKernel(packetWidth);
+	#pragma omp parallel for schedule(dynamic) if(parallel)
+	for(int first = 0; first < numRays; first += RAY_BLOCK)
+	{
+		int last = first + RAY_BLOCK < numRays ? first + RAY_BLOCK : numRays;
+		kernel(rayData, first, last, data.data(), ids.data(), numPackets, outIds, outInter);
+	}
+}
+
+void PackedTriangles::occludedArrays(
+	const float* rayData,
+	const float* maxDistances,
+	int numRays,
+	uint8_t* outHit,
+	bool parallel
+) const {
+	OcclusionKernel kernel = occlusionKernel(packetWidth);
+	#pragma omp parallel for schedule(dynamic) if(parallel)
+	for(int first = 0; first < numRays; first += RAY_BLOCK)
+	{
+		int last = first + RAY_BLOCK < numRays ? first + RAY_BLOCK : numRays;
+		kernel(rayData, maxDistances, first, last, data.data(), numPackets, outHit);
+	}
+}
@@ -0,0 +1,65 @@
+#ifndef _PACKET_H_
+#define _PACKET_H_
+
+#include <cstdint>
+#include <string>
+#include <vector>
+
+// Triangles prepared for the single precision packet kernel: vertex 0 and
+// the two edges of every triangle, stored as structure of arrays in packets
+// of `width` triangles (padded with degenerate ones), so one ray is tested
+// against a whole packet with vector instructions. The packet width follows
+// the widest vector unit found at runtime: 16 (AVX-512), 8 (AVX2) or 4
+// (SSE2, 64-bit NEON and anything else), or is given explicitly to compare
+// them.
+class PackedTriangles {
+public:
+	// Throws std::invalid_argument when `width` isn't 0 (the widest) or a
+	// width this CPU supports
+	template<typename Real>
+	PackedTriangles(
+		const int* triangleIds,
+		const Real* triangleData,
+		int numTriangles,
+		int width = 0);
+
+	// Closest hit of each ray, as intersectArrays. Distances are computed in
+	// float, so they may differ from the double kernels in the last bits and
+	// hits exactly on a triangle edge may be decided differently.
+	void intersectArrays(
+		const float* rayData,
+		int numRays,
+		int* outIds,
+		float* outInter,
+		bool parallel) const;
+
+	// Any-hit query, as occludedArrays in tracer.hpp. A ray stops after the
+	// first packet with a hit closer than its maximum distance.
+	void occludedArrays(
+		const float* rayData,
+		const float* maxDistances,
+		int numRays,
+		uint8_t* outHit,
+		bool parallel) const;
+
+	int numTriangles() const { return triangleCount; }
+	int width() const { return packetWidth; }
+	size_t memoryUsage() const {
+		return data.size()*sizeof(float) + ids.size()*sizeof(int);
+	}
+
+private:
+	int triangleCount;
+	int packetWidth;
+	int numPackets;
+	// Per packet: v0 x/y/z, edge1 x/y/z and edge2 x/y/z, `width` floats each
+	std::vector<float> data;
+	// Triangle id of every lane, padding lanes included
+	std::vector<int> ids;
+};
+
+// Packet width used on this CPU and the name of the instruction set
+int simdWidth();
+std::string simdTarget();
+
+#endif
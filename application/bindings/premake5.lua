@@ -17,7 +17,7 @@ project "tests"
         defines { "NDEBUG" }
         optimize "On"
 
-    files { "main.cpp", "tracer.cpp", "tracer.hpp"}
+    files { "main.cpp", "tracer.cpp", "tracer.hpp", "bvh.cpp", "bvh.hpp", "packet.cpp", "packet.hpp", "intersect.hpp"}
 
 project "tracer"
     kind "SharedLib"
@@ -39,7 +39,7 @@ project "tracer"
     filter {"action:vs*"}
         targetextension (".pyd")
 
-    files { "binding.cpp", "tracer.cpp", "tracer.hpp"}
+    files { "binding.cpp", "tracer.cpp", "tracer.hpp", "bvh.cpp", "bvh.hpp", "packet.cpp", "packet.hpp", "intersect.hpp"}
 
     filter "configurations:x32"
         architecture "x86"
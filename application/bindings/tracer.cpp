@@ -3,6 +3,7 @@
 #include <tuple>
 
 #include "tracer.hpp"
+#include "intersect.hpp"
 
 #ifdef DEBUG
 #include <iostream>
@@ -17,79 +18,81 @@
 #define PRINT_VEC3(VEC)
 #endif
 
-#define EPSILON 1.0e-6
-#define INFINITY 1.0e9
-#define TRIANGLE_ATTR_NUMBER 9
-#define RAY_ATTR_NUMBER 6
-
-#define COORDS 3
-#define VEC3(NAME) double NAME[COORDS]
-#define ASSIGN(VL, VR) (VL)[0] = (VR)[0]; (VL)[1] = (VR)[1]; (VL)[2] = (VR)[2]
-#define DOT(V1, V2) (V1[0]*V2[0] + V1[1]*V2[1] + V1[2]*V2[2])
-#define CROSS(VR, V1, V2) \
-	VR[0] = V1[1] * V2[2] - V1[2] * V2[1], \
-	VR[1] = V1[2] * V2[0] - V1[0] * V2[2], \
-	VR[2] = V1[0] * V2[1] - V1[1] * V2[0]
-#define SUB(VR, V1, V2) 	\
-	VR[0] = V1[0] - V2[0]; 	\
-	VR[1] = V1[1] - V2[1]; 	\
-	VR[2] = V1[2] - V2[2]
-
-bool rayIntersect(
-	double& t, 
-	const int ray, 
-	const std::vector<double>& rayData, 
-	const int tri,
-	const std::vector<double>& triData
+template<typename Real>
+void intersectArrays(
+	const Real* rayData,
+	int numRays,
+	const int* triangleIds,
+	const Real* triangleData,
+	int numTriangles,
+	int* outIds,
+	Real* outInter,
+	bool parallel
 ) {
-	VEC3(origin); VEC3(direction);
-	VEC3(v0); VEC3(v1); VEC3(v2);
-
-	int rayBase = ray*RAY_ATTR_NUMBER;
-	ASSIGN(origin, 	  &(rayData[rayBase])); 
-	ASSIGN(direction, &(rayData[rayBase + COORDS]));
-	
-	int triBase = tri*TRIANGLE_ATTR_NUMBER;
-	ASSIGN(v0, &(triData[triBase]));
-	ASSIGN(v1, &(triData[triBase + COORDS]));
-	ASSIGN(v2, &(triData[triBase + 2*COORDS]));
-
-	VEC3(edge1); VEC3(edge2);
-	SUB(edge1, v1, v0);
-	SUB(edge2, v2, v0);
+	#pragma omp parallel for if(parallel)
+	for(int ray = 0; ray < numRays; ray++)
+	{
+		const Real* origin = &(rayData[ray*RAY_ATTR_NUMBER]);
+		const Real* direction = origin + COORDS;
+		int closestId = -1;
+		double closestInter = MAX_DISTANCE;
 
-	VEC3(h);
-	CROSS(h, direction, edge2);
-	double a = DOT(edge1, h);
+		for(int tri = 0; tri < numTriangles; tri++)
+		{
+			double t;
+			if(rayTriangleIntersect(t, origin, direction, &(triangleData[tri*TRIANGLE_ATTR_NUMBER])))
+			if(t < closestInter && t > EPSILON)
+			{
+				closestId = triangleIds[tri];
+				closestInter = t;
+			}
+		}
 
-	if(fabs(a) < EPSILON)
-	{
-		return false;
+		outIds[ray]   = closestId;
+		outInter[ray] = closestInter;
 	}
+}
 
-	double f = 1.0 / a;
-	VEC3(s);
-	SUB(s, origin, v0);
-	double u = f * DOT(s, h);
-
-	if(u < 0.0 || u > 1.0)
+template void intersectArrays<float>(
+	const float*, int, const int*, const float*, int, int*, float*, bool);
+template void intersectArrays<double>(
+	const double*, int, const int*, const double*, int, int*, double*, bool);
+
+template<typename Real>
+void occludedArrays(
+	const Real* rayData,
+	const Real* maxDistances,
+	int numRays,
+	const Real* triangleData,
+	int numTriangles,
+	uint8_t* outHit,
+	bool parallel
+) {
+	#pragma omp parallel for schedule(dynamic, 64) if(parallel)
+	for(int ray = 0; ray < numRays; ray++)
 	{
-		return false;
-	}
+		const Real* origin = &(rayData[ray*RAY_ATTR_NUMBER]);
+		const Real* direction = origin + COORDS;
+		double maxDistance = maxDistances[ray];
+		uint8_t hit = 0;
 
-	VEC3(q);
-	CROSS(q, s, edge1);
-	double v = f * DOT(direction, q);
+		for(int tri = 0; tri < numTriangles && !hit; tri++)
+		{
+			double t;
+			if(rayTriangleIntersect(t, origin, direction, &(triangleData[tri*TRIANGLE_ATTR_NUMBER])))
+			if(t > EPSILON && t < maxDistance)
+				hit = 1;
+		}
 
-	if(v < 0.0 || u + v > 1.0)
-	{
-		return false;
+		outHit[ray] = hit;
 	}
-	
-	t = f * DOT(edge2, q);
-	return true;
 }
 
+template void occludedArrays<float>(
+	const float*, const float*, int, const float*, int, uint8_t*, bool);
+template void occludedArrays<double>(
+	const double*, const double*, int, const double*, int, uint8_t*, bool);
+
 intersectResults computeIntersections(
 	std::vector<double> rayData,
 	std::vector<int> triangleIds,
@@ -102,22 +105,10 @@ intersectResults computeIntersections(
 	std::vector<int> outIds(numRays);
 	std::vector<double> outInter(numRays);
 
-	for(int ray = 0; ray < numRays; ray++)
-	{
-		outIds[ray]   = -1;
-		outInter[ray] = INFINITY; 
-
-		for(int tri = 0; tri < numTriangles; tri++)
-		{
-			double t;
-			if(rayIntersect(t, ray, rayData, tri, triangleData)) 
-			if(t < outInter[ray] && t > EPSILON)
-			{
-				outIds[ray] = triangleIds[tri];
-				outInter[ray] = t;
-			}
-		}
-	}
+	intersectArrays(
+		rayData.data(), numRays,
+		triangleIds.data(), triangleData.data(), numTriangles,
+		outIds.data(), outInter.data(), false);
 
 	return std::make_pair(outIds, outInter);
 }
@@ -134,25 +125,10 @@ intersectResults computeIntersectionsParallel(
 	std::vector<int> outIds(numRays);
 	std::vector<double> outInter(numRays);
 
-	#pragma omp parallel for
-	for(int ray = 0; ray < numRays; ray++)
-	{
-		outIds[ray]   = -1;
-		outInter[ray] = INFINITY; 
-
-		for(int tri = 0; tri < numTriangles; tri++)
-		{
-			double t;
-			if(rayIntersect(t, ray, rayData, tri, triangleData)) 
-			if(t < outInter[ray] && t > EPSILON)
-			{
-				outIds[ray] = triangleIds[tri];
-				outInter[ray] = t;
-			}
-		}
-	}
+	intersectArrays(
+		rayData.data(), numRays,
+		triangleIds.data(), triangleData.data(), numTriangles,
+		outIds.data(), outInter.data(), true);
 
 	return std::make_pair(outIds, outInter);
 }
-
-
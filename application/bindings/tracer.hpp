@@ -1,6 +1,10 @@
 #ifndef _TRACER_H_
 #define _TRACER_H_
 
+#include <cstdint>
+#include <utility>
+#include <vector>
+
 typedef std::pair<std::vector<int>, std::vector<double>> intersectResults;
 
 intersectResults computeIntersections(
@@ -14,4 +18,30 @@ intersectResults computeIntersectionsParallel(
 	std::vector<double> triangleData
 );
 
-#endif
\ No newline at end of file
+// Pointer based kernel used by the vector and NumPy entry points. Writes
+// the closest triangle id and distance of each ray to outIds/outInter.
+template<typename Real>
+void intersectArrays(
+	const Real* rayData,
+	int numRays,
+	const int* triangleIds,
+	const Real* triangleData,
+	int numTriangles,
+	int* outIds,
+	Real* outInter,
+	bool parallel);
+
+// Any-hit query for shadow rays: outHit[ray] is 1 when the ray hits a
+// triangle at a distance between EPSILON and maxDistances[ray], 0 otherwise.
+// The triangle loop of a ray stops at the first hit found.
+template<typename Real>
+void occludedArrays(
+	const Real* rayData,
+	const Real* maxDistances,
+	int numRays,
+	const Real* triangleData,
+	int numTriangles,
+	uint8_t* outHit,
+	bool parallel);
+
+#endif
@@ -0,0 +1,109 @@
+import threading
+import logging as log
+from collections import OrderedDict
+
+
+class CachedScene():
+    ''' Parsed triangle arrays of one geometry plus the structures
+        the tracers derive from them (BVH, FPGA buffers, ...), which
+        are kept in `derived` by the tracers' prepare methods
+    '''
+    def __init__(self, key, triangle_ids, triangles):
+        self.key = key
+        self.triangle_ids = triangle_ids
+        self.triangles = triangles
+        self.derived = {}
+        # requests currently using the scene, which can't be evicted
+        self.pins = 0
+
+    @property
+    def nbytes(self):
+        size = self.triangle_ids.nbytes + self.triangles.nbytes
+        for value in list(self.derived.values()):
+            size += getattr(value, 'nbytes', 0)
+        return size
+
+    def release(self):
+        ''' Free derived structures holding external memory '''
+        for value in self.derived.values():
+            release = getattr(value, 'release', None)
+            if release is not None:
+                release()
+        self.derived.clear()
+
+
+class SceneCache():
+    ''' LRU cache of scenes bounded by their memory footprint.
+        get and put pin the returned scene until unpin is called, and
+        pinned scenes are never evicted. Neither is the most recently
+        used scene, even if it is larger than the limit on its own
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @property
+    def nbytes(self):
+        # a copy, the metrics endpoint reads it from another thread
+        return sum(entry.nbytes for entry in list(self.entries.values()))
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            entry.pins += 1
+            return entry
+
+    def put(self, key, triangle_ids, triangles):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = CachedScene(key, triangle_ids, triangles)
+                self.entries[key] = entry
+            # else another request uploaded the same geometry meanwhile
+            self.entries.move_to_end(key)
+            entry.pins += 1
+        self.trim()
+        return entry
+
+    def unpin(self, entry):
+        with self._lock:
+            entry.pins -= 1
+        # scenes kept only because they were pinned can go now
+        self.trim()
+
+    def trim(self):
+        ''' Evict the least recently used scenes until the cache fits
+            its limit. Called again after derived structures grow
+        '''
+        with self._lock:
+            total = self.nbytes
+            for key in list(self.entries)[:-1]:
+                if total <= self.max_bytes:
+                    break
+                entry = self.entries[key]
+                if entry.pins > 0:
+                    continue
+                del self.entries[key]
+                total -= entry.nbytes
+                log.info(f'Evicting scene {key.hex()} from the cache')
+                entry.release()
+
+    def clear(self):
+        with self._lock:
+            for entry in self.entries.values():
+                entry.release()
+            self.entries.clear()
@@ -0,0 +1,127 @@
+''' Throughput model used to split the rays between the CPU and the
+    FPGA in heterogeneous mode. The time of each device is fitted as
+    overhead + cost * work, where work is the number of ray-triangle
+    tests, from the measurements of the previous requests. Older
+    measurements are decayed so the model follows scene changes
+'''
+import os
+import json
+import logging as log
+
+
+class LinearFit():
+    ''' Weighted least squares fit of seconds = overhead + cost * work '''
+    def __init__(self, decay=0.8, sums=None):
+        self.decay = decay
+        # weight, sum of work, of seconds, of work^2 and of work*seconds
+        self.sums = list(sums) if sums is not None else [0.0] * 5
+
+    @property
+    def weight(self):
+        return self.sums[0]
+
+    def add(self, work, seconds):
+        update = (1.0, work, seconds, work * work, work * seconds)
+        self.sums = [self.decay * old + new for old, new in zip(self.sums, update)]
+
+    def coefficients(self):
+        ''' Returns (overhead, cost). When all the measurements had
+            about the same work (the same scene over and over) the
+            overhead can't be told apart, and the fit goes through 0
+        '''
+        n, sx, sy, sxx, sxy = self.sums
+        if n == 0 or sx <= 0:
+            return None
+        variance = sxx / n - (sx / n) ** 2
+        if variance > 1e-3 * (sx / n) ** 2:
+            cost = (sxy - sx * sy / n) / (n * variance)
+            overhead = (sy - cost * sx) / n
+            if cost > 0 and overhead >= 0:
+                return (overhead, cost)
+        return (0.0, sy / sx)
+
+    def predict(self, work):
+        overhead, cost = self.coefficients()
+        return overhead + cost * work
+
+
+class ThroughputModel():
+    ''' CPU and FPGA fits stored in a JSON file under `key`, which
+        identifies the hardware configuration (bitstream and modes),
+        so a restarted server starts from the last known split
+    '''
+    DEVICES = ('cpu', 'fpga')
+    # both devices keep some work so both keep being measured
+    MIN_SHARE = 0.02
+    # samples recorded between two writes of the file
+    SAVE_EVERY = 32
+
+    def __init__(self, filename, key, decay=0.8):
+        self.filename = filename
+        self.key = key
+        self.fits = {device: LinearFit(decay) for device in self.DEVICES}
+        self.unsaved = 0
+        self.load()
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as file:
+                stored = json.load(file).get(self.key, {})
+        except (OSError, ValueError) as error:
+            log.warning(f'Ignoring calibration file {self.filename}: {error}')
+            return
+        for device, sums in stored.items():
+            if device in self.fits and len(sums) == 5:
+                self.fits[device].sums = list(sums)
+        log.info(f'Loaded calibration for {self.key}')
+
+    def save(self):
+        if not self.filename:
+            return
+        stored = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as file:
+                    stored = json.load(file)
+            except (OSError, ValueError):
+                stored = {}
+        stored[self.key] = {device: fit.sums for device, fit in self.fits.items()}
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(stored, file, indent=1)
+        os.replace(temporary, self.filename)
+        self.unsaved = 0
+
+    def record(self, device, num_rays, num_tris, seconds):
+        ''' Add a measurement. The file is written every SAVE_EVERY
+            measurements, call save() at shutdown for the others
+        '''
+        # without any work there is nothing to fit
+        if num_rays * num_tris == 0:
+            return
+        self.fits[device].add(num_rays * num_tris, seconds)
+        self.unsaved += 1
+        if self.unsaved >= self.SAVE_EVERY:
+            self.save()
+
+    def is_calibrated(self):
+        return all(fit.weight > 0 for fit in self.fits.values())
+
+    def fpga_fraction(self, num_rays, num_tris, default):
+        ''' Fraction of the rays to give the FPGA so both devices are
+            predicted to finish at the same time
+        '''
+        if not self.is_calibrated() or num_rays == 0:
+            return default
+        work = num_rays * num_tris
+        cpu, fpga = self.fits['cpu'].coefficients(), self.fits['fpga'].coefficients()
+        if cpu is None or fpga is None:
+            return default
+        cpu_overhead, cpu_cost = cpu
+        fpga_overhead, fpga_cost = fpga
+        # cpu_overhead + cpu_cost*(1-f)*work == fpga_overhead + fpga_cost*f*work
+        fraction = (cpu_overhead - fpga_overhead + cpu_cost * work) \
+            / ((cpu_cost + fpga_cost) * work)
+        return min(max(fraction, self.MIN_SHARE), 1.0 - self.MIN_SHARE)
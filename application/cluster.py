@@ -0,0 +1,269 @@
+''' Client side fan-out of one frame over several edge nodes.
+
+    The rays of a frame are cut into shards, most of them handed to
+    each node in proportion to the throughput it had in the previous
+    frames. Every shard is one binary request using the scene cache,
+    so a node receives the geometry with its first shard only. Nodes
+    that run out of shards take the pending shards of the others and,
+    at the end of the frame, run again the shards that are taking
+    much longer than expected on a slow node; the first result wins.
+    A node that fails is retried `max-failures` times before it is
+    left out, and its shard goes back to the pending ones
+'''
+import socket
+import threading
+import numpy as np
+import logging as log
+from time import time
+import application.protocol as protocol
+
+
+class Node():
+    ''' Edge server of the cluster and what is known about its speed '''
+    def __init__(self, ip, port, weight=1.0, max_failures=3):
+        self.ip = ip
+        self.port = port
+        self.max_failures = max_failures
+        # rays per second, the initial weight only sets the first split
+        self.throughput = None
+        self.weight = weight
+        self.failures = 0
+        self.pending = []
+
+    @property
+    def name(self):
+        return f'{self.ip}:{self.port}'
+
+    @property
+    def available(self):
+        return self.failures < self.max_failures
+
+    def share(self):
+        return self.throughput if self.throughput is not None else self.weight
+
+    def record(self, num_rays, seconds, decay=0.5):
+        rate = num_rays / max(seconds, 1e-6)
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput = decay * self.throughput + (1.0 - decay) * rate
+
+
+class Shard():
+    ''' Range of rays [first, last) of the frame '''
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.done = False
+        # (node, start time) of every request running it
+        self.runs = []
+
+    def __len__(self):
+        return self.last - self.first
+
+
+class Cluster():
+    ''' Several edge nodes computing the rays of one frame. Has the
+        same compute_scene interface as RendererClient
+    '''
+    def __init__(self, config):
+        cluster = config['cluster']
+        # consecutive failed requests before a node is left out
+        max_failures = cluster.get('max-failures', 3)
+        self.nodes = [
+            Node(node['ip'], node['port'], node.get('weight', 1.0), max_failures)
+            for node in cluster['nodes']]
+        if not self.nodes:
+            raise ValueError('The cluster has no edge nodes')
+        # shards per node in proportion to its share, for balancing
+        self.shards_per_node = cluster.get('shards-per-node', 4)
+        self.min_shard = cluster.get('min-shard-rays', 1024)
+        # a shard running this many times longer than expected is
+        # run again by an idle node
+        self.straggler_factor = cluster.get('straggler-factor', 3.0)
+        self.timeout = cluster.get('timeout', 60.0)
+        # encoding asked for the results of every shard
+        self.encoding = protocol.Encoding.from_config(config.get('edge', {}).get('result-encoding'))
+        self._condition = threading.Condition()
+        # results are handed to on_chunk one shard at a time
+        self._chunk_lock = threading.Lock()
+
+    def compute_scene(self, scene, on_chunk=None):
+        ''' Request the closest hits of the scene camera rays from
+            all the nodes. Returns a dict with the 'triangles_hit'
+            and 'intersections' of each pixel. `on_chunk(first, ids,
+            intersects)` is called with every shard as it arrives
+        '''
+        tri_ids, tris = scene.get_triangles_array()
+        rays = scene.camera.get_rays_array()
+        return self.compute(tri_ids, tris, rays, on_chunk)
+
+    def compute(self, tri_ids, tris, rays, on_chunk=None):
+        num_rays = np.size(rays) // protocol.NUM_RAY_ATTRS
+        frame = {
+            'tri_ids'   : tri_ids,
+            'tris'      : tris,
+            'rays'      : np.ascontiguousarray(rays, dtype=protocol.FLOAT_TYPE),
+            'key'       : protocol.geometry_hash(tri_ids, tris),
+            'ids'       : np.full(num_rays, -1, dtype=protocol.ID_TYPE),
+            'intersects': np.empty(num_rays, dtype=protocol.FLOAT_TYPE),
+            'on_chunk'  : on_chunk}
+        nodes = [node for node in self.nodes if node.available]
+        if not nodes:
+            raise RuntimeError('All the edge nodes failed')
+        shards = self._partition(num_rays, nodes)
+
+        ti = time()
+        workers = [
+            threading.Thread(target=self._work, args=(node, nodes, shards, frame))
+            for node in nodes]
+        for worker in workers:
+            # a straggling request is abandoned when its shard is
+            # finished by another node, the thread ends on its own
+            worker.daemon = True
+            worker.start()
+        with self._condition:
+            while not all(shard.done for shard in shards):
+                if not any(node.available for node in nodes):
+                    raise RuntimeError('All the edge nodes failed')
+                self._condition.wait(0.1)
+        log.info(f'Cluster computed {num_rays} rays in {time() - ti} seconds')
+
+        return {
+            'intersections' : frame['intersects'],
+            'triangles_hit' : frame['ids']
+        }
+
+    def compute_occlusion(self, tri_ids, tris, rays, max_distances):
+        ''' Any-hit query for shadow rays, sent whole to the fastest
+            node and to the next ones if it fails. Returns a boolean
+            array, see RendererClient.compute_occlusion
+        '''
+        nodes = sorted(
+            (node for node in self.nodes if node.available),
+            key=lambda node: node.share(), reverse=True)
+        for node in nodes:
+            try:
+                with socket.create_connection((node.ip, node.port), self.timeout) as sock:
+                    protocol.send_cached_scene(sock, tri_ids, tris, rays,
+                        flags=protocol.FLAG_OCCLUSION)
+                    protocol.send_max_distances(sock, max_distances)
+                    occluded, _ = protocol.recv_occlusion(sock)
+                node.failures = 0
+                return occluded
+            except (OSError, protocol.ProtocolError) as error:
+                with self._condition:
+                    node.failures += 1
+                log.warning(f'{node.name} failed the occlusion query '
+                            f'({node.failures} failures): {error}')
+        raise RuntimeError('All the edge nodes failed')
+
+    def _partition(self, num_rays, nodes):
+        ''' Cut the rays into shards, giving each node a number of
+            consecutive ones proportional to its share
+        '''
+        for node in self.nodes:
+            node.pending = []
+        total = sum(node.share() for node in nodes)
+        shards, first = [], 0
+        for i, node in enumerate(nodes):
+            if i == len(nodes) - 1:
+                last = num_rays
+            else:
+                last = min(num_rays, first + int(round(num_rays * node.share() / total)))
+            size = max(self.min_shard, -(-(last - first) // self.shards_per_node))
+            node.pending = [
+                Shard(start, min(start + size, last))
+                for start in range(first, last, size)]
+            shards += node.pending
+            log.info(f'{node.name} gets rays {first} to {last}')
+            first = last
+        return shards
+
+    def _next_shard(self, node, nodes, shards):
+        ''' Next shard for `node`: its own, the last pending one of
+            the busiest node or a straggling one. Blocks while there
+            is nothing to take but shards are still running. Returns
+            None when the frame is finished
+        '''
+        with self._condition:
+            while True:
+                if all(shard.done for shard in shards) or not node.available:
+                    return None
+                busiest = max(nodes, key=lambda other: len(other.pending))
+                if node.pending:
+                    shard = node.pending.pop(0)
+                elif busiest.pending:
+                    shard = busiest.pending.pop()
+                else:
+                    shard = self._straggler(node, shards)
+                if shard is not None:
+                    shard.runs.append((node, time()))
+                    return shard
+                self._condition.wait(0.05)
+
+    def _straggler(self, node, shards):
+        now = time()
+        for shard in shards:
+            if shard.done or len(shard.runs) != 1:
+                continue
+            owner, start = shard.runs[0]
+            if owner is node or owner.throughput is None:
+                continue
+            expected = len(shard) / owner.throughput
+            if now - start > self.straggler_factor * expected:
+                log.warning(f'{owner.name} is slow, {node.name} also runs '
+                            f'rays {shard.first} to {shard.last}')
+                # the next frames give it less until it answers again
+                owner.throughput /= 2
+                return shard
+        return None
+
+    def _work(self, node, nodes, shards, frame):
+        while True:
+            shard = self._next_shard(node, nodes, shards)
+            if shard is None:
+                return
+            ti = time()
+            try:
+                ids, intersects = self._request(node, shard, frame)
+            except (OSError, protocol.ProtocolError) as error:
+                with self._condition:
+                    node.failures += 1
+                    shard.runs = [run for run in shard.runs if run[0] is not node]
+                    if not shard.done and not shard.runs:
+                        # back to the front of the queue of a working node
+                        owner = next((other for other in nodes if other.available), node)
+                        owner.pending.insert(0, shard)
+                    log.warning(f'{node.name} failed rays {shard.first} to '
+                                f'{shard.last} ({node.failures} failures): {error}')
+                    self._condition.notify_all()
+                continue
+
+            with self._condition:
+                node.record(len(shard), time() - ti)
+                node.failures = 0
+                if shard.done:
+                    continue
+                frame['ids'][shard.first:shard.last] = ids
+                frame['intersects'][shard.first:shard.last] = intersects
+                shard.done = True
+                self._condition.notify_all()
+            if frame['on_chunk'] is not None:
+                with self._chunk_lock:
+                    frame['on_chunk'](
+                        shard.first,
+                        frame['ids'][shard.first:shard.last],
+                        frame['intersects'][shard.first:shard.last])
+
+    def _request(self, node, shard, frame):
+        rays = frame['rays'][shard.first*protocol.NUM_RAY_ATTRS : shard.last*protocol.NUM_RAY_ATTRS]
+        with socket.create_connection((node.ip, node.port), self.timeout) as sock:
+            # the geometry is uploaded only if the node does not have it
+            protocol.send_cached_scene(sock, frame['tri_ids'], frame['tris'], rays, frame['key'],
+                self.encoding.flags)
+            ids, intersects, _ = protocol.recv_results(sock)
+        if len(ids) != len(shard):
+            raise protocol.ProtocolError(
+                f'{len(ids)} results for {len(shard)} rays')
+        return ids, intersects
@@ -0,0 +1,114 @@
+''' Ray reordering for coherent tracing.
+
+    Rays are sorted by the octant of their direction, then by the
+    Morton code of their origin and of their direction, so rays next
+    to each other in a task start close and point the same way: BVH
+    traversals share nodes and the triangles they touch stay in cache.
+    Sorting is done inside blocks of consecutive rays (tiles of the
+    scanline order), which keeps the results of a block together when
+    they are streamed back. The permutation is kept to put the
+    results back in the original order
+'''
+import numpy as np
+
+# bits per axis of the Morton codes: 3 + 2*24 bits for a key, the
+# block index of the ray goes in the remaining 13 bits
+MORTON_BITS = 8
+KEY_BITS = 3 + 6*MORTON_BITS
+
+
+def _spread_bits(values):
+    ''' Insert two zero bits after each of the 8 low bits '''
+    values = values.astype(np.uint32)
+    for shift, mask in ((8, 0x0300f00f), (4, 0x030c30c3), (2, 0x09249249)):
+        values = (values | (values << np.uint32(shift))) & np.uint32(mask)
+    return values
+
+
+# spread bits of every cell coordinate, looked up instead of computed
+SPREAD_TABLE = _spread_bits(np.arange(2**MORTON_BITS))
+
+
+def morton_codes(points, lower, upper):
+    ''' 24-bit Morton codes of (N, 3) points quantized in the box
+        [lower, upper]
+    '''
+    scale = (2**MORTON_BITS - 1) / np.maximum(upper - lower, 1e-12)
+    cells = np.clip((points - lower) * scale, 0, 2**MORTON_BITS - 1).astype(np.uint8)
+    return (SPREAD_TABLE[cells[:, 0]] << np.uint32(2)) \
+        | (SPREAD_TABLE[cells[:, 1]] << np.uint32(1)) \
+        | SPREAD_TABLE[cells[:, 2]]
+
+
+def coherence_keys(rays):
+    ''' Sort key of every ray of an (N, 6) array: direction octant,
+        then origin Morton code, then direction Morton code
+    '''
+    origins = rays[:, :3]
+    directions = rays[:, 3:]
+    octants = (directions[:, 0] < 0)*4 + (directions[:, 1] < 0)*2 + (directions[:, 2] < 0)
+    origin_codes = morton_codes(origins, origins.min(axis=0), origins.max(axis=0))
+    direction_codes = morton_codes(directions, -1.0, 1.0)
+    return (octants.astype(np.uint64) << np.uint64(6*MORTON_BITS)) \
+        | (origin_codes.astype(np.uint64) << np.uint64(3*MORTON_BITS)) \
+        | direction_codes
+
+
+class RayOrder():
+    ''' Coherent order of a set of rays (flat, 6 values per ray),
+        sorted inside blocks of `block_size` consecutive rays, all
+        the rays at once when None
+    '''
+    def __init__(self, rays, block_size=None):
+        rays = np.asarray(rays).reshape(-1, 6)
+        self.num_rays = len(rays)
+        self.block_size = block_size or max(self.num_rays, 1)
+        keys = coherence_keys(rays)
+        blocks = np.arange(self.num_rays, dtype=np.uint64) // np.uint64(self.block_size)
+        # sorted position -> original position
+        if self.num_rays == 0 or blocks[-1] < 2**(64 - KEY_BITS):
+            self.order = np.argsort(keys | (blocks << np.uint64(KEY_BITS)))
+        else:
+            self.order = np.lexsort((keys, blocks))
+
+    def apply(self, rays):
+        ''' The rays in coherent order, as a flat array '''
+        return np.asarray(rays).reshape(-1, 6)[self.order].reshape(-1)
+
+    def restore(self, ids, intersects):
+        ''' Results of the sorted rays back in the original order '''
+        original_ids = np.empty_like(ids)
+        original_intersects = np.empty_like(intersects)
+        original_ids[self.order] = ids
+        original_intersects[self.order] = intersects
+        return (original_ids, original_intersects)
+
+    def restoring(self, on_result):
+        ''' Wrap a streaming callback `on_result(first, ids,
+            intersects)` receiving ranges of sorted rays, so that it
+            is called with ranges of the original order instead: each
+            block once all of its rays are computed. Safe to call
+            from several threads
+        '''
+        import threading
+        lock = threading.Lock()
+        ids = np.empty(self.num_rays, dtype=np.int32)
+        intersects = np.empty(self.num_rays, dtype=np.float32)
+        num_blocks = -(-self.num_rays // self.block_size)
+        missing = np.bincount(
+            np.arange(self.num_rays) // self.block_size,
+            minlength=num_blocks)
+
+        def on_sorted_result(first, chunk_ids, chunk_intersects):
+            positions = self.order[first : first + len(chunk_ids)]
+            with lock:
+                ids[positions] = chunk_ids
+                intersects[positions] = chunk_intersects
+                blocks, counts = np.unique(positions // self.block_size, return_counts=True)
+                missing[blocks] -= counts
+                finished = blocks[missing[blocks] == 0]
+                for block in finished:
+                    start = block * self.block_size
+                    end = min(start + self.block_size, self.num_rays)
+                    on_result(start, ids[start:end], intersects[start:end])
+        return on_sorted_result
@@ -0,0 +1,208 @@
+''' Compact encodings of the closest hit results.
+
+    The raw binary results are an int32 triangle id and a float32
+    distance per ray. They can be made smaller three ways, chosen by
+    the client per request and combined freely:
+
+        ids         : raw, rle (runs of equal ids, the -1 of the
+                      background pixels and the neighbouring pixels
+                      hitting the same triangle) or delta (difference
+                      with the previous id, small numbers that
+                      compress well)
+        distances   : float32, float16 (about 3 significant digits,
+                      saturating at 65504) or quantized (16-bit steps
+                      between the closest and the farthest hit)
+        compression : none, zlib or lz4 (when the lz4 package is
+                      installed), applied to each block
+
+    Misses keep their distance of 1e9 through the lossy encodings.
+    The encoding is negotiated through the frame flags: the client
+    sets the one it wants on its request, the server replies with the
+    one it used, which differs when it lacks the compression library
+'''
+import zlib
+import struct
+import numpy as np
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+IDS = ('raw', 'rle', 'delta')
+DISTANCES = ('float32', 'float16', 'quantized')
+COMPRESSIONS = ('none', 'zlib', 'lz4')
+
+# frame flag bits holding the encoding, 2 bits per field
+FLAGS_SHIFT = 8
+FLAGS_MASK = 0x3f << FLAGS_SHIFT
+
+# distance of the rays that hit nothing
+MISS_DISTANCE = 1e9
+# quantized code of the misses
+QUANTIZED_MISS = 0xffff
+# zlib level, speed matters more than size on the board
+ZLIB_LEVEL = 1
+
+# size of the ids block, size of the distances block, range of the
+# quantized distances
+BLOCKS = struct.Struct('<IIdd')
+
+
+class Encoding():
+    ''' One choice of ids, distances and compression (names above) '''
+    def __init__(self, ids='raw', distances='float32', compression='none'):
+        for name, choices in ((ids, IDS), (distances, DISTANCES), (compression, COMPRESSIONS)):
+            if name not in choices:
+                raise ValueError(f'Unknown result encoding {name}, expected one of {choices}')
+        self.ids = ids
+        self.distances = distances
+        self.compression = compression
+
+    @classmethod
+    def from_config(cls, config):
+        ''' Encoding of a "result-encoding" config section, raw when None '''
+        config = config or {}
+        return cls(
+            config.get('ids', 'raw'),
+            config.get('distances', 'float32'),
+            config.get('compression', 'none'))
+
+    @classmethod
+    def from_flags(cls, flags):
+        value = (flags & FLAGS_MASK) >> FLAGS_SHIFT
+        try:
+            return cls(IDS[value & 3], DISTANCES[(value >> 2) & 3], COMPRESSIONS[value >> 4])
+        except IndexError:
+            raise ValueError(f'Invalid result encoding flags {flags:#x}')
+
+    @property
+    def flags(self):
+        return (IDS.index(self.ids)
+            | DISTANCES.index(self.distances) << 2
+            | COMPRESSIONS.index(self.compression) << 4) << FLAGS_SHIFT
+
+    @property
+    def is_raw(self):
+        return self.flags == 0
+
+    def supported(self):
+        ''' This encoding, with zlib instead of lz4 when the lz4
+            package is missing
+        '''
+        if self.compression == 'lz4' and lz4 is None:
+            return Encoding(self.ids, self.distances, 'zlib')
+        return self
+
+    def encode(self, ids, distances):
+        ''' Encoded bytes of the results of a range of rays '''
+        ids_block = self._compress(encode_ids(ids, self.ids))
+        distances_block, near, far = encode_distances(distances, self.distances)
+        distances_block = self._compress(distances_block)
+        return BLOCKS.pack(len(ids_block), len(distances_block), near, far) \
+            + ids_block + distances_block
+
+    def decode(self, read, num_rays):
+        ''' (ids, distances) of `num_rays` rays whose encoded bytes
+            are returned by `read(size)`
+        '''
+        ids_size, distances_size, near, far = BLOCKS.unpack(read(BLOCKS.size))
+        ids = decode_ids(self._decompress(read(ids_size)), self.ids, num_rays)
+        distances = decode_distances(
+            self._decompress(read(distances_size)), self.distances, num_rays, near, far)
+        return ids, distances
+
+    def _compress(self, data):
+        if self.compression == 'zlib':
+            return zlib.compress(data, ZLIB_LEVEL)
+        if self.compression == 'lz4':
+            return lz4.compress(data)
+        return data
+
+    def _decompress(self, data):
+        if self.compression == 'zlib':
+            return zlib.decompress(data)
+        if self.compression == 'lz4':
+            if lz4 is None:
+                raise ValueError('lz4 compressed results need the lz4 package')
+            try:
+                return lz4.decompress(data)
+            except RuntimeError as error:
+                raise ValueError(f'Invalid lz4 block: {error}')
+        return bytes(data)
+
+    def __repr__(self):
+        return f'Encoding({self.ids}, {self.distances}, {self.compression})'
+
+
+RAW = Encoding()
+
+
+def encode_ids(ids, method):
+    ids = np.ascontiguousarray(ids, dtype='<i4')
+    if method == 'rle':
+        if len(ids) == 0:
+            return b''
+        # value and length of every run of equal ids
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        lengths = np.diff(np.append(starts, len(ids))).astype('<u4')
+        return ids[starts].tobytes() + lengths.tobytes()
+    if method == 'delta':
+        # int32 differences wrap around like the cumulative sum
+        return np.diff(ids, prepend=np.int32(0)).astype('<i4').tobytes()
+    return ids.tobytes()
+
+
+def decode_ids(data, method, num_rays):
+    if method == 'rle':
+        runs = np.frombuffer(data, dtype='<i4')
+        values, lengths = runs[:len(runs) // 2], runs[len(runs) // 2:].view('<u4')
+        # checked before expanding them, the lengths come from the peer
+        total = int(lengths.sum(dtype=np.uint64))
+        if len(runs) % 2 or total != num_rays:
+            raise ValueError(f'Runs of {total} ids for {num_rays} rays')
+        ids = np.repeat(values, lengths).astype(np.int32)
+    elif method == 'delta':
+        ids = np.cumsum(np.frombuffer(data, dtype='<i4'), dtype=np.int32)
+    else:
+        ids = np.frombuffer(data, dtype='<i4').astype(np.int32)
+    if len(ids) != num_rays:
+        raise ValueError(f'Decoded {len(ids)} ids for {num_rays} rays')
+    return ids
+
+
+def encode_distances(distances, method):
+    ''' Returns (bytes, near, far), the range of the quantized hits '''
+    distances = np.asarray(distances, dtype=np.float32)
+    miss = distances >= MISS_DISTANCE
+    if method == 'float16':
+        # misses become infinite, the hits are kept finite
+        values = np.minimum(distances, np.finfo(np.float16).max).astype('<f2')
+        values[miss] = np.inf
+        return values.tobytes(), 0.0, 0.0
+    if method == 'quantized':
+        hits = distances[~miss]
+        near, far = (float(hits.min()), float(hits.max())) if len(hits) else (0.0, 0.0)
+        scale = (QUANTIZED_MISS - 1) / (far - near) if far > near else 0.0
+        codes = np.rint((distances.astype(np.float64) - near) * scale)
+        codes = np.clip(codes, 0, QUANTIZED_MISS - 1).astype('<u2')
+        codes[miss] = QUANTIZED_MISS
+        return codes.tobytes(), near, far
+    return np.ascontiguousarray(distances, dtype='<f4').tobytes(), 0.0, 0.0
+
+
+def decode_distances(data, method, num_rays, near=0.0, far=0.0):
+    if method == 'float16':
+        values = np.frombuffer(data, dtype='<f2')
+        distances = values.astype(np.float32)
+        distances[np.isinf(values)] = MISS_DISTANCE
+    elif method == 'quantized':
+        codes = np.frombuffer(data, dtype='<u2')
+        step = (far - near) / (QUANTIZED_MISS - 1)
+        distances = (near + codes * step).astype(np.float32)
+        distances[codes == QUANTIZED_MISS] = MISS_DISTANCE
+    else:
+        distances = np.frombuffer(data, dtype='<f4').astype(np.float32)
+    if len(distances) != num_rays:
+        raise ValueError(f'Decoded {len(distances)} distances for {num_rays} rays')
+    return distances
@@ -0,0 +1,138 @@
+''' Compiled cache of the arrays parsed from mesh and scene files.
+
+    The arrays built from a source file (OBJ mesh, .drk scene) are
+    saved next to it as `<source>.cache`: a small JSON header
+    followed by the raw arrays, each aligned to 64 bytes.
+
+        magic 'DRKC' | uint32 version | uint64 header size | header
+        | padding | array data ...
+
+    The header records the size, mtime and sha1 of the source. A
+    cache is used as it is when size and mtime match; when only the
+    mtime changed (a copy, a checkout) the source is hashed and the
+    cache is kept if the content is the same. Arrays are opened with
+    np.memmap, so loading costs about the same for any mesh size
+'''
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+import logging as log
+
+MAGIC = b'DRKC'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sIQ')
+ALIGNMENT = 64
+
+
+def cache_path(source):
+    return source + '.cache'
+
+
+def file_hash(filename, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_cache(filename, arrays, source_info):
+    ''' Save a dict of arrays with the source description. Written
+        to a temporary file first, so readers never see a partial one
+    '''
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = {
+            'dtype' : array.dtype.str,
+            'shape' : list(array.shape),
+            'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'source': source_info, 'arrays': layout}).encode()
+    data_start = _aligned(PREAMBLE.size + len(header))
+
+    temporary = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(PREAMBLE.pack(MAGIC, VERSION, len(header)) + header)
+        for name, array in arrays.items():
+            file.seek(data_start + layout[name]['offset'])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + offset)
+    os.replace(temporary, filename)
+
+
+def read_header(filename):
+    with open(filename, 'rb') as file:
+        magic, version, size = PREAMBLE.unpack(file.read(PREAMBLE.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{filename} is not a version {VERSION} cache')
+        header = json.loads(file.read(size).decode())
+    header['data_start'] = _aligned(PREAMBLE.size + size)
+    return header
+
+
+def read_cache(filename, header=None):
+    ''' Map the arrays of a cache file (read-only) '''
+    header = header or read_header(filename)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=info['dtype'])
+            continue
+        arrays[name] = np.memmap(
+            filename, dtype=info['dtype'], mode='r', shape=shape,
+            offset=header['data_start'] + info['offset'])
+    return arrays
+
+
+def _source_info(source, digest=None):
+    stat = os.stat(source)
+    return {
+        'path' : os.path.abspath(source),
+        'size' : stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha1' : digest or file_hash(source)}
+
+
+def load(source, build, required=()):
+    ''' Arrays compiled from `source`. `build(source)` parses the
+        source into a dict of arrays and is only called when the
+        cache is missing, stale or lacks one of the `required`
+        arrays. Failing to write the cache (read-only directory)
+        only costs the parse next time
+    '''
+    filename = cache_path(source)
+    stat = os.stat(source)
+    try:
+        header = read_header(filename)
+        info = header['source']
+        digest = info['sha1']
+        fresh = info['size'] == stat.st_size and info['mtime'] == stat.st_mtime_ns
+        if not fresh and info['size'] == stat.st_size:
+            fresh = file_hash(source) == digest
+            if fresh:
+                # same content, remember the new mtime
+                arrays = read_cache(filename, header)
+                write_cache(filename, {k: np.array(v) for k, v in arrays.items()},
+                    _source_info(source, digest))
+        if fresh and all(name in header['arrays'] for name in required):
+            log.info(f'Loading {source} from {filename}')
+            return read_cache(filename)
+    except (OSError, ValueError, KeyError) as error:
+        if not isinstance(error, FileNotFoundError):
+            log.warning(f'Ignoring cache {filename}: {error}')
+
+    log.info(f'Compiling {source}')
+    arrays = build(source)
+    try:
+        write_cache(filename, arrays, _source_info(source))
+    except OSError as error:
+        log.warning(f'Could not write cache {filename}: {error}')
+    return arrays
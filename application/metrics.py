@@ -0,0 +1,305 @@
+''' Per-request instrumentation of the edge server.
+
+    Every request gets a Trace, a list of timed spans (receive, parse,
+    prepare, compute, each device, serialize, send) carrying counters
+    such as rays, triangles, bytes and cache hits. Finished traces are
+    aggregated by Metrics into histograms of the span durations and
+    totals of their counters, exposed as text (Prometheus format) and
+    JSON on a local HTTP endpoint, and optionally appended to a JSONL
+    trace file, one line per request. Recording a span costs two clock
+    reads and a list append; aggregation happens once per request,
+    after the results are sent, so it can stay on in production
+'''
+import json
+import bisect
+import threading
+import logging as log
+from time import time, perf_counter
+from collections import OrderedDict
+
+# upper bounds in seconds of the duration histograms, 100 us to 100 s
+DURATION_BOUNDS = tuple(
+    round(base * 10.0**exponent, 6)
+    for exponent in range(-4, 2) for base in (1.0, 2.5, 5.0)) + (100.0,)
+# upper bounds of the ratio histograms (device utilization)
+RATIO_BOUNDS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)
+# span counters that are ratios, histogrammed instead of summed
+RATIOS = ('utilization',)
+
+
+class Histogram():
+    ''' Number of observations under each of the `bounds`, plus
+        their count, sum, minimum and maximum
+    '''
+    def __init__(self, bounds=DURATION_BOUNDS):
+        self.bounds = bounds
+        # the last bucket holds values above the largest bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q-quantile, the
+            maximum for the overflow bucket
+        '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count' : self.count,
+            'sum'   : self.sum,
+            'min'   : self.min,
+            'max'   : self.max,
+            'p50'   : self.quantile(0.5),
+            'p90'   : self.quantile(0.9),
+            'p99'   : self.quantile(0.99),
+            'bounds': list(self.bounds),
+            'buckets': list(self.buckets)}
+
+
+class Span():
+    ''' Timed stage of a request '''
+    def __init__(self, name, seconds=None, counters=None):
+        self.name = name
+        self.start = perf_counter()
+        self.seconds = seconds
+        self.counters = counters or {}
+
+    def count(self, **counters):
+        ''' Add to the counters of the span '''
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = perf_counter() - self.start
+        return False
+
+    def to_dict(self):
+        return dict(name=self.name, seconds=self.seconds, **self.counters)
+
+
+class Trace():
+    ''' Spans of one request, in the order they were started. Spans
+        of one request are only opened from one thread at a time
+    '''
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.timestamp = time()
+        self.spans = []
+        self.finished = False
+
+    def span(self, name, **counters):
+        ''' Context manager timing a stage:
+
+                with trace.span('parse', bytes=size) as span:
+                    ...
+                    span.count(rays=num_rays)
+        '''
+        span = Span(name, counters=counters)
+        self.spans.append(span)
+        return span
+
+    def add(self, name, seconds, **counters):
+        ''' Record a stage timed elsewhere (a device of the scheduler,
+            an accelerator)
+        '''
+        span = Span(name, seconds, counters)
+        self.spans.append(span)
+        return span
+
+    def get(self, name):
+        return next((span for span in self.spans if span.name == name), None)
+
+    def finish(self, error=None):
+        ''' Hand the trace to the aggregation, once '''
+        if self.finished:
+            return
+        self.finished = True
+        self.metrics.record(self, error)
+
+    def to_dict(self, error=None):
+        record = {
+            'request'  : self.name,
+            'timestamp': self.timestamp,
+            'spans'    : [span.to_dict() for span in self.spans if span.seconds is not None]}
+        if error is not None:
+            record['error'] = str(error)
+        return record
+
+
+class Metrics():
+    ''' Aggregates the traces of the requests: a duration histogram
+        and counter totals per span name, ratio histograms per span
+        and counter, and gauges read when the metrics are exported.
+        `trace_file` receives every trace as a JSON line
+    '''
+    def __init__(self, trace_file=None, enabled=True):
+        self.enabled = enabled
+        self.durations = OrderedDict()
+        self.ratios = OrderedDict()
+        self.totals = OrderedDict()
+        self.requests = 0
+        self.errors = 0
+        self.gauges = OrderedDict()
+        self.counters = OrderedDict()
+        self._lock = threading.Lock()
+        self._trace_file = open(trace_file, 'a') if trace_file and enabled else None
+        self._http = None
+
+    def trace(self, name):
+        return Trace(self, name)
+
+    def gauge(self, name, read):
+        ''' Export the value returned by `read()` as `name` '''
+        self.gauges[name] = read
+
+    def counter(self, name, read):
+        ''' Export the value returned by `read()`, which only grows,
+            as the counter `name`
+        '''
+        self.counters[name] = read
+
+    def record(self, trace, error=None):
+        if not self.enabled:
+            return
+        line = json.dumps(trace.to_dict(error)) if self._trace_file is not None else None
+        with self._lock:
+            self.requests += 1
+            self.errors += error is not None
+            for span in trace.spans:
+                if span.seconds is None:
+                    continue
+                histogram = self.durations.get(span.name)
+                if histogram is None:
+                    histogram = self.durations[span.name] = Histogram(DURATION_BOUNDS)
+                histogram.observe(span.seconds)
+                for key, value in span.counters.items():
+                    name = f'{span.name}.{key}'
+                    if key in RATIOS:
+                        ratio = self.ratios.get(name)
+                        if ratio is None:
+                            ratio = self.ratios[name] = Histogram(RATIO_BOUNDS)
+                        ratio.observe(value)
+                    else:
+                        self.totals[name] = self.totals.get(name, 0) + value
+            if line is not None:
+                self._trace_file.write(line + '\n')
+                self._trace_file.flush()
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'requests' : self.requests,
+                'errors'   : self.errors,
+                'durations': {name: h.snapshot() for name, h in self.durations.items()},
+                'ratios'   : {name: h.snapshot() for name, h in self.ratios.items()},
+                'totals'   : dict(self.totals)}
+        snapshot['gauges'] = {name: read() for name, read in self.gauges.items()}
+        snapshot['counters'] = {name: read() for name, read in self.counters.items()}
+        return snapshot
+
+    def render_text(self):
+        ''' Metrics in the Prometheus text exposition format '''
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE raytracer_requests_total counter',
+            f'raytracer_requests_total {snapshot["requests"]}',
+            '# TYPE raytracer_errors_total counter',
+            f'raytracer_errors_total {snapshot["errors"]}']
+        lines.append('# TYPE raytracer_span_seconds histogram')
+        for name, histogram in snapshot['durations'].items():
+            lines += _histogram_lines('raytracer_span_seconds', name, histogram)
+        lines.append('# TYPE raytracer_span_ratio histogram')
+        for name, histogram in snapshot['ratios'].items():
+            lines += _histogram_lines('raytracer_span_ratio', name, histogram)
+        lines.append('# TYPE raytracer_span_total counter')
+        for name, value in snapshot['totals'].items():
+            lines.append(f'raytracer_span_total{{name="{name}"}} {value}')
+        lines.append('# TYPE raytracer_counter_total counter')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'raytracer_counter_total{{name="{name}"}} {value}')
+        lines.append('# TYPE raytracer_gauge gauge')
+        for name, value in snapshot['gauges'].items():
+            lines.append(f'raytracer_gauge{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, ip='127.0.0.1', port=9100):
+        ''' Answer GET /metrics (text) and /metrics.json from a daemon
+            thread. Returns the bound (ip, port)
+        '''
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in ('/', '/metrics'):
+                    body, content = metrics.render_text(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content = json.dumps(metrics.snapshot()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._http = Server((ip, port), Handler)
+        thread = threading.Thread(target=self._http.serve_forever)
+        thread.daemon = True
+        thread.start()
+        address = self._http.server_address
+        log.info(f'Metrics served on http://{address[0]}:{address[1]}/metrics')
+        return address
+
+    def close(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+
+def _histogram_lines(metric, name, histogram):
+    lines, seen = [], 0
+    for bound, count in zip(histogram['bounds'], histogram['buckets']):
+        seen += count
+        lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {seen}')
+    lines.append(f'{metric}_bucket{{name="{name}",le="+Inf"}} {histogram["count"]}')
+    lines.append(f'{metric}_sum{{name="{name}"}} {histogram["sum"]}')
+    lines.append(f'{metric}_count{{name="{name}"}} {histogram["count"]}')
+    return lines
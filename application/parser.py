@@ -23,4 +23,9 @@ class Parser:
             type=float,
             help='Pixel size of the image')
 
+        self.parser.add_argument(
+            '--port',
+            type=int,
+            help='Port the server listens on, replacing the one in the settings')
+
         self.args = self.parser.parse_args()
@@ -0,0 +1,510 @@
+''' Binary framing used between RendererClient and RendererServer.
+
+    Every binary message starts with a frame header (magic, protocol
+    version, message type and flags) followed by a fixed header for
+    the message type and by raw little-endian array blocks:
+
+        SCENE  : num_tris, num_rays | int32 ids | float32 triangles
+                 | float32 rays
+        RESULT : num_rays, compute time | int32 ids | float32 distances
+        ERROR  : message length | utf-8 message
+
+    A SCENE_QUERY replaces SCENE when the server may have the geometry
+    cached. The client sends the geometry hash and sizes, the server
+    answers with a STATUS, and the client sends the id/triangle blocks
+    only when that status is SCENE_MISS. The rays block comes last in
+    both cases:
+
+        SCENE_QUERY : geometry hash, num_tris, num_rays
+        STATUS      : SCENE_HIT or SCENE_MISS
+
+    With FLAG_STREAM set on the SCENE or SCENE_QUERY frame, the server
+    sends the results as RESULT_CHUNK messages, each one a range of
+    consecutive rays, as soon as they are computed and in any order,
+    followed by a RESULT_END once all the rays were sent:
+
+        RESULT_CHUNK : first ray, num_rays | int32 ids | float32 distances
+        RESULT_END   : num_rays, compute time
+
+    Bits 8 to 13 of the request flags select a compact encoding of the
+    results (application.encoding). The server sets the encoding it
+    used on the flags of its RESULT and RESULT_CHUNK frames, whose
+    arrays are then replaced by an encoded block:
+
+        encoded : ids size, distances size, distance range | ids
+                  bytes | distances bytes
+
+    FLAG_OCCLUSION asks for an any-hit query (shadow rays) instead of
+    the closest hits: a float32 block with the maximum distance of
+    every ray follows the rays, and the answer is a bitmask with one
+    bit per ray, set when the ray hits a triangle closer than its
+    maximum distance (np.packbits order). It is never streamed:
+
+        OCCLUSION_RESULT : num_rays, compute time | ceil(num_rays/8) bytes
+
+    A RENDER asks the server for a whole shaded frame: it generates the
+    camera rays, traces them, traces the shadow rays of the hits and
+    shades the pixels itself, so only the camera, the shading
+    parameters and (on a cache miss) the geometry go up and only the
+    pixels come back. The geometry follows the same STATUS exchange as
+    a SCENE_QUERY:
+
+        RENDER : geometry hash, num_tris, num_lights, options
+                 | camera | material | float64 lights (7 per light:
+                 position, color, intensity)
+        CAMERA : hres, vres, eye, look point, up vector, distance,
+                 pixel size
+        MATERIAL : color, diffuse coefficient
+        IMAGE  : width, height, compute time | uint8 RGB pixels
+
+    A CAMERA_QUERY replaces the rays of a SCENE_QUERY by the camera
+    they come from and an optional tile of its image (x, y, width,
+    height; a zero width means the whole image). The server generates
+    the rays itself, in the scanline order of the tile, so the upload
+    no longer grows with the resolution. The geometry and the results
+    are exchanged as for a SCENE_QUERY, FLAG_STREAM included:
+
+        CAMERA_QUERY : geometry hash, num_tris, tile | camera
+
+    The sizes of the headers are checked against max_block_size
+    (set_max_block_size) before the blocks are allocated, a larger
+    one fails with a ProtocolError.
+
+    The text protocol (a 4-byte big-endian size followed by the scene
+    as decimal text) is still accepted by the server. Both can share
+    a port: a text size would have to be about 1.1GB to look like the
+    magic bytes.
+'''
+import zlib
+import struct
+import hashlib
+import numpy as np
+from application.encoding import Encoding, RAW
+
+MAGIC = b'DRKB'
+VERSION = 1
+
+MSG_SCENE       = 1
+MSG_RESULT      = 2
+MSG_ERROR       = 3
+MSG_SCENE_QUERY = 4
+MSG_STATUS      = 5
+MSG_RESULT_CHUNK = 6
+MSG_RESULT_END   = 7
+MSG_OCCLUSION_RESULT = 8
+MSG_RENDER = 9
+MSG_IMAGE  = 10
+MSG_CAMERA_QUERY = 11
+
+FLAG_STREAM    = 1
+FLAG_OCCLUSION = 2
+
+SCENE_MISS = 0
+SCENE_HIT  = 1
+
+FRAME  = struct.Struct('<4sHHI')  # magic, version, message type, flags
+SCENE  = struct.Struct('<II')     # number of triangles, number of rays
+RESULT = struct.Struct('<Id')     # number of rays, compute time (s)
+ERROR  = struct.Struct('<I')      # message size
+SCENE_QUERY = struct.Struct('<20sII')  # geometry hash, triangles, rays
+STATUS = struct.Struct('<B')
+RESULT_CHUNK = struct.Struct('<II')    # first ray, number of rays
+OCCLUSION_RESULT = RESULT
+RENDER = struct.Struct('<20sIII')      # geometry hash, triangles, lights, options
+CAMERA = struct.Struct('<II11d')       # resolution, eye, look, up, distance, pixel size
+MATERIAL = struct.Struct('<4d')        # color, diffuse coefficient
+IMAGE = struct.Struct('<IId')          # width, height, compute time
+CAMERA_QUERY = struct.Struct('<20sI4I')  # geometry hash, triangles, tile
+
+# RENDER options
+RENDER_SHADOWS = 1
+NUM_LIGHT_ATTRS = 7
+
+ID_TYPE    = np.dtype('<i4')
+FLOAT_TYPE = np.dtype('<f4')
+
+NUM_TRIANGLE_ATTRS = 9
+NUM_RAY_ATTRS = 6
+
+# largest block a peer may announce, checked before allocating it
+max_block_size = 1 << 30
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_binary(prefix):
+    ''' Tell if the first 4 bytes of a connection belong to a
+        binary frame or to the size of a text message
+    '''
+    return bytes(prefix) == MAGIC
+
+
+def set_max_block_size(size):
+    ''' Bound, in bytes, of the blocks received from now on '''
+    global max_block_size
+    max_block_size = int(size)
+
+
+def check_block_size(size):
+    ''' Reject a block size read from a header before it is allocated '''
+    if size > max_block_size:
+        raise ProtocolError(
+            f'Block of {size} bytes exceeds the maximum of {max_block_size} bytes')
+
+
+def recv_into(sock, buffer):
+    ''' Fill a writable buffer (bytearray, memoryview or ndarray)
+        straight from the socket, without intermediate copies
+    '''
+    view = memoryview(buffer).cast('B')
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ProtocolError(
+                f'Connection closed after {received}/{len(view)} bytes')
+        received += count
+    return buffer
+
+
+def recv_exactly(sock, size):
+    check_block_size(size)
+    return recv_into(sock, bytearray(size))
+
+
+def recv_array(sock, count, dtype):
+    ''' Receive a block of `count` elements into a new array '''
+    dtype = np.dtype(dtype)
+    check_block_size(count * dtype.itemsize)
+    return recv_into(sock, np.empty(count, dtype=dtype))
+
+
+def send_array(sock, array, dtype):
+    ''' Send an array as a raw block, converting it only when it
+        is not already contiguous with the wire dtype
+    '''
+    array = np.ascontiguousarray(array, dtype=dtype)
+    sock.sendall(memoryview(array).cast('B'))
+
+
+def send_frame(sock, msg_type, header, flags=0):
+    sock.sendall(FRAME.pack(MAGIC, VERSION, msg_type, flags) + header)
+
+
+def recv_frame(sock, prefix=None):
+    ''' Read and validate a frame header. `prefix` holds the first
+        bytes when they were already read to detect the protocol.
+        Returns the message type and flags
+    '''
+    data = bytes(prefix or b'')
+    data += bytes(recv_exactly(sock, FRAME.size - len(data)))
+    magic, version, msg_type, flags = FRAME.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError(f'Invalid frame magic {magic}')
+    if version != VERSION:
+        raise ProtocolError(
+            f'Unsupported protocol version {version} (expected {VERSION})')
+    if msg_type == MSG_ERROR:
+        size, = ERROR.unpack(recv_exactly(sock, ERROR.size))
+        raise ProtocolError(recv_exactly(sock, size).decode())
+    return msg_type, flags
+
+
+def expect_frame(sock, msg_type, prefix=None):
+    received, flags = recv_frame(sock, prefix)
+    if received != msg_type:
+        raise ProtocolError(f'Expected message {msg_type}, received {received}')
+    return flags
+
+
+def geometry_hash(tri_ids, tris):
+    ''' Content hash of the geometry in its wire format '''
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(tri_ids, dtype=ID_TYPE))
+    digest.update(np.ascontiguousarray(tris, dtype=FLOAT_TYPE))
+    return digest.digest()
+
+
+def send_scene(sock, tri_ids, tris, rays, flags=0):
+    tri_ids = np.asarray(tri_ids)
+    num_tris = len(tri_ids)
+    num_rays = np.size(rays) // NUM_RAY_ATTRS
+    send_frame(sock, MSG_SCENE, SCENE.pack(num_tris, num_rays), flags)
+    send_geometry(sock, tri_ids, tris)
+    send_array(sock, rays, FLOAT_TYPE)
+
+
+def send_cached_scene(sock, tri_ids, tris, rays, key=None, flags=0):
+    ''' Send a scene whose geometry may be cached by the server.
+        Returns True when the geometry upload was skipped
+    '''
+    tri_ids = np.asarray(tri_ids)
+    key = key or geometry_hash(tri_ids, tris)
+    num_rays = np.size(rays) // NUM_RAY_ATTRS
+    send_frame(sock, MSG_SCENE_QUERY,
+        SCENE_QUERY.pack(key, len(tri_ids), num_rays), flags)
+    hit = recv_status(sock) == SCENE_HIT
+    if not hit:
+        send_geometry(sock, tri_ids, tris)
+    send_array(sock, rays, FLOAT_TYPE)
+    return hit
+
+
+def send_geometry(sock, tri_ids, tris):
+    send_array(sock, tri_ids, ID_TYPE)
+    send_array(sock, tris, FLOAT_TYPE)
+
+
+def recv_scene(sock):
+    ''' Receive the body of a SCENE message into preallocated
+        arrays. Returns (triangle ids, triangles, rays)
+    '''
+    num_tris, num_rays = SCENE.unpack(recv_exactly(sock, SCENE.size))
+    tri_ids, tris = recv_geometry(sock, num_tris)
+    rays = recv_rays(sock, num_rays)
+    return tri_ids, tris, rays
+
+
+def recv_scene_query(sock):
+    ''' Receive the body of a SCENE_QUERY message.
+        Returns (geometry hash, number of triangles, number of rays)
+    '''
+    return SCENE_QUERY.unpack(recv_exactly(sock, SCENE_QUERY.size))
+
+
+def recv_geometry(sock, num_tris):
+    tri_ids = recv_array(sock, num_tris, ID_TYPE)
+    tris = recv_array(sock, num_tris * NUM_TRIANGLE_ATTRS, FLOAT_TYPE)
+    return tri_ids, tris
+
+
+def recv_rays(sock, num_rays):
+    return recv_array(sock, num_rays * NUM_RAY_ATTRS, FLOAT_TYPE)
+
+
+def send_status(sock, status):
+    send_frame(sock, MSG_STATUS, STATUS.pack(status))
+
+
+def recv_status(sock):
+    expect_frame(sock, MSG_STATUS)
+    status, = STATUS.unpack(recv_exactly(sock, STATUS.size))
+    return status
+
+
+def send_results(sock, ids, intersects, compute_time=0.0, encoding=RAW):
+    ''' Returns the number of bytes of the results, header excluded '''
+    header = RESULT.pack(len(ids), compute_time)
+    if encoding.is_raw:
+        send_frame(sock, MSG_RESULT, header)
+        send_array(sock, ids, ID_TYPE)
+        send_array(sock, intersects, FLOAT_TYPE)
+        return len(ids) * (ID_TYPE.itemsize + FLOAT_TYPE.itemsize)
+    data = encoding.encode(ids, intersects)
+    send_frame(sock, MSG_RESULT, header + data, encoding.flags)
+    return len(data)
+
+
+def result_encoding(flags):
+    try:
+        return Encoding.from_flags(flags)
+    except ValueError as error:
+        raise ProtocolError(str(error))
+
+
+def recv_encoded(sock, encoding, num_rays):
+    ''' (ids, distances) of an encoded results block. A block that
+        does not decode to `num_rays` results is a ProtocolError,
+        like any other malformed message
+    '''
+    try:
+        return encoding.decode(lambda size: recv_exactly(sock, size), num_rays)
+    except (ValueError, zlib.error) as error:
+        raise ProtocolError(f'Invalid encoded results: {error}')
+
+
+def recv_results(sock):
+    ''' Returns (triangle ids, distances, compute time) '''
+    encoding = result_encoding(expect_frame(sock, MSG_RESULT))
+    num_rays, compute_time = RESULT.unpack(recv_exactly(sock, RESULT.size))
+    if encoding.is_raw:
+        ids = recv_array(sock, num_rays, ID_TYPE)
+        intersects = recv_array(sock, num_rays, FLOAT_TYPE)
+    else:
+        # the decoded arrays are allocated from num_rays
+        check_block_size(num_rays * (ID_TYPE.itemsize + FLOAT_TYPE.itemsize))
+        ids, intersects = recv_encoded(sock, encoding, num_rays)
+    return ids, intersects, compute_time
+
+
+def send_result_chunk(sock, first_ray, ids, intersects, encoding=RAW):
+    ''' Returns the number of bytes of the results, header excluded '''
+    header = RESULT_CHUNK.pack(first_ray, len(ids))
+    if encoding.is_raw:
+        send_frame(sock, MSG_RESULT_CHUNK, header)
+        send_array(sock, ids, ID_TYPE)
+        send_array(sock, intersects, FLOAT_TYPE)
+        return len(ids) * (ID_TYPE.itemsize + FLOAT_TYPE.itemsize)
+    data = encoding.encode(ids, intersects)
+    send_frame(sock, MSG_RESULT_CHUNK, header + data, encoding.flags)
+    return len(data)
+
+
+def send_result_end(sock, num_rays, compute_time=0.0):
+    send_frame(sock, MSG_RESULT_END, RESULT.pack(num_rays, compute_time))
+
+
+def recv_result_stream(sock, ids, intersects, on_chunk=None):
+    ''' Receive streamed results into the preallocated `ids` and
+        `intersects` arrays (one element per ray), straight from the
+        socket. `on_chunk(first, last)` is called after the range of
+        rays [first, last) arrived. Returns the compute time
+    '''
+    num_received = 0
+    while True:
+        msg_type, flags = recv_frame(sock)
+        if msg_type == MSG_RESULT_END:
+            num_rays, compute_time = RESULT.unpack(recv_exactly(sock, RESULT.size))
+            if num_received != num_rays or num_rays != len(ids):
+                raise ProtocolError(
+                    f'Received results for {num_received} of {len(ids)} rays')
+            return compute_time
+        if msg_type != MSG_RESULT_CHUNK:
+            raise ProtocolError(f'Unexpected message {msg_type}')
+        first, count = RESULT_CHUNK.unpack(recv_exactly(sock, RESULT_CHUNK.size))
+        last = first + count
+        if last > len(ids):
+            raise ProtocolError(f'Results for rays {first}-{last} out of range')
+        encoding = result_encoding(flags)
+        if encoding.is_raw:
+            recv_into(sock, ids[first:last])
+            recv_into(sock, intersects[first:last])
+        else:
+            ids[first:last], intersects[first:last] = recv_encoded(sock, encoding, count)
+        num_received += count
+        if on_chunk is not None:
+            on_chunk(first, last)
+
+
+def send_error(sock, message):
+    data = message.encode()
+    send_frame(sock, MSG_ERROR, ERROR.pack(len(data)) + data)
+
+
+def send_max_distances(sock, max_distances):
+    send_array(sock, max_distances, FLOAT_TYPE)
+
+
+def recv_max_distances(sock, num_rays):
+    return recv_array(sock, num_rays, FLOAT_TYPE)
+
+
+def send_occlusion(sock, occluded, compute_time=0.0):
+    occluded = np.asarray(occluded, dtype=bool)
+    send_frame(sock, MSG_OCCLUSION_RESULT, OCCLUSION_RESULT.pack(len(occluded), compute_time))
+    sock.sendall(np.packbits(occluded).tobytes())
+
+
+def recv_occlusion(sock):
+    ''' Returns (boolean array, compute time) '''
+    expect_frame(sock, MSG_OCCLUSION_RESULT)
+    num_rays, compute_time = OCCLUSION_RESULT.unpack(recv_exactly(sock, OCCLUSION_RESULT.size))
+    bits = recv_array(sock, (num_rays + 7) // 8, np.uint8)
+    return np.unpackbits(bits)[:num_rays].astype(bool), compute_time
+
+
+def pack_camera(resolution, eye_point, look_point, up_vector, distance, psize):
+    ''' CAMERA block of the arguments of a raytracer Camera '''
+    return CAMERA.pack(
+        *resolution, *np.ravel(eye_point), *np.ravel(look_point),
+        *np.ravel(up_vector), distance, psize)
+
+
+def unpack_camera(data):
+    ''' Camera arguments (resolution, eye point, look point, up
+        vector, distance, pixel size) of a CAMERA block
+    '''
+    values = CAMERA.unpack(data)
+    return (
+        values[0:2],
+        np.array(values[2:5]),
+        np.array(values[5:8]),
+        np.array(values[8:11]),
+        values[11],
+        values[12])
+
+
+def send_render(sock, tri_ids, tris, camera, material, lights, options=0, key=None):
+    ''' Ask for a shaded frame. `camera` holds the Camera arguments,
+        `material` the color and diffuse coefficient and `lights` the
+        7 values of each point light. Returns True when the geometry
+        upload was skipped
+    '''
+    tri_ids = np.asarray(tri_ids)
+    key = key or geometry_hash(tri_ids, tris)
+    lights = np.ascontiguousarray(lights, dtype='<f8').reshape(-1)
+    color, diffuse = material
+    send_frame(sock, MSG_RENDER,
+        RENDER.pack(key, len(tri_ids), len(lights) // NUM_LIGHT_ATTRS, options)
+        + pack_camera(*camera) + MATERIAL.pack(*np.ravel(color), diffuse))
+    send_array(sock, lights, '<f8')
+    hit = recv_status(sock) == SCENE_HIT
+    if not hit:
+        send_geometry(sock, tri_ids, tris)
+    return hit
+
+
+def recv_render(sock):
+    ''' Receive the body of a RENDER message up to the geometry.
+        Returns (geometry hash, number of triangles, camera arguments,
+        (material color, diffuse coefficient), (L, 7) lights, options)
+    '''
+    key, num_tris, num_lights, options = RENDER.unpack(recv_exactly(sock, RENDER.size))
+    camera = unpack_camera(recv_exactly(sock, CAMERA.size))
+    material = MATERIAL.unpack(recv_exactly(sock, MATERIAL.size))
+    lights = recv_array(sock, num_lights * NUM_LIGHT_ATTRS, '<f8')
+    return (key, num_tris, camera, (np.array(material[:3]), material[3]),
+            lights.reshape(-1, NUM_LIGHT_ATTRS), options)
+
+
+def send_camera_query(sock, tri_ids, tris, camera, tile=None, key=None, flags=0):
+    ''' Ask for the closest hits of the rays of a camera (its
+        arguments, as for send_render), restricted to the (x, y,
+        width, height) `tile`. Returns True when the geometry upload
+        was skipped
+    '''
+    tri_ids = np.asarray(tri_ids)
+    key = key or geometry_hash(tri_ids, tris)
+    send_frame(sock, MSG_CAMERA_QUERY,
+        CAMERA_QUERY.pack(key, len(tri_ids), *(tile or (0, 0, 0, 0)))
+        + pack_camera(*camera), flags)
+    hit = recv_status(sock) == SCENE_HIT
+    if not hit:
+        send_geometry(sock, tri_ids, tris)
+    return hit
+
+
+def recv_camera_query(sock):
+    ''' Receive the body of a CAMERA_QUERY message up to the geometry.
+        Returns (geometry hash, number of triangles, camera arguments,
+        tile or None for the whole image)
+    '''
+    key, num_tris, *tile = CAMERA_QUERY.unpack(recv_exactly(sock, CAMERA_QUERY.size))
+    camera = unpack_camera(recv_exactly(sock, CAMERA.size))
+    return key, num_tris, camera, (tuple(tile) if tile[2] else None)
+
+
+def send_image(sock, image, compute_time=0.0):
+    height, width = image.shape[:2]
+    send_frame(sock, MSG_IMAGE, IMAGE.pack(width, height, compute_time))
+    send_array(sock, image, np.uint8)
+
+
+def recv_image(sock):
+    ''' Returns ((height, width, 3) uint8 image, compute time) '''
+    expect_frame(sock, MSG_IMAGE)
+    width, height, compute_time = IMAGE.unpack(recv_exactly(sock, IMAGE.size))
+    image = recv_array(sock, width * height * 3, np.uint8)
+    return image.reshape(height, width, 3), compute_time
@@ -17,5 +17,9 @@ class PointLight(LightSource):
 	def get_direction(self, point):
 		return self.position - point
 
+	def get_directions(self, points):
+		''' Directions to the light from an (N, 3) array of points '''
+		return self.position[None, :] - points
+
 	def get_radiance(self):
 		return self.color * self.intensity
@@ -20,3 +20,18 @@ class Matte(object):
 		return color
 
 
+
+	def shade_batch(self, hit_points, normals, incident_directions, lights, visibility=None):
+		''' Same as shade for N hits at once, taking (N, 3) arrays
+			and returning the (N, 3) colors. `visibility` has an (N,)
+			boolean array per light, False where the light is blocked
+		'''
+		color = np.zeros((len(hit_points), 3))
+		dot = np.einsum('ij,ij->i', incident_directions, normals)[:, None]
+		for i, light in enumerate(lights):
+			influence = light.get_radiance()
+			L = self.color*self.diffuse_coef*influence*dot*INV_PI
+			if visibility is not None:
+				L = L*visibility[i][:, None]
+			color += L
+		return color
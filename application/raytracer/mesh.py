@@ -0,0 +1,195 @@
+import os
+import re
+import mmap
+import numpy as np
+import application.meshcache as meshcache
+from .geometry import Triangle
+
+BVH_ARRAYS = ('bvh_bounds', 'bvh_links', 'bvh_triangles', 'bvh_ids', 'bvh_index')
+
+VERTEX_LINE = re.compile(rb'^v[ \t]+([^\r\n]*)', re.M)
+FACE_LINE = re.compile(rb'^f[ \t]+([^\r\n]*)', re.M)
+
+
+def triangle_normals(triangles):
+	''' Unit normal of every triangle of a (T, 3, 3) array of vertex
+		coordinates (or the flat array of 9 values per triangle)
+	'''
+	triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+	p1, p2, p3 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+	normals = np.cross(p2 - p1, p3 - p1)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		normals /= np.linalg.norm(normals, axis=1)[:, None]
+	return normals
+
+
+class Mesh():
+	''' Triangle mesh stored as contiguous arrays: vertex
+		coordinates (V, 3), vertex indices of each triangle (T, 3)
+		and triangle normals (T, 3), computed once for all faces
+		unless given. `bvh_arrays` are the arrays of a serialized
+		BVH of the triangles (see BVH.toArrays)
+	'''
+	def __init__(self, vertices, faces, normals=None, bvh_arrays=None):
+		self.vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+		self.faces = np.ascontiguousarray(faces, dtype=np.int32)
+		if normals is None:
+			normals = self._compute_normals()
+		self.normals = normals
+		self.bvh_arrays = bvh_arrays
+		self.triangles = TriangleList(self)
+
+	def __len__(self):
+		return len(self.faces)
+
+	def _compute_normals(self):
+		return triangle_normals(self.vertices[self.faces])
+
+	def triangle_array(self, dtype=np.float32):
+		''' Coordinates of the 3 vertices of every triangle as a
+			flat array, 9 values per triangle
+		'''
+		return self.vertices[self.faces].astype(dtype).reshape(-1)
+
+	def arrays(self):
+		''' Arrays describing the mesh, as stored in the mesh cache '''
+		arrays = {
+			'vertices': self.vertices,
+			'faces'   : self.faces,
+			'normals' : self.normals}
+		if self.bvh_arrays is not None:
+			arrays.update(zip(BVH_ARRAYS, self.bvh_arrays))
+		return arrays
+
+	def build_bvh(self):
+		''' Build the BVH of the triangles (with the ids and single
+			precision coordinates sent to the tracers) and keep its
+			arrays. Returns the compiled BVH
+		'''
+		from application.tracers import load_cpp_tracer
+		cpp_tracer = load_cpp_tracer()
+		if cpp_tracer is None:
+			raise RuntimeError('the compiled tracer is required to build a BVH')
+		ids = np.arange(len(self), dtype=np.int32)
+		bvh = cpp_tracer.BVH(ids, self.triangle_array())
+		self.bvh_arrays = bvh.toArrays()
+		return bvh
+
+	def bvh(self):
+		''' The BVH restored from the stored arrays, or None '''
+		if self.bvh_arrays is None:
+			return None
+		from application.tracers import load_cpp_tracer
+		return load_cpp_tracer().BVH.fromArrays(*self.bvh_arrays)
+
+	def triangle(self, index):
+		p1, p2, p3 = (self.vertices[i] for i in self.faces[index])
+		tri = Triangle(p1, p2, p3)
+		tri.id = index
+		return tri
+
+
+class TriangleList():
+	''' Sequence of the Triangle objects of a mesh, created only
+		when one is accessed
+	'''
+	def __init__(self, mesh):
+		self.mesh = mesh
+
+	def __len__(self):
+		return len(self.mesh)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self.mesh.triangle(i) for i in range(len(self))[index]]
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError('triangle index out of range')
+		return self.mesh.triangle(index)
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self.mesh.triangle(index)
+
+
+def _parse_rows(lines, columns, dtype):
+	''' Parse whitespace separated rows with at least `columns`
+		values each, keeping the first `columns` of every row
+	'''
+	values = np.fromstring(b' '.join(lines), dtype=dtype, sep=' ')
+	if len(values) == len(lines) * columns:
+		return values.reshape(-1, columns)
+	# rows with extra values (vertex weights or colors)
+	return np.array([line.split()[:columns] for line in lines], dtype=dtype)
+
+
+def _triangulate(lines, num_vertices):
+	''' Vertex indices of the faces, 0-based, with polygons split in
+		fans around their first vertex. Accepts v, v/vt, v//vn and
+		v/vt/vn references, and negative (relative to the end of the
+		vertex list) indices
+	'''
+	joined = b' '.join(lines)
+	if b'/' not in joined:
+		faces = np.fromstring(joined, dtype=np.int64, sep=' ')
+		if len(faces) == len(lines) * 3:
+			faces = faces.reshape(-1, 3)
+			return np.where(faces < 0, faces + num_vertices, faces - 1)
+
+	triangles = []
+	for line in lines:
+		indices = [int(ref.split(b'/')[0]) for ref in line.split()]
+		indices = [i + num_vertices if i < 0 else i - 1 for i in indices]
+		for k in range(1, len(indices) - 1):
+			triangles.append((indices[0], indices[k], indices[k + 1]))
+	return np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+
+def read_obj(filename, use_mmap=False):
+	''' Load the vertices and faces of an OBJ file into a Mesh. The
+		file is scanned in bulk with regular expressions, over a
+		memory map of it with `use_mmap`, instead of line by line
+	'''
+	with open(filename, 'rb') as file:
+		# empty files can't be mapped
+		use_mmap = use_mmap and os.fstat(file.fileno()).st_size > 0
+		if use_mmap:
+			data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			data = file.read()
+		try:
+			vertex_lines = VERTEX_LINE.findall(data)
+			face_lines = FACE_LINE.findall(data)
+		finally:
+			if use_mmap:
+				data.close()
+
+	vertices = _parse_rows(vertex_lines, 3, np.float64)
+	faces = _triangulate(face_lines, len(vertices))
+	return Mesh(vertices.reshape(-1, 3), faces)
+
+
+def load_mesh(filename, use_cache=True, with_bvh=False):
+	''' Mesh of an OBJ file. With `use_cache` the parsed arrays are
+		kept in a binary cache next to the file (see meshcache) and
+		memory mapped by the following loads. `with_bvh` also stores
+		the BVH of the triangles in the cache
+	'''
+	def build(source):
+		mesh = read_obj(source)
+		if with_bvh:
+			mesh.build_bvh()
+		return mesh.arrays()
+
+	if not use_cache:
+		return Mesh(**_mesh_arguments(build(filename)))
+	required = BVH_ARRAYS if with_bvh else ()
+	return Mesh(**_mesh_arguments(meshcache.load(filename, build, required)))
+
+
+def _mesh_arguments(arrays):
+	arguments = {name: arrays[name] for name in ('vertices', 'faces', 'normals')}
+	if all(name in arrays for name in BVH_ARRAYS):
+		arguments['bvh_arrays'] = tuple(arrays[name] for name in BVH_ARRAYS)
+	return arguments
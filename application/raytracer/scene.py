@@ -1,35 +1,49 @@
 from .geometry import *
 from .light import *
 from .material import *
+from .mesh import Mesh, read_obj, load_mesh, triangle_normals
 import numpy as np
 
-def read_obj(filename):
-	triangles = []
-	vertices = []
-	with open(filename, 'r') as file:
-		tid = 0
-		vcount = 0
-		for line in file:
-			line = line.split()
-			data_type = line[0]
-			data = line[1:]
-			if data_type == 'v':
-				vcount += 1
-				vertices.append(np.array(list(map(float, data))))
-			elif data_type == 'f':
-				triangles.append(
-					Triangle(
-						vertices[int(data[0]) - 1],
-						vertices[int(data[1]) - 1],
-						vertices[int(data[2]) - 1])
-					)
-				triangles[tid].id = tid
-				tid+=1
-	return triangles
+# shadow ray origins are moved towards the light by this fraction of the
+# scene size, so they don't hit the triangle they start on
+SHADOW_BIAS = 1e-4
+
+def shadow_rays(hit_points, light, bias=0.0):
+	''' Rays from (N, 3) hit points towards a point light, as flat
+		float32 rays and the float32 distance each one may travel
+		before reaching the light. Origins are moved `bias` towards
+		the light
+	'''
+	directions = light.get_directions(hit_points)
+	distances = np.linalg.norm(directions, axis=1)
+	directions /= distances[:, None]
+	rays = np.empty((len(hit_points), 6), dtype=np.float32)
+	rays[:, :3] = hit_points + directions*bias
+	rays[:, 3:] = directions
+	return rays.reshape(-1), (distances - 2*bias).astype(np.float32)
+
+def shade_hits(rays, distances, normals, material, lights, occluded=None, bias=0.0):
+	''' Colors (N, 3) of the hits of N rays (N, 6) at `distances`
+		on surfaces with `normals` (N, 3). With `occluded(rays,
+		max_distances)`, an any-hit query returning a boolean array,
+		the lights are shadowed: it is called once per light with
+		the shadow rays of all the hits
+	'''
+	rays = np.asarray(rays, dtype=np.float64).reshape(-1, 6)
+	hit_points = rays[:, :3] + rays[:, 3:]*np.asarray(distances, dtype=np.float64)[:, None]
+	visibility = None
+	if occluded is not None and len(hit_points):
+		visibility = [
+			~np.asarray(occluded(*shadow_rays(hit_points, light, bias)), dtype=bool)
+			for light in lights]
+	return material.shade_batch(hit_points, normals, -rays[:, 3:], lights, visibility)
 
 class Scene():
-	def __init__(self, filename):
-		self.triangles = read_obj(filename)
+	def __init__(self, filename, use_cache=True):
+		self.mesh = load_mesh(filename, use_cache)
+		# Triangle objects are only built when accessed
+		self.triangles = self.mesh.triangles
+		self._triangle_arrays = None
 		self.lights = [
 			PointLight(
 				np.array([50., 50., 50.]),
@@ -56,17 +70,63 @@ class Scene():
 			psize)
 
 	def get_triangles_string(self):
-		ids = ''
-		out = ''
-		counter = 0
-		for t in self.triangles:
-			ids += f'{counter} '
-			for p in t.pts:
-				for c in p:
-					out += f'{c} '
-			out += '\n'
-			counter += 1
-		return ids + '\n' + out + '\n'
+		import io
+		out = io.StringIO()
+		out.write(' '.join(map(str, range(len(self.mesh)))) + ' \n')
+		np.savetxt(out, self.mesh.triangle_array(np.float64).reshape(-1, 9), fmt='%.17g')
+		return out.getvalue() + '\n'
+
+	def get_triangles_array(self):
+		''' Triangle ids and vertex coordinates (9 per triangle)
+			as the flat arrays sent by the binary protocol
+		'''
+		if self._triangle_arrays is None:
+			ids = np.arange(len(self.mesh), dtype=np.int32)
+			self._triangle_arrays = (ids, self.mesh.triangle_array())
+		return self._triangle_arrays
+
+	def get_normals_array(self):
+		''' Unit normal of every triangle as a (T, 3) array '''
+		return self.mesh.normals
+
+	def get_size(self):
+		''' Length of the diagonal of the mesh bounding box '''
+		vertices = self.mesh.vertices
+		return float(np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0)))
+
+	def shadow_rays(self, hit_points, light):
+		''' Shadow rays of (N, 3) hit points towards a light, see
+			the shadow_rays function
+		'''
+		return shadow_rays(hit_points, light, SHADOW_BIAS * self.get_size())
+
+	def shade(self, triangle_ids, distances, first_pixel=0, image=None, occluded=None):
+		''' Shade the camera image from the triangle hit and the
+			distance of every pixel ray, as returned by the server.
+			Returns the image as a (vres, hres, 3) uint8 array,
+			black where nothing was hit. Given the results of only
+			the pixels from `first_pixel` on (in scanline order),
+			those pixels of `image` are shaded. With `occluded(rays,
+			max_distances)`, an any-hit query returning a boolean
+			array, the lights are shadowed: it is called once per
+			light with the shadow rays of all the pixels hit
+		'''
+		triangle_ids = np.asarray(triangle_ids)
+		last_pixel = first_pixel + len(triangle_ids)
+		hit = triangle_ids != -1
+		rays = self.camera.get_pixel_rays(first_pixel, last_pixel, np.float64)[hit]
+		distances = np.asarray(distances, dtype=np.float64)[hit]
+		normals = self.get_normals_array()[triangle_ids[hit]]
+		colors = shade_hits(
+			rays, distances, normals, self.materials[0], self.lights,
+			occluded, SHADOW_BIAS * self.get_size())
+
+		if image is None:
+			image = np.zeros((self.camera.vres, self.camera.hres, 3), dtype=np.uint8)
+		pixels = image.reshape(-1, 3)[first_pixel : last_pixel]
+		pixels[:] = 0
+		pixels[hit] = np.clip((colors*255).astype('int32'), 0, 255)
+		return image
 
 class Camera():
 	def __init__(self, 
@@ -89,25 +149,86 @@ class Camera():
 
 		self.v = np.cross(self.w, self.u)
 
+	def parameters(self):
+		''' Arguments building the same camera, as sent to the server '''
+		return (
+			(self.hres, self.vres), self.eye_point, self.look_point,
+			self.up_vec, self.dist, self.psize)
+
 	def get_ray(self, c, r):
-		xv = self.psize*(c - self.hres/2),
-		yv = self.psize*(r - self.vres/2);
-		d = xv*self.u + yv*self.v - self.dist*self.w
-		d /= np.linalg.norm(d)
+		d = self._directions(np.array([c], dtype=np.float64), np.array([r], dtype=np.float64))[0]
 		return Ray(self.eye_point, d)
 
+	def _directions(self, xs, ys):
+		''' Unit directions through the image plane points at pixel
+			coordinates xs, ys (arrays of the same shape), as an
+			(N, 3) float64 array
+		'''
+		xv = self.psize*(xs.reshape(-1) - self.hres/2)
+		yv = self.psize*(ys.reshape(-1) - self.vres/2)
+		dirs = xv[:, None]*self.u + yv[:, None]*self.v - self.dist*self.w
+		dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+		return dirs
+
+	def tiles(self, width, height):
+		''' (x, y, width, height) of the tiles covering the image,
+			row by row. Border tiles are cropped to the image
+		'''
+		for y in range(0, self.vres, height):
+			for x in range(0, self.hres, width):
+				yield (x, y, min(width, self.hres - x), min(height, self.vres - y))
+
+	def get_rays(self, tile=None, samples=1, jitter=None, dtype=np.float32, out=None):
+		''' Origin and direction of the rays of a tile (the whole
+			image by default) as an (N, 6) array, in scanline order
+			with the `samples` rays of each pixel next to each other.
+			Rays go through the pixel corners, as get_ray, unless a
+			`jitter` random generator (np.random.RandomState) is
+			given, which offsets each ray randomly inside its pixel.
+			The rays are written to `out`, an (N, 6) array, when given
+		'''
+		x0, y0, width, height = tile or (0, 0, self.hres, self.vres)
+		ys, xs, _ = np.meshgrid(
+			np.arange(y0, y0 + height, dtype=np.float64),
+			np.arange(x0, x0 + width, dtype=np.float64),
+			np.arange(samples),
+			indexing='ij')
+		if jitter is not None:
+			xs = xs + jitter.random_sample(xs.shape)
+			ys = ys + jitter.random_sample(ys.shape)
+
+		dirs = self._directions(xs, ys)
+		rays = np.empty((len(dirs), 6), dtype=dtype) if out is None else out
+		rays[:, :3] = self.eye_point
+		rays[:, 3:] = dirs
+		return rays
+
+	def num_rays(self, tile=None, samples=1):
+		x0, y0, width, height = tile or (0, 0, self.hres, self.vres)
+		return width * height * samples
+
+	def get_pixel_rays(self, first, last, dtype=np.float32):
+		''' Rays of the pixels first to last - 1 in scanline order,
+			the same as those rows of get_rays()
+		'''
+		pixels = np.arange(first, last)
+		dirs = self._directions(
+			(pixels % self.hres).astype(np.float64),
+			(pixels // self.hres).astype(np.float64))
+		rays = np.empty((len(dirs), 6), dtype=dtype)
+		rays[:, :3] = self.eye_point
+		rays[:, 3:] = dirs
+		return rays
+
+	def get_rays_array(self):
+		''' Origin and direction of every pixel ray, in the
+			same scanline order as get_rays_string, as a flat
+			float32 array
+		'''
+		return self.get_rays().reshape(-1)
+
 	def get_rays_string(self):
-		out = ''
-		for r in range(self.vres):
-			for c in range(self.hres):
-				xv = self.psize*(c - self.hres/2),
-				yv = self.psize*(r - self.vres/2);
-				dir = xv*self.u + yv*self.v - self.dist*self.w
-				dir /= np.linalg.norm(dir)
-
-				for i in self.eye_point:
-					out += f'{round(i, 6)} '
-				for i in dir:
-					out += f'{round(i, 6)} '
-				out += '\n'
-		return out
+		import io
+		out = io.StringIO()
+		np.savetxt(out, self.get_rays(dtype=np.float64), fmt='%.6f')
+		return out.getvalue()
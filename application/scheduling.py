@@ -0,0 +1,136 @@
+''' Dynamic scheduling of rays over the CPU tracer and the FPGA
+    accelerators in heterogeneous mode. The rays are cut into tasks
+    with divide_tasks and every device takes the next task as soon as
+    it is free, so a device slower than expected only holds back the
+    task it is working on instead of a fixed share of the frame
+'''
+import abc
+import queue
+import threading
+import numpy as np
+import logging as log
+from time import time
+from application.tracers import divide_tasks
+
+
+class Device(abc.ABC):
+    ''' Processing unit fed by the scheduler. Keeps how much work
+        it did in the last schedule
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_tasks = 0
+        self.num_rays  = 0
+        self.busy_time = 0.0
+        # copies to and from the device's buffers, part of busy_time
+        self.fill_time  = 0.0
+        self.drain_time = 0.0
+
+    @abc.abstractmethod
+    def run(self, task, tri_ids, tris):
+        ''' Compute one task and return its (ids, intersects) '''
+
+
+class CPUDevice(Device):
+    def __init__(self, tracer, name='cpu'):
+        super().__init__(name)
+        self.tracer = tracer
+
+    def run(self, task, tri_ids, tris):
+        return self.tracer.compute(task.ray_data, tri_ids, tris)
+
+
+class FPGADevice(Device):
+    ''' One accelerator of a TracerFPGA. The accelerators run on
+        their own, so the thread feeding one sleeps while it waits
+    '''
+    def __init__(self, accelerator, fpga_tracer):
+        super().__init__(accelerator.name)
+        self.accelerator = accelerator
+        self.fpga_tracer = fpga_tracer
+
+    def run(self, task, tri_ids, tris):
+        self.accelerator.compute(task.ray_data, tri_ids, tris,
+            self.fpga_tracer.prepared_triangles(tris))
+        self.accelerator.wait()
+        results = self.accelerator.get_results()
+        self.fill_time  += self.accelerator.fill_time
+        self.drain_time += self.accelerator.drain_time
+        return results
+
+
+def fpga_devices(fpga_tracer):
+    return [FPGADevice(accel, fpga_tracer) for accel in fpga_tracer.accelerators]
+
+
+class Scheduler():
+    ''' Hands fixed-size tasks to whichever device is free and puts
+        the results back in ray order
+    '''
+    def __init__(self, devices, task_size=4096):
+        self.devices = devices
+        self.task_size = task_size
+        # seconds the last compute call took, to tell device utilization
+        self.wall_time = 0.0
+
+    def compute(self, rays, tri_ids, tris, on_result=None):
+        ''' Returns the (ids, intersects) of all the rays. When given,
+            `on_result(first_ray, ids, intersects)` is called from the
+            device threads with the results of every task as soon as
+            it is finished
+        '''
+        tasks = divide_tasks(rays, self.task_size)
+        if not tasks:
+            return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+
+        pending = queue.Queue()
+        for task in tasks:
+            pending.put(task)
+        results = [None] * len(tasks)
+        errors = []
+
+        for device in self.devices:
+            device.reset_stats()
+        ti = time()
+        workers = [
+            threading.Thread(
+                target=self._work,
+                args=(device, pending, results, errors, tri_ids, tris, on_result))
+            for device in self.devices]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.wall_time = time() - ti
+        if errors:
+            raise errors[0]
+
+        for device in self.devices:
+            log.info(f'{device.name}: {device.num_tasks} tasks, '
+                     f'{device.num_rays} rays in {device.busy_time} seconds')
+        ids = np.concatenate([result[0] for result in results])
+        intersects = np.concatenate([result[1] for result in results])
+        return (ids, intersects)
+
+    def _work(self, device, pending, results, errors, tri_ids, tris, on_result):
+        # stop taking tasks once any device failed
+        while not errors:
+            try:
+                task = pending.get_nowait()
+            except queue.Empty:
+                return
+            ti = time()
+            try:
+                results[task.id] = device.run(task, tri_ids, tris)
+                if on_result is not None:
+                    on_result(task.id * self.task_size, *results[task.id])
+            except Exception as error:
+                log.exception(f'{device.name} failed computing task {task.id}')
+                errors.append(error)
+                return
+            device.busy_time += time() - ti
+            device.num_tasks += 1
+            device.num_rays  += len(task)
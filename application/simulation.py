@@ -0,0 +1,152 @@
+''' Software stand-ins for the PYNQ pieces used by the FPGA tracer,
+    so the FPGA and heterogeneous modes can run (and be tested) on a
+    machine without the board. The simulated accelerator exposes the
+    same control registers as the intersectFPGA IP and computes on the
+    CPU, optionally throttled to a given ray-triangle test throughput
+'''
+import asyncio
+import threading
+import weakref
+import numpy as np
+import logging as log
+from time import time, sleep
+from application.tracers import TracerCPU, XIntersectFPGA as regs
+
+
+class SimulatedBuffer(np.ndarray):
+    ''' Numpy array standing in for a contiguous memory buffer '''
+    physical_address = 0
+
+    def freebuffer(self):
+        pass
+
+
+class SimulatedXlnk():
+    ''' Allocates buffers with fake physical addresses that the
+        simulated accelerators resolve back to the arrays
+    '''
+    def __init__(self):
+        self._buffers = weakref.WeakValueDictionary()
+        self._next_address = 0x10000000
+        self._lock = threading.Lock()
+        self.num_allocations = 0
+
+    def cma_array(self, shape, dtype=np.uint32):
+        buffer = np.zeros(shape, dtype=dtype).view(SimulatedBuffer)
+        with self._lock:
+            buffer.physical_address = self._next_address
+            self._next_address += max(buffer.nbytes, 1)
+            self._buffers[buffer.physical_address] = buffer
+            self.num_allocations += 1
+        return buffer
+
+    def buffer(self, address):
+        return self._buffers[address]
+
+
+class SimulatedInterrupt():
+    ''' Stand-in for pynq.Interrupt: wait is a coroutine returning
+        once the interrupt line is raised
+    '''
+    POLL_INTERVAL = 1e-3
+
+    def __init__(self):
+        self._raised = threading.Event()
+
+    def raise_line(self):
+        self._raised.set()
+
+    def lower_line(self):
+        self._raised.clear()
+
+    async def wait(self):
+        while not self._raised.is_set():
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+
+class SimulatedIntersectIP():
+    ''' Register-level model of the intersectFPGA IP. Writing 1 to
+        the control register starts the computation in a thread and
+        the register reads 4 (idle) again when it is finished. When
+        enabled through GIE/IER, finishing also flags ap_done in ISR
+        (cleared by writing 1 to it) and raises the interrupt line.
+        `throughput` is the number of ray-triangle tests per second
+        to emulate, None runs as fast as the CPU allows
+    '''
+    AP_START = 1
+    AP_IDLE  = 4
+
+    def __init__(self, xlnk, throughput=None):
+        self.xlnk = xlnk
+        self.throughput = throughput
+        self.registers = {regs.ADDR_AP_CTRL: self.AP_IDLE}
+        self.interrupt = SimulatedInterrupt()
+        self.num_reads = 0
+        self._worker = None
+
+    def read(self, offset):
+        self.num_reads += 1
+        return self.registers.get(offset, 0)
+
+    def write(self, offset, value):
+        if offset == regs.ADDR_AP_CTRL and value & self.AP_START:
+            if self.registers[offset] != self.AP_IDLE:
+                raise RuntimeError('Simulated accelerator started while busy')
+            self.registers[offset] = self.AP_START
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+        elif offset == regs.ADDR_ISR:
+            # toggle on write
+            self.registers[offset] = self.read(offset) ^ value
+            self._update_interrupt()
+        else:
+            self.registers[offset] = value
+            self._update_interrupt()
+
+    def _update_interrupt(self):
+        if self.read(regs.ADDR_GIE) & 1 and self.read(regs.ADDR_ISR) & 1:
+            self.interrupt.raise_line()
+        else:
+            self.interrupt.lower_line()
+
+    def _finish(self):
+        self.registers[regs.ADDR_AP_CTRL] = self.AP_IDLE
+        if self.read(regs.ADDR_IER) & 1:
+            self.registers[regs.ADDR_ISR] = self.read(regs.ADDR_ISR) | 1
+            self._update_interrupt()
+
+    def _run(self):
+        try:
+            ti = time()
+            num_tris = self.read(regs.ADDR_I_TNUMBER_DATA)
+            num_rays = self.read(regs.ADDR_I_RNUMBER_DATA)
+            tids = self.xlnk.buffer(self.read(regs.ADDR_I_TIDS_DATA))
+            tris = self.xlnk.buffer(self.read(regs.ADDR_I_TDATA_DATA))
+            rays = self.xlnk.buffer(self.read(regs.ADDR_I_RDATA_DATA))
+            out_ids = self.xlnk.buffer(self.read(regs.ADDR_O_TIDS_DATA))
+            out_inter = self.xlnk.buffer(self.read(regs.ADDR_O_TINTERSECTS_DATA))
+
+            ids, intersects = TracerCPU(use_multicore=False).compute(
+                np.asarray(rays[:num_rays*6]),
+                np.asarray(tids[:num_tris]),
+                np.asarray(tris[:num_tris*9]))
+            out_ids[:num_rays] = ids
+            out_inter[:num_rays] = intersects
+
+            if self.throughput:
+                sleep(max(0.0, num_rays*num_tris/self.throughput - (time() - ti)))
+        except Exception:
+            log.exception('Simulated accelerator failed')
+        finally:
+            self._finish()
+
+
+class SimulatedOverlay():
+    ''' Overlay with `num_accelerators` simulated intersectFPGA IPs,
+        named like the ones of the real bitstreams
+    '''
+    def __init__(self, xlnk, num_accelerators=1, throughput=None):
+        self.xlnk = xlnk
+        for i in range(num_accelerators):
+            setattr(self, f'intersectfpga_{i}', SimulatedIntersectIP(xlnk, throughput))
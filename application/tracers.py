@@ -1,6 +1,7 @@
+import threading
 import numpy as np 
 import logging as log
-from time import time
+from time import time, sleep
 
 class TracerPYNQ:
     MAX_DISTANCE = 1e9
@@ -8,9 +9,153 @@ class TracerPYNQ:
     def compute(self, rays, tri_ids, tris):
         raise Exception('ERROR: Using abstract class')
 
+    def prepare(self, tri_ids, tris, derived):
+        ''' Build whatever the tracer derives from a triangle set
+            before computing with it. The structures are stored in
+            the `derived` dict, which the server keeps alongside the
+            cached scene, so they are reused when it is sent again.
+            `derived` is None for triangles that are not cached
+        '''
+        pass
+
+    def occluded(self, rays, max_distances, tri_ids, tris):
+        ''' Any-hit query for shadow rays: boolean array telling for
+            each ray if it hits a triangle closer than its maximum
+            distance. Tracers without an any-hit kernel answer it
+            with the closest hits
+        '''
+        ids, intersects = self.compute(rays, tri_ids, tris)
+        return hits_within(ids, intersects, max_distances)
+
+
+def hits_within(ids, intersects, max_distances):
+    ''' Rays whose closest hit is nearer than their maximum distance '''
+    return (np.asarray(ids) != -1) & (np.asarray(intersects) < np.asarray(max_distances))
+
+
+def as_arrays(rays, tri_ids, tris):
+    ''' Convert scene data to the contiguous arrays taken by the
+        tracers. Inputs that already are float32/float64 arrays
+        (int32 for the ids) are returned as they are, without copies
+    '''
+    dtype = getattr(tris, 'dtype', np.float64)
+    if dtype not in (np.float32, np.float64):
+        dtype = np.float64
+    return (
+        np.ascontiguousarray(rays, dtype=dtype),
+        np.ascontiguousarray(tri_ids, dtype=np.int32),
+        np.ascontiguousarray(tris, dtype=dtype))
+
+
+def pynq_xlnk():
+    ''' Allocator of the board's contiguous memory. The FPGA classes
+        take any object with the same cma_array method instead, like
+        application.simulation.SimulatedXlnk
+    '''
+    from pynq import Xlnk
+    return Xlnk()
+
+
+def wait_until(condition, timeout=None, min_interval=1e-5, max_interval=2e-3):
+    ''' Poll `condition` sleeping between checks, starting with
+        min_interval and doubling up to max_interval, so short jobs
+        are noticed quickly and long ones cost few register reads.
+        Returns False if `timeout` seconds passed first
+    '''
+    deadline = None if timeout is None else time() + timeout
+    interval = min_interval
+    while not condition():
+        if deadline is not None and time() >= deadline:
+            return False
+        sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return True
+
+
+class BufferPool():
+    ''' Contiguous buffers kept between calls, one per name. A buffer
+        is only reallocated when a call needs more elements than it
+        has, so calls of similar size reuse the same memory (and the
+        same physical addresses)
+    '''
+    GROWTH = 1.5
+
+    def __init__(self, xlnk):
+        self.xlnk = xlnk
+        self.buffers = {}
+
+    def get(self, name, size, dtype):
+        ''' Buffer with room for at least `size` elements. Only the
+            first `size` elements are meant to be used
+        '''
+        buffer = self.buffers.get(name)
+        if buffer is None or len(buffer) < size or buffer.dtype != dtype:
+            capacity = size
+            if buffer is not None:
+                capacity = max(size, int(len(buffer) * self.GROWTH))
+                buffer.freebuffer()
+            # zero sized buffers can't be allocated
+            buffer = self.xlnk.cma_array(shape=(max(capacity, 1),), dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+    def release(self):
+        for buffer in self.buffers.values():
+            buffer.freebuffer()
+        self.buffers.clear()
+
+
+class TriangleBuffers():
+    ''' Triangle ids and coordinates copied once to contiguous
+        memory. The accelerators only read them, so a single copy
+        is shared by all the accelerators of the overlay. Built by
+        TracerFPGA.prepare for the arrays of one scene, which are
+        kept with the cached scene under its geometry hash and never
+        changed in place, or refilled for every uncached request
+    '''
+    def __init__(self, xlnk, tri_ids, tris):
+        self.xlnk = xlnk
+        self.tids = None
+        self.tris = None
+        self.fill(tri_ids, tris)
+
+    def fill(self, tri_ids, tris):
+        ''' Copy a triangle set in, reallocating the buffers only
+            when it has more triangles than they hold
+        '''
+        num_tris = len(tri_ids)
+        if self.tids is None or len(self.tids) < num_tris:
+            capacity = num_tris
+            if self.tids is not None:
+                capacity = max(num_tris, int(len(self.tids) * BufferPool.GROWTH))
+                self.release()
+            # zero sized buffers can't be allocated
+            capacity = max(capacity, 1)
+            self.tids = self.xlnk.cma_array(shape=(capacity,), dtype=np.int32)
+            self.tris = self.xlnk.cma_array(shape=(capacity*9,), dtype=np.float32)
+        self.tids[:num_tris] = tri_ids
+        self.tris[:num_tris*9] = tris
+        self.num_tris = num_tris
+        self.source = tris
+
+    @property
+    def nbytes(self):
+        return self.tids.nbytes + self.tris.nbytes
+
+    def release(self):
+        self.tids.freebuffer()
+        self.tris.freebuffer()
+
 class XIntersectFPGA():
     
     ADDR_AP_CTRL            = 0x00
+    ADDR_GIE                = 0x04
+    ADDR_IER                = 0x08
+    ADDR_ISR                = 0x0c
     ADDR_I_TNUMBER_DATA     = 0x10
     ADDR_I_TDATA_DATA       = 0x18
     ADDR_I_TIDS_DATA        = 0x20
@@ -21,112 +166,331 @@ class XIntersectFPGA():
     ADDR_O_TIDS_DATA        = 0x40
     ADDR_O_TINTERSECTS_DATA = 0x38
 
-    def __init__(self, intersect_ip, name):
+    # an interrupt wait is cut in slices of this many seconds, and
+    # the status register is read between them in case one was missed
+    INTERRUPT_SLICE = 0.1
+
+    def __init__(self, intersect_ip, name, xlnk=None, batch_size=None, num_buffers=2,
+                 use_interrupts=False):
+        ''' `intersect_ip` is the register block of the accelerator
+            (anything with read/write, as pynq's DefaultIP) and `xlnk`
+            the contiguous memory allocator, pynq's by default.
+            Calls with more than `batch_size` rays are streamed in
+            batches through `num_buffers` ray/result buffers.
+            With `use_interrupts`, wait blocks on the IP's interrupt
+            when the overlay connects one, instead of polling
+        '''
         self.intersect_ip = intersect_ip
         self.name = name
-        self._out_ids   = None
-        self._out_inter = None
-        self._tids = None
-        self._tris = None
-        self._rays = None
+        self.xlnk = xlnk if xlnk is not None else pynq_xlnk()
+        self.buffers = BufferPool(self.xlnk)
+        self.batch_size = batch_size
+        self.num_buffers = max(num_buffers, 2)
+        self._num_rays = 0
+        self._streamer = None
+        self._stream_results = None
+        self._stream_error = None
+        self._loop = None
+        self.start_time = None
+        self.finish_time = None
+        # seconds the last compute call spent copying to and from
+        # the contiguous buffers
+        self.fill_time = 0.0
+        self.drain_time = 0.0
+
+        self.use_interrupts = use_interrupts and hasattr(intersect_ip, 'interrupt')
+        if self.use_interrupts:
+            log.info(f'{self.name}: Waiting on the ap_done interrupt')
+            self.intersect_ip.write(self.ADDR_GIE, 1)
+            self.intersect_ip.write(self.ADDR_IER, 1)
+
+    @property
+    def num_rays(self):
+        ''' Rays of the last compute call '''
+        return self._num_rays
+
+    @property
+    def elapsed(self):
+        ''' Seconds from the start of the last compute call (buffer
+            filling included) until wait saw it finish
+        '''
+        if self.start_time is None or self.finish_time is None:
+            return None
+        return self.finish_time - self.start_time
+
+    def wait(self, timeout=None):
+        ''' Block until the last compute call finishes. Returns False
+            if `timeout` seconds passed first
+        '''
+        if self._streamer is not None:
+            self._streamer.join(timeout)
+            done = not self._streamer.is_alive()
+        else:
+            done = self._wait_hardware(timeout)
+        if done and self.finish_time is None:
+            self.finish_time = time()
+        return done
 
     def is_done(self):
+        if self._streamer is not None:
+            return not self._streamer.is_alive()
+        return self._is_idle()
+
+    def _is_idle(self):
         return self.intersect_ip.read(0x00) == 4
 
-    def compute(self, rays, tri_ids, tris):
-        from pynq import Xlnk
-        xlnk = Xlnk()
+    def compute(self, rays, tri_ids, tris, triangles=None):
+        ''' Start the accelerator. `triangles` may hold TriangleBuffers
+            already filled with tri_ids/tris, otherwise the triangles
+            are copied to the accelerator's own buffers on every call,
+            as the caller may have changed them in place since.
+            Streamed calls return at once too, a thread feeds the
+            batches until is_done
+        '''
         num_tris = len(tris) // 9
         num_rays = len(rays) // 6
+        self._num_rays = num_rays
+        self._streamer = None
+        self.start_time = time()
+        self.finish_time = None
+        self.fill_time = 0.0
+        self.drain_time = 0.0
+
+        log.info(f'{self.name}: Preparing shared arrays')
+        self._set_triangles(tri_ids, tris, triangles)
+
+        if self.batch_size and num_rays > self.batch_size:
+            log.info(f'{self.name}: Streaming {num_rays} rays in batches of {self.batch_size}')
+            self._stream_results = None
+            self._stream_error = None
+            self._streamer = threading.Thread(target=self._stream, args=(rays,))
+            self._streamer.daemon = True
+            self._streamer.start()
+            return
+
+        self._fill_rays(0, rays)
+        log.info(f'Starting co-processor {self.name}')
+        self._start(0, num_rays)
 
-        self._out_ids   = None
-        self._out_inter = None
-        self._tids = None
-        self._tris = None
-        self._rays = None
+    def get_results(self):
+        if self._streamer is not None:
+            self._streamer.join()
+            if self._stream_error is not None:
+                raise self._stream_error
+            return self._stream_results
+        # copies, the buffers are overwritten by the next compute
+        ti = time()
+        out_ids, out_inter = self._outputs(0, self._num_rays)
+        results = (np.array(out_ids), np.array(out_inter))
+        self.drain_time += time() - ti
+        return results
 
-        log.info(f'{self.name}: Allocating shared input arrays')
-        self._tids = xlnk.cma_array(shape=(num_tris,), dtype=np.int32)
-        self._tris = xlnk.cma_array(shape=(num_tris*9,), dtype=np.float32)
-        self._rays = xlnk.cma_array(shape=(num_rays*6,), dtype=np.float32)
+    def release(self):
+        self.buffers.release()
 
-        log.info(f'{self.name}: Allocating shared output arrays')
-        self._out_ids   = xlnk.cma_array(shape=(num_rays,), dtype=np.int32)
-        self._out_inter = xlnk.cma_array(shape=(num_rays,), dtype=np.float32)
+    def _set_triangles(self, tri_ids, tris, triangles):
+        num_tris = len(tris) // 9
+        ti = time()
+        if triangles is not None:
+            tids_buffer, tris_buffer = triangles.tids, triangles.tris
+        else:
+            tids_buffer = self.buffers.get('tids', num_tris, np.int32)
+            tris_buffer = self.buffers.get('tris', num_tris*9, np.float32)
+            tids_buffer[:num_tris] = tri_ids
+            tris_buffer[:num_tris*9] = tris
+            self.fill_time += time() - ti
+            log.info(f'{self.name}: Triangle arrays filled in {time() - ti} seconds')
 
         log.info(f'{self.name}: Setting accelerator input physical addresses')
         self.intersect_ip.write(self.ADDR_I_TNUMBER_DATA, num_tris)
-        self.intersect_ip.write(self.ADDR_I_TDATA_DATA, self._tris.physical_address)
-        self.intersect_ip.write(self.ADDR_I_TIDS_DATA,  self._tids.physical_address)
-
-        self.intersect_ip.write(self.ADDR_I_RNUMBER_DATA, num_rays)
-        self.intersect_ip.write(self.ADDR_I_RDATA_DATA, self._rays.physical_address)
-        
-        self.intersect_ip.write(self.ADDR_O_TIDS_DATA, self._out_ids.physical_address)
-        self.intersect_ip.write(self.ADDR_O_TINTERSECTS_DATA, self._out_inter.physical_address)
-
-        ti = time()
-        log.info(f'{self.name}: Filling input memory arrays')
-        for t in range(num_tris):
-            self._tids[t] = tri_ids[t]
-            for i in range(9):
-                self._tris[t*9+i] = tris[t*9+i]
-        log.info(f'{self.name}: Triangle arrays filled in {time() - ti} seconds')
+        self.intersect_ip.write(self.ADDR_I_TDATA_DATA, tris_buffer.physical_address)
+        self.intersect_ip.write(self.ADDR_I_TIDS_DATA,  tids_buffer.physical_address)
 
+    def _fill_rays(self, slot, rays):
+        ''' Copy rays to the input buffer of a slot and make sure the
+            slot's output buffers fit them
+        '''
         ti = time()
-        for i, r in enumerate(rays):
-            self._rays[i] = r
+        num_rays = len(rays) // 6
+        rays_buffer = self.buffers.get(f'rays{slot}', num_rays*6, np.float32)
+        rays_buffer[:num_rays*6] = rays
+        self.buffers.get(f'out_ids{slot}', num_rays, np.int32)
+        self.buffers.get(f'out_inter{slot}', num_rays, np.float32)
+        self.fill_time += time() - ti
         log.info(f'{self.name}: Ray arrays filled in {time() - ti} seconds')
 
-        log.info(f'Starting co-processor {self.name}')
-        self.intersect_ip.write(0x00, 1)
+    def _outputs(self, slot, num_rays):
+        buffers = self.buffers.buffers
+        return (
+            buffers[f'out_ids{slot}'][:num_rays],
+            buffers[f'out_inter{slot}'][:num_rays])
 
-    def get_results(self):
-
-        return (self._out_ids.tolist(), self._out_inter.tolist())
+    def _start(self, slot, num_rays):
+        buffers = self.buffers.buffers
+        self.intersect_ip.write(self.ADDR_I_RNUMBER_DATA, num_rays)
+        self.intersect_ip.write(self.ADDR_I_RDATA_DATA, buffers[f'rays{slot}'].physical_address)
+        
+        self.intersect_ip.write(self.ADDR_O_TIDS_DATA, buffers[f'out_ids{slot}'].physical_address)
+        self.intersect_ip.write(self.ADDR_O_TINTERSECTS_DATA, buffers[f'out_inter{slot}'].physical_address)
 
+        self.intersect_ip.write(0x00, 1)
 
-    
-def ray_triangle_intersect(self, ray, tri):
-    ''' Implementation of the Möller algorithm for
-        ray-triangle intersection calculation
+    def _stream(self, rays):
+        ''' Run the rays batch by batch. The next batch is copied to
+            a free slot while the current one computes and the results
+            of a batch are copied out while the following one computes
+        '''
+        try:
+            num_rays = len(rays) // 6
+            out_ids = np.empty(num_rays, dtype=np.int32)
+            out_inter = np.empty(num_rays, dtype=np.float32)
+            running = None
+            for index, begin in enumerate(range(0, num_rays, self.batch_size)):
+                slot = index % self.num_buffers
+                count = min(self.batch_size, num_rays - begin)
+                self._fill_rays(slot, rays[begin*6 : (begin + count)*6])
+                if running is not None:
+                    self._wait_hardware()
+                self._start(slot, count)
+                if running is not None:
+                    self._drain(running, out_ids, out_inter)
+                running = (slot, begin, count)
+            self._wait_hardware()
+            self._drain(running, out_ids, out_inter)
+            self._stream_results = (out_ids, out_inter)
+            self.finish_time = time()
+        except Exception as error:
+            log.exception(f'{self.name}: Streaming failed')
+            self._stream_error = error
+
+    def _drain(self, batch, out_ids, out_inter):
+        ti = time()
+        slot, begin, count = batch
+        ids, intersects = self._outputs(slot, count)
+        out_ids[begin : begin + count] = ids
+        out_inter[begin : begin + count] = intersects
+        self.drain_time += time() - ti
+
+    def _wait_hardware(self, timeout=None):
+        if self.use_interrupts:
+            return self._wait_interrupt(timeout)
+        return wait_until(self._is_idle, timeout)
+
+    def _wait_interrupt(self, timeout=None):
+        import asyncio
+        # pynq interrupts are awaited on an event loop, each
+        # accelerator keeps its own for the thread waiting on it
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        deadline = None if timeout is None else time() + timeout
+        while not self._is_idle():
+            remaining = self.INTERRUPT_SLICE
+            if deadline is not None:
+                remaining = min(remaining, deadline - time())
+                if remaining <= 0:
+                    return False
+            try:
+                self._loop.run_until_complete(asyncio.wait_for(
+                    self.intersect_ip.interrupt.wait(), remaining))
+            except asyncio.TimeoutError:
+                pass
+        # ap_done stays flagged until it is toggled back
+        self.intersect_ip.write(self.ADDR_ISR, 1)
+        return True
+
+
+def intersect_tiles(rays, tri_ids, tris, ray_tile=256, tri_tile=1024):
+    ''' Möller-Trumbore test of every ray against every triangle as
+        NumPy array operations. Rays and triangles are processed in
+        tiles of ray_tile x tri_tile pairs, which bounds the memory of
+        the temporaries (about 100 bytes per pair). Follows the C++
+        tracer: computes in double precision, keeps hits farther than
+        EPSILON and the lowest triangle on ties, and returns the same
+        (ids, distances) arrays, -1/1e9 for rays that hit nothing
     '''
-    origin, direction = np.array(ray[:3]), np.array(ray[3:6])
-    v0, v1, v2 = (np.array(tri[3*x: 3*x+3]) for x in range(3))
-    EPSILON = 1.0e-5
-
-    edge1 = v1 - v0
-    edge2 = v2 - v0
-
-    h = np.cross(direction, edge2)
-    a = np.dot(edge1, h)
-
-    if -EPSILON < a < EPSILON:
-        return None
-
-    f = 1.0 / a
-    s = origin - v0
-    u = f * np.dot(s, h)
-
-    if not 0.0 <= u <= 1.0:
-        return None
-
-    q = np.cross(s, edge1)
-    v = f * np.dot(direction, q)
-
-    if v < 0.0 or u + v > 1.0:
+    EPSILON = 1.0e-6
+    MAX_DISTANCE = 1.0e9
+    out_type = rays.dtype if rays.dtype in (np.float32, np.float64) else np.float64
+    rays = np.asarray(rays, dtype=np.float64).reshape(-1, 6)
+    tris = np.asarray(tris, dtype=np.float64).reshape(-1, 9)
+    tri_ids = np.asarray(tri_ids, dtype=np.int32)
+    num_rays, num_tris = len(rays), len(tris)
+
+    out_ids = np.full(num_rays, -1, dtype=np.int32)
+    out_inter = np.full(num_rays, MAX_DISTANCE)
+
+    # per triangle terms, as columns
+    v0 = tris[:, 0:3].T
+    edge1 = (tris[:, 3:6] - tris[:, 0:3]).T
+    edge2 = (tris[:, 6:9] - tris[:, 0:3]).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for r0 in range(0, num_rays, ray_tile):
+            # ray components as (rays, 1) columns broadcast over triangles
+            ox, oy, oz, dx, dy, dz = (c[:, None] for c in rays[r0 : r0 + ray_tile].T)
+            best_t = out_inter[r0 : r0 + ray_tile]
+            best_id = out_ids[r0 : r0 + ray_tile]
+
+            for t0 in range(0, num_tris, tri_tile):
+                t1 = t0 + tri_tile
+                ax, ay, az = v0[:, t0:t1]
+                e1x, e1y, e1z = edge1[:, t0:t1]
+                e2x, e2y, e2z = edge2[:, t0:t1]
+
+                hx = dy * e2z - dz * e2y
+                hy = dz * e2x - dx * e2z
+                hz = dx * e2y - dy * e2x
+                a = e1x * hx + e1y * hy + e1z * hz
+                f = 1.0 / a
+
+                sx, sy, sz = ox - ax, oy - ay, oz - az
+                u = f * (sx * hx + sy * hy + sz * hz)
+
+                qx = sy * e1z - sz * e1y
+                qy = sz * e1x - sx * e1z
+                qz = sx * e1y - sy * e1x
+                v = f * (dx * qx + dy * qy + dz * qz)
+                t = f * (e2x * qx + e2y * qy + e2z * qz)
+
+                hit = (np.abs(a) >= EPSILON) & (u >= 0.0) & (u <= 1.0) \
+                    & (v >= 0.0) & (u + v <= 1.0) & (t > EPSILON)
+                t = np.where(hit, t, np.inf)
+                # argmin takes the first triangle on ties, as the C++ loop
+                closest = np.argmin(t, axis=1)
+                closest_t = t[np.arange(len(t)), closest]
+                better = closest_t < best_t
+                best_t[better] = closest_t[better]
+                best_id[better] = tri_ids[t0 + closest[better]]
+
+    return (out_ids, out_inter.astype(out_type))
+
+
+def load_cpp_tracer():
+    ''' The compiled tracer module, or None when tracer.so was not
+        built for this machine
+    '''
+    try:
+        import application.bindings.tracer as cpp_tracer
+    except ImportError:
         return None
-
-    t = f * np.dot(edge2, q)
-
-    if EPSILON < t < 1e9:
-        return t
+    return cpp_tracer
 
 
 class TracerCPU(TracerPYNQ):
-    def __init__(self, use_multicore: bool = True, use_python: bool = False):
+    def __init__(self, use_multicore: bool = True, use_python: bool = False,
+                 use_bvh: bool = False, use_simd: bool = False):
+        if not use_python and load_cpp_tracer() is None:
+            log.warning('Compiled tracer not available, using the NumPy implementation')
+            use_python = True
         self.use_python = use_python
         self.use_multicore = use_multicore
+        self.use_bvh = use_bvh
+        self.use_simd = use_simd and not use_bvh
+        self._bvh = None
+        self._bvh_tris = None
+        self._packed = None
+        self._packed_tris = None
 
     def compute(self, rays, tri_ids, tris):
         ''' Call the ray-triangle intersection calculation
@@ -137,10 +501,22 @@ class TracerCPU(TracerPYNQ):
             faster to pass the ids to the lower level method,
             but I'll change it later
         '''
-        intersects, ids = [], []
+        rays, tri_ids, tris = as_arrays(rays, tri_ids, tris)
 
         if not self.use_python:
-            if self.use_multicore: 
+            if self.use_bvh:
+                # CPP BVH traversal, built once per triangle set
+                ids, intersects = self._compute_bvh(
+                    rays,
+                    tri_ids,
+                    tris)
+            elif self.use_simd:
+                # float32 packet kernel, triangles packed once per set
+                ids, intersects = self._compute_simd(
+                    rays,
+                    tri_ids,
+                    tris)
+            elif self.use_multicore: 
                 # CPP Code with OpenMP parallelism
                 ids, intersects = self._compute_multicore(
                     rays,
@@ -152,57 +528,110 @@ class TracerCPU(TracerPYNQ):
                     rays,
                     tri_ids,
                     tris)
-        else: # using the pure python implementation
-            ids, intersects = self._compute_python(
-                np.array(rays), 
-                np.array(tris))
-            intersects = intersects.tolist()
-            ids = list(map(lambda x : tri_ids[x] if x != -1 else -1, ids))
+        else: # using the NumPy implementation
+            ids, intersects = self._compute_python(rays, tri_ids, tris)
 
         return (ids, intersects)
 
+    def occluded(self, rays, max_distances, tri_ids, tris):
+        ''' Any-hit query, see TracerPYNQ.occluded. The compiled
+            kernels stop testing a ray at its first hit
+        '''
+        rays, tri_ids, tris = as_arrays(rays, tri_ids, tris)
+        if self.use_python:
+            return super().occluded(rays, max_distances, tri_ids, tris)
+
+        import application.bindings.tracer as cpp_tracer
+        if self.use_bvh:
+            if self._bvh is None or self._bvh_tris is not tris:
+                self.build_bvh(tri_ids, tris)
+            structure = self._bvh
+        elif self.use_simd:
+            if self._packed is None or self._packed_tris is not tris:
+                self.pack_triangles(tri_ids, tris)
+            structure = self._packed
+            rays = np.ascontiguousarray(rays, dtype=np.float32)
+        else:
+            structure = None
+        max_distances = np.ascontiguousarray(max_distances, dtype=rays.dtype)
+
+        if structure is None:
+            if self.use_multicore:
+                return cpp_tracer.occludedArraysParallel(rays, max_distances, tris)
+            return cpp_tracer.occludedArrays(rays, max_distances, tris)
+        if self.use_multicore:
+            return structure.occludedArraysParallel(rays, max_distances)
+        return structure.occludedArrays(rays, max_distances)
+
+    def prepare(self, tri_ids, tris, derived):
+        if derived is None:
+            derived = {}
+        if self.use_bvh and not self.use_python:
+            bvh = derived.get('bvh')
+            if bvh is None:
+                bvh = derived['bvh'] = self.build_bvh(tri_ids, tris)
+            self._bvh = bvh
+            self._bvh_tris = tris
+        if self.use_simd and not self.use_python:
+            packed = derived.get('packed')
+            if packed is None:
+                packed = derived['packed'] = self.pack_triangles(tri_ids, tris)
+            self._packed = packed
+            self._packed_tris = tris
+
+    def build_bvh(self, tri_ids, tris):
+        ''' Build the bounding volume hierarchy of a triangle set.
+            The structure is kept and reused by the following
+            compute calls made with the same triangle list
+        '''
+        import application.bindings.tracer as cpp_tracer
+        ti = time()
+        self._bvh = cpp_tracer.BVH(tri_ids, tris)
+        self._bvh_tris = tris
+        log.info(f'BVH with {self._bvh.numNodes} nodes built in {time() - ti} seconds')
+        return self._bvh
+
+    def _compute_bvh(self, rays, tri_ids, tris):
+        if self._bvh is None or self._bvh_tris is not tris:
+            self.build_bvh(tri_ids, tris)
+        if self.use_multicore:
+            return self._bvh.computeArraysParallel(rays)
+        return self._bvh.computeArrays(rays)
+
+    def pack_triangles(self, tri_ids, tris):
+        ''' Lay out a triangle set for the SIMD kernel, which tests
+            one ray against cpp_tracer.simdWidth() triangles at once.
+            Kept for the following calls with the same triangles
+        '''
+        import application.bindings.tracer as cpp_tracer
+        ti = time()
+        self._packed = cpp_tracer.PackedTriangles(tri_ids, tris)
+        self._packed_tris = tris
+        log.info(f'Packed {self._packed.numTriangles} triangles for '
+                 f'{cpp_tracer.simdTarget()} in {time() - ti} seconds')
+        return self._packed
+
+    def _compute_simd(self, rays, tri_ids, tris):
+        if self._packed is None or self._packed_tris is not tris:
+            self.pack_triangles(tri_ids, tris)
+        rays = np.ascontiguousarray(rays, dtype=np.float32)
+        if self.use_multicore:
+            return self._packed.computeArraysParallel(rays)
+        return self._packed.computeArrays(rays)
+
     def _compute_cpp(self, rays, tri_ids, tris):
         import application.bindings.tracer as cpp_tracer
-        return cpp_tracer.compute(rays, tri_ids, tris)
+        return cpp_tracer.computeArrays(rays, tri_ids, tris)
 
     def _compute_multicore(self, rays, tri_ids, tris):
         import application.bindings.tracer as cpp_tracer
-        return cpp_tracer.computeParallel(rays, tri_ids, tris)
+        return cpp_tracer.computeArraysParallel(rays, tri_ids, tris)
 
-    def _compute_python(self, rays, triangles):
+    def _compute_python(self, rays, tri_ids, tris):
         ''' Compute the intersection of a set of rays against
-            a set of triangles
+            a set of triangles with the NumPy implementation
         '''
-        # data structures info
-        ray_attrs = 6
-        num_rays = len(rays) // ray_attrs
-        tri_attrs = 9
-        num_tris = len(triangles) // tri_attrs
-        # output array
-        out_inter = np.full(num_rays, 1.0e9)
-        out_ids   = np.full(num_rays, -1)
-        # for each ray
-        for ray in range(num_rays):
-            # select ray
-            ray_base = ray * ray_attrs
-            closest_tri, closest_dist = -1, self.MAX_DISTANCE
-            ray_data = rays[ray_base : ray_base + ray_attrs]
-
-            for tri in range(num_tris):
-                tri_base = tri * tri_attrs
-            
-                tri_data = triangles[tri_base : tri_base + tri_attrs]
-            
-                dist = ray_triangle_intersect(ray_data, tri_data)
-            
-                if dist is not None and dist < closest_dist:
-                    closest_dist = dist
-                    closest_tri  = tri
-
-            out_inter[ray] = closest_dist
-            out_ids[ray]   = closest_tri
-
-        return (out_ids, out_inter)
+        return intersect_tiles(rays, tri_ids, tris)
 
 class Counter():
     next_id = 0
@@ -238,19 +667,34 @@ def divide_tasks(rays, max_task_size):
             task_data = rays[task_start : task_end]
         else:
             task_data = rays[task_start : ]
-        ray_tasks.append(Task(task_data))
+        ray_tasks.append(Task(task_data, i - 1))
     rays = []
     return ray_tasks
 
 
 class TracerFPGA(TracerPYNQ):
-    def __init__(self, overlay_filename: str, use_multi_fpga: bool = False):
-        from pynq import Overlay
+    def __init__(self, overlay_filename: str, use_multi_fpga: bool = False,
+                 overlay=None, xlnk=None, batch_size=None, num_buffers=2,
+                 use_interrupts=False):
+        ''' `overlay` and `xlnk` replace the pynq ones when given,
+            which is how the simulated accelerators are plugged in.
+            `batch_size` and `num_buffers` set up the streaming of
+            large calls and `use_interrupts` the completion wait,
+            see XIntersectFPGA
+        '''
         self.use_multi_fpga = use_multi_fpga
         self.accelerators = []
+        self.xlnk = xlnk if xlnk is not None else pynq_xlnk()
+        self._triangles = None
+        # buffers refilled by every request without a cached scene
+        self._uncached = None
+        # accelerators given work by the last compute call
+        self._active = []
 
         #overlay = Overlay('/home/xilinx/adrianno/intersect_fpga_x2.bit')
-        overlay = Overlay(overlay_filename)
+        if overlay is None:
+            from pynq import Overlay
+            overlay = Overlay(overlay_filename)
         log.info('Finished loading overlay')
         
         accel_names = [x for x in dir(overlay) if 'intersect' in x]
@@ -259,10 +703,13 @@ class TracerFPGA(TracerPYNQ):
             # detecting all accelerators in current overlay
             # getting the attribute from overlay
             self.accelerators = [
-                XIntersectFPGA(getattr(overlay, attr), attr) for attr in accel_names]
+                XIntersectFPGA(getattr(overlay, attr), attr, self.xlnk, batch_size, num_buffers,
+                    use_interrupts)
+                for attr in accel_names]
         else:
             self.accelerators.append(
-                XIntersectFPGA(getattr(overlay, accel_names[0]), 'accel_0'))
+                XIntersectFPGA(getattr(overlay, accel_names[0]), 'accel_0', self.xlnk,
+                    batch_size, num_buffers, use_interrupts))
 
         self.num_accelerators = len(self.accelerators)
         log.info(f'Detected {self.num_accelerators} accelerators')
@@ -277,20 +724,106 @@ class TracerFPGA(TracerPYNQ):
         #         XIntersectFPGA(overlay.intersectFPGA_1, 'accel_1'))
 
 
+    def prepare(self, tri_ids, tris, derived):
+        ti = time()
+        if derived is None:
+            # requests without a cached scene refill the same buffers
+            if self._uncached is None:
+                self._uncached = TriangleBuffers(self.xlnk, tri_ids, tris)
+            else:
+                self._uncached.fill(tri_ids, tris)
+            triangles = self._uncached
+        else:
+            triangles = derived.get('fpga')
+            if triangles is not None:
+                self._triangles = triangles
+                return
+            triangles = derived['fpga'] = TriangleBuffers(self.xlnk, tri_ids, tris)
+        log.info(f'Triangle buffers filled in {time() - ti} seconds')
+        self._triangles = triangles
+
+    def release(self):
+        for accel in self.accelerators:
+            accel.release()
+        if self._uncached is not None:
+            self._uncached.release()
+            self._uncached = None
+
+    def occluded(self, rays, max_distances, tri_ids, tris):
+        ''' Shadow rays on the accelerators, which only find the
+            closest hit
+        '''
+        self.compute(rays, tri_ids, tris)
+        self.wait()
+        ids, intersects = self.get_results()
+        return hits_within(ids, intersects, max_distances)
+
+    def prepared_triangles(self, tris):
+        ''' Buffers filled by prepare for this triangle list, if any '''
+        if self._triangles is not None and self._triangles.source is tris:
+            return self._triangles
+        return None
+
     def is_done(self):
         all_done = True
-        for accel in self.accelerators:
+        for accel in self._active:
             all_done = all_done and accel.is_done()
         return all_done
 
+    def wait(self, timeout=None):
+        ''' Block until every accelerator finished the last compute
+            call and log the time each one took. Returns False if
+            `timeout` seconds passed first
+        '''
+        deadline = None if timeout is None else time() + timeout
+        for accel in self._active:
+            remaining = None if deadline is None else max(0.0, deadline - time())
+            if not accel.wait(remaining):
+                return False
+        for name, elapsed in self.finish_times().items():
+            log.info(f'{name} finished in {elapsed} seconds')
+        return True
+
+    def finish_times(self):
+        ''' Seconds each accelerator took in the last compute call '''
+        return {accel.name: accel.elapsed for accel in self._active}
+
+    def active(self):
+        ''' Accelerators given work by the last compute call '''
+        return list(self._active)
+
+    def elapsed(self):
+        times = [accel.elapsed for accel in self._active if accel.elapsed is not None]
+        return max(times) if times else 0.0
+
+    def compute_async(self, rays, tri_ids, tris):
+        ''' Run compute, wait and get_results in a thread. Returns a
+            concurrent.futures.Future with the (ids, intersects), so
+            callers can block on result() or add_done_callback
+        '''
+        from concurrent.futures import Future
+        future = Future()
+        def run():
+            try:
+                self.compute(rays, tri_ids, tris)
+                self.wait()
+                future.set_result(self.get_results())
+            except Exception as error:
+                future.set_exception(error)
+        waiter = threading.Thread(target=run)
+        waiter.daemon = True
+        waiter.start()
+        return future
+
     def get_results(self):
         
         ids, intersects = [], []
-        if self.use_multi_fpga:
-            for accel in self.accelerators:
-                res = accel.get_results()
-                ids += res[0]
-                intersects += res[1]
+        if not self._active:
+            ids, intersects = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        elif self.use_multi_fpga:
+            results = [accel.get_results() for accel in self._active]
+            ids = np.concatenate([res[0] for res in results])
+            intersects = np.concatenate([res[1] for res in results])
 
             # return (ids, intersects)
             # ids0, intersects0 = self.accelerators[0].get_results()
@@ -319,10 +852,12 @@ class TracerFPGA(TracerPYNQ):
             # dividing the rays into equal sized tasks
             num_rays = len(rays) // 6
             tasks = divide_tasks(rays, 
-                int(np.ceil(num_rays/self.num_accelerators)))
+                max(1, int(np.ceil(num_rays/self.num_accelerators))))
             # one task for each accelerator
+            self._active = self.accelerators[:len(tasks)]
             for accel, task in zip(self.accelerators, tasks):
-                accel.compute(task.ray_data, tri_ids, tris)
+                accel.compute(task.ray_data, tri_ids, tris,
+                    self.prepared_triangles(tris))
 
 
             # num_rays = len(rays) // 6
@@ -336,5 +871,7 @@ class TracerFPGA(TracerPYNQ):
             #     tri_ids, 
             #     tris)
         else:
-            self.accelerators[0].compute(rays, tri_ids, tris)
+            self._active = self.accelerators[:1]
+            self.accelerators[0].compute(rays, tri_ids, tris,
+                self.prepared_triangles(tris))
         
\ No newline at end of file
@@ -0,0 +1,76 @@
+''' Whole frames rendered on the edge server.
+
+    The client sends the camera and the shading parameters instead of
+    rays, and the server runs the frame as waves of rays traced by its
+    tracers: the primary rays of every pixel, then, on the compacted
+    set of pixels that hit something, one wave of shadow rays per
+    light. Only the final pixels go back to the client, which saves the
+    rays upload and one round-trip per wave
+'''
+import numpy as np
+from application.raytracer.scene import Camera, shade_hits, SHADOW_BIAS
+from application.raytracer.material import Matte
+from application.raytracer.light import PointLight
+from application.raytracer.mesh import triangle_normals
+
+
+class FrameRenderer():
+    ''' Per-scene data needed to shade the hits: the normal of every
+        triangle, looked up by triangle id, and the shadow ray bias.
+        Kept with the cached scene by the server
+    '''
+    def __init__(self, tri_ids, tris):
+        tri_ids = np.asarray(tri_ids, dtype=np.int32)
+        tris = np.asarray(tris).reshape(-1, 9)
+        # rows of the triangles sorted by id, to find the hit ones
+        self.order = np.argsort(tri_ids, kind='stable')
+        self.sorted_ids = tri_ids[self.order]
+        self.normals = triangle_normals(tris)
+        size = np.linalg.norm(tris.reshape(-1, 3).max(axis=0) - tris.reshape(-1, 3).min(axis=0)) \
+            if len(tris) else 0.0
+        self.bias = SHADOW_BIAS * size
+
+    @property
+    def nbytes(self):
+        return self.order.nbytes + self.sorted_ids.nbytes + self.normals.nbytes
+
+    def normals_of(self, ids):
+        rows = self.order[np.searchsorted(self.sorted_ids, ids)]
+        return self.normals[rows]
+
+    def render(self, camera, material, lights, closest, occluded=None):
+        ''' Shade the pixels of `camera` as a (vres, hres, 3) uint8
+            image. `closest(rays)` returns the (ids, distances) of
+            flat rays and `occluded(rays, max_distances)` the shadow
+            ray hits; without it the lights are not shadowed
+        '''
+        rays = camera.get_rays(dtype=np.float64)
+        ids, distances = closest(rays.astype(np.float32).reshape(-1))
+        ids = np.asarray(ids)
+        # only the pixels that hit something spawn shadow rays
+        hit = ids != -1
+        colors = shade_hits(
+            rays[hit], np.asarray(distances)[hit], self.normals_of(ids[hit]),
+            material, lights, occluded, self.bias)
+
+        image = np.zeros((camera.vres, camera.hres, 3), dtype=np.uint8)
+        image.reshape(-1, 3)[hit] = np.clip((colors*255).astype('int32'), 0, 255)
+        return image
+
+
+def scene_objects(camera, material, lights):
+    ''' Camera, material and lights of a RENDER request as the
+        raytracer objects (see protocol.recv_render)
+    '''
+    color, diffuse = material
+    return (
+        Camera(*camera),
+        Matte(np.asarray(color, dtype=np.float64), diffuse),
+        [PointLight(light[0:3], light[3:6], light[6]) for light in lights])
+
+
+def light_values(lights):
+    ''' (L, 7) array of the position, color and intensity of point lights '''
+    return np.array([
+        np.concatenate([light.position, light.color, [light.intensity]])
+        for light in lights], dtype=np.float64).reshape(-1, 7)
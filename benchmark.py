@@ -0,0 +1,449 @@
+''' Benchmark of the tracer backends and of the request pipeline.
+
+    Every backend traces the rays of the examples/ scenes and of
+    synthetic sphere meshes of increasing size. For each run the
+    best time of `--repeat` runs is reported as rays/s and millions
+    of ray-triangle tests per second, with the preparation time
+    (BVH build, triangle packing, FPGA buffers), the peak memory
+    allocated while tracing and the number of rays whose hit differs
+    from the reference (examples/expected_intersects.txt for the big
+    example scene, the singlecore backend otherwise). The pipeline
+    stages around tracing are measured per scene: parsing, text and
+    binary serialization, loopback transfer and shading. The results
+    of every scene are also encoded as the text protocol's JSON and
+    with a selection of the binary result encodings, for their size,
+    encoding and decoding time and distance error.
+
+    Results are written as JSON, and --compare prints the speedup
+    against a previous results file:
+
+        python3 benchmark.py --output before.json
+        python3 benchmark.py --compare before.json
+'''
+import os
+import gc
+import sys
+import json
+import socket
+import platform
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import subprocess
+import numpy as np
+import logging as log
+from time import time, strftime
+
+import application.protocol as protocol
+import application.tracers as tracers
+from application.encoding import Encoding, lz4
+from application.raytracer.scene import Scene
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+EXPECTED = {'scene_big_15k_2k': 'expected_intersects.txt'}
+CPU_BACKENDS = ['python', 'singlecore', 'multicore', 'simd', 'bvh']
+BACKENDS = CPU_BACKENDS + ['fpga-sim']
+# above this many ray-triangle tests the NumPy backend is skipped
+PYTHON_MAX_TESTS = 2e8
+# result encodings compared with JSON, (ids, distances, compression)
+ENCODINGS = [
+    ('raw', 'float32', 'none'),
+    ('rle', 'float32', 'none'),
+    ('rle', 'quantized', 'none'),
+    ('raw', 'float32', 'zlib'),
+    ('rle', 'float32', 'zlib'),
+    ('delta', 'float16', 'zlib'),
+    ('rle', 'quantized', 'zlib')]
+if lz4 is not None:
+    ENCODINGS += [('raw', 'float32', 'lz4'), ('rle', 'quantized', 'lz4')]
+
+
+def make_backend(name, args):
+    ''' Tracer for a backend name, or None if it can't run here '''
+    compiled = tracers.load_cpp_tracer() is not None
+    if name == 'python':
+        return tracers.TracerCPU(use_python=True)
+    if not compiled:
+        return None
+    if name == 'singlecore':
+        return tracers.TracerCPU(use_multicore=False)
+    if name == 'multicore':
+        return tracers.TracerCPU(use_multicore=True)
+    if name == 'simd':
+        return tracers.TracerCPU(use_simd=True)
+    if name == 'bvh':
+        return tracers.TracerCPU(use_bvh=True)
+    if name == 'fpga-sim':
+        from application.simulation import SimulatedOverlay, SimulatedXlnk
+        xlnk = SimulatedXlnk()
+        overlay = SimulatedOverlay(xlnk, args.fpga_accelerators, args.fpga_throughput)
+        return tracers.TracerFPGA('', use_multi_fpga=True, overlay=overlay, xlnk=xlnk)
+    raise ValueError(f'Unknown backend {name}')
+
+
+def trace(backend, rays, tri_ids, tris):
+    if isinstance(backend, tracers.TracerFPGA):
+        backend.compute(rays, tri_ids, tris)
+        backend.wait()
+        return backend.get_results()
+    return backend.compute(rays, tri_ids, tris)
+
+
+def sphere_obj(filename, num_triangles):
+    ''' Write a UV sphere of about `num_triangles` triangles '''
+    slices = max(3, int(np.sqrt(num_triangles)))
+    stacks = max(2, num_triangles // (2 * slices))
+    theta = np.linspace(0, np.pi, stacks + 1)
+    phi = np.linspace(0, 2 * np.pi, slices, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing='ij')
+    vertices = np.stack([np.sin(t) * np.cos(p), np.sin(t) * np.sin(p), np.cos(t)], axis=-1)
+    index = np.arange((stacks + 1) * slices).reshape(stacks + 1, slices) + 1
+    a, b = index[:-1], np.roll(index[:-1], -1, axis=1)
+    c, d = index[1:], np.roll(index[1:], -1, axis=1)
+    faces = np.concatenate([
+        np.stack([a, c, b], axis=-1).reshape(-1, 3),
+        np.stack([b, c, d], axis=-1).reshape(-1, 3)])
+    with open(filename, 'w') as file:
+        np.savetxt(file, vertices.reshape(-1, 3), fmt='v %.6f %.6f %.6f')
+        np.savetxt(file, faces, fmt='f %d %d %d')
+    return len(faces)
+
+
+def load_drk(name):
+    ''' Triangles and rays of an example .drk scene, as the server
+        parses them, with the time it took
+    '''
+    with open(os.path.join(EXAMPLES, name + '.drk'), 'rb') as file:
+        text = file.read()
+    ti = time()
+    data = np.fromstring(text, dtype=np.float64, sep=' ')
+    num_tris = int(data[0])
+    tri_end = 2 + num_tris * 10
+    scene = {
+        'name'    : name,
+        'tri_ids' : data[2 : 2 + num_tris].astype(np.int32),
+        'tris'    : data[2 + num_tris : tri_end].astype(np.float32),
+        'rays'    : data[tri_end : ].astype(np.float32),
+        'stages'  : {'parse_text': time() - ti, 'text_bytes': len(text)}}
+    if name in EXPECTED:
+        expected = np.loadtxt(os.path.join(EXAMPLES, EXPECTED[name]), ndmin=2)
+        scene['expected'] = (expected[:, 0].astype(np.int32), expected[:, 1])
+    return scene
+
+
+def load_mesh_scene(name, filename, resolution):
+    ''' Triangles of an OBJ file and the rays of a camera looking
+        at it, timing the OBJ parsing, the cached load and shading
+    '''
+    ti = time()
+    scene = Scene(filename, use_cache=False)
+    parse_time = time() - ti
+    ti = time()
+    Scene(filename, use_cache=True)
+    Scene(filename, use_cache=True)
+    cached_time = time() - ti
+
+    lower, upper = scene.mesh.vertices.min(axis=0), scene.mesh.vertices.max(axis=0)
+    center, size = (lower + upper) / 2, np.linalg.norm(upper - lower)
+    scene.set_camera(resolution, center + np.array([0.0, -1.0, 0.5]) * size,
+        center, np.array([0.0, 0.0, 1.0]), 1.0, 1.0 / max(resolution))
+    tri_ids, tris = scene.get_triangles_array()
+
+    ti = time()
+    text = f'{len(tri_ids)} {resolution[0]*resolution[1]}\n' \
+        + scene.get_triangles_string() + '\n' + scene.camera.get_rays_string()
+    serialize_time = time() - ti
+    return {
+        'name'   : name,
+        'scene'  : scene,
+        'tri_ids': tri_ids,
+        'tris'   : tris,
+        'rays'   : scene.camera.get_rays_array(),
+        'stages' : {
+            'parse_obj'     : parse_time,
+            'load_cached'   : cached_time / 2,
+            'serialize_text': serialize_time,
+            'text_bytes'    : len(text)}}
+
+
+def measure_transfer(scene):
+    ''' Time to send the scene and receive the results with the
+        binary protocol over a loopback connection
+    '''
+    sender, receiver = socket.socketpair()
+    num_rays = len(scene['rays']) // 6
+    ids = np.zeros(num_rays, dtype=np.int32)
+    intersects = np.zeros(num_rays, dtype=np.float32)
+    try:
+        ti = time()
+        thread = threading.Thread(target=protocol.send_scene,
+            args=(sender, scene['tri_ids'], scene['tris'], scene['rays']))
+        thread.start()
+        protocol.expect_frame(receiver, protocol.MSG_SCENE)
+        protocol.recv_scene(receiver)
+        thread.join()
+        scene_time = time() - ti
+
+        ti = time()
+        thread = threading.Thread(target=protocol.send_results,
+            args=(receiver, ids, intersects))
+        thread.start()
+        protocol.recv_results(sender)
+        thread.join()
+        results_time = time() - ti
+    finally:
+        sender.close()
+        receiver.close()
+    num_bytes = scene['tri_ids'].nbytes + scene['tris'].nbytes + scene['rays'].nbytes
+    return {'transfer_scene': scene_time, 'transfer_results': results_time,
+            'binary_bytes': num_bytes}
+
+
+def measure_encodings(name, ids, intersects, repeat=3):
+    ''' Size, best encoding and decoding times and largest distance
+        error of the results as JSON and with each of ENCODINGS
+    '''
+    ids = np.asarray(ids, dtype=np.int32)
+    intersects = np.asarray(intersects, dtype=np.float32)
+    hit = ids != -1
+
+    def best(function):
+        times = []
+        for _ in range(repeat):
+            ti = time()
+            value = function()
+            times.append(time() - ti)
+        return value, min(times)
+
+    # as the text protocol of the server
+    text, encode_time = best(lambda: json.dumps(
+        {'intersections': intersects.tolist(), 'triangles_hit': ids.tolist()}).encode())
+    _, decode_time = best(lambda: {key: np.array(value) for key, value in json.loads(text).items()})
+    rows = [{'scene': name, 'encoding': 'json', 'bytes': len(text),
+             'encode_s': encode_time, 'decode_s': decode_time, 'max_error': 0.0}]
+
+    for fields in ENCODINGS:
+        encoding = Encoding(*fields)
+        data, encode_time = best(lambda: encoding.encode(ids, intersects))
+
+        def decode():
+            view = memoryview(data)
+            offset = [0]
+            def read(size):
+                offset[0] += size
+                return view[offset[0] - size : offset[0]]
+            return encoding.decode(read, len(ids))
+        (decoded_ids, decoded), decode_time = best(decode)
+        if not np.array_equal(decoded_ids, ids):
+            raise AssertionError(f'{encoding} changed the triangle ids')
+        error = np.abs(decoded[hit] - intersects[hit]).max() if hit.any() else 0.0
+        rows.append({'scene': name, 'encoding': '/'.join(fields), 'bytes': len(data),
+                     'encode_s': encode_time, 'decode_s': decode_time, 'max_error': float(error)})
+
+    for row in rows:
+        print(f'{name:22s} {row["encoding"]:22s} {row["bytes"]:10d} B '
+              f'({len(text) / row["bytes"]:6.1f}x smaller than json) encode {row["encode_s"]:.4f} s '
+              f'decode {row["decode_s"]:.4f} s  max error {row["max_error"]:.2e}')
+    return rows
+
+
+def count_mismatches(ids, intersects, reference):
+    ''' Rays whose hit differs from the reference: another triangle
+        or a distance off by more than 1e-4 (relative)
+    '''
+    ref_ids, ref_intersects = reference
+    ids = np.asarray(ids)
+    intersects = np.asarray(intersects, dtype=np.float64)
+    if len(ids) != len(ref_ids):
+        return int(max(len(ids), len(ref_ids)))
+    wrong = ids != ref_ids
+    hit = ~wrong & (ids != -1)
+    wrong[hit] |= np.abs(intersects[hit] - ref_intersects[hit]) > 1e-4 * np.abs(ref_intersects[hit])
+    return int(wrong.sum())
+
+
+def run_backend(name, backend, scene, reference, repeat):
+    rays, tri_ids, tris = scene['rays'], scene['tri_ids'], scene['tris']
+    num_rays, num_tris = len(rays) // 6, len(tri_ids)
+
+    ti = time()
+    derived = {}
+    backend.prepare(tri_ids, tris, derived)
+    prepare_time = time() - ti
+
+    gc.collect()
+    tracemalloc.start()
+    times = []
+    for _ in range(repeat):
+        ti = time()
+        ids, intersects = trace(backend, rays, tri_ids, tris)
+        times.append(time() - ti)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for value in derived.values():
+        getattr(value, 'release', lambda: None)()
+
+    best = min(times)
+    result = {
+        'scene'         : scene['name'],
+        'backend'       : name,
+        'rays'          : num_rays,
+        'triangles'     : num_tris,
+        'seconds'       : best,
+        'rays_per_s'    : num_rays / best,
+        'mtests_per_s'  : num_rays * num_tris / best / 1e6,
+        'prepare_s'     : prepare_time,
+        'peak_mb'       : peak / 2**20,
+        'mismatches'    : None,
+        'reference'     : None}
+    if reference is not None:
+        result['reference'], expected = reference
+        result['mismatches'] = count_mismatches(ids, intersects, expected)
+    return result, (ids, np.asarray(intersects, dtype=np.float64))
+
+
+def benchmark_scene(scene, backends, args):
+    rows = []
+    reference = None
+    if 'expected' in scene:
+        reference = ('expected_intersects.txt', scene['expected'])
+    num_tests = len(scene['rays']) // 6 * len(scene['tri_ids'])
+
+    # the singlecore backend is the reference of the other ones
+    names = sorted(backends, key=lambda name: name != 'singlecore')
+    for name in names:
+        if name == 'python' and num_tests > PYTHON_MAX_TESTS:
+            log.info(f'Skipping python on {scene["name"]} ({num_tests:.0f} tests)')
+            continue
+        backend = make_backend(name, args)
+        if backend is None:
+            log.warning(f'Backend {name} is not available (tracer.so not built)')
+            continue
+        try:
+            row, results = run_backend(name, backend, scene, reference, args.repeat)
+        finally:
+            release = getattr(backend, 'release', None)
+            if release is not None:
+                release()
+        if reference is None and name == 'singlecore':
+            reference = ('singlecore', results)
+        rows.append(row)
+        print(f'{row["scene"]:22s} {name:10s} {row["rays"]:8d} rays {row["triangles"]:7d} tris '
+              f'{row["seconds"]:9.4f} s {row["rays_per_s"]:12.0f} rays/s '
+              f'{row["mtests_per_s"]:9.1f} Mtests/s  prep {row["prepare_s"]:.3f} s '
+              f'peak {row["peak_mb"]:7.1f} MB  mismatches {row["mismatches"]}')
+    return rows
+
+
+def run_stages(scene, results):
+    stages = dict(scene['stages'])
+    stages.update(measure_transfer(scene))
+    ids, intersects = tracers.TracerCPU().compute(scene['rays'], scene['tri_ids'], scene['tris'])
+    results['encodings'] += measure_encodings(scene['name'], ids, intersects)
+    if 'scene' in scene:
+        ti = time()
+        scene['scene'].shade(ids, intersects)
+        stages['shade'] = time() - ti
+    stages['scene'] = scene['name']
+    print(f'{scene["name"]:22s} stages ' + ' '.join(
+        f'{key} {value:.4f}' if isinstance(value, float) else f'{key} {value}'
+        for key, value in stages.items() if key != 'scene'))
+    return stages
+
+
+def environment():
+    cpp_tracer = tracers.load_cpp_tracer()
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit'    : commit,
+        'date'      : strftime('%Y-%m-%d %H:%M:%S'),
+        'machine'   : platform.machine(),
+        'processor' : platform.processor(),
+        'cpus'      : os.cpu_count(),
+        'python'    : platform.python_version(),
+        'numpy'     : np.__version__,
+        'simd'      : cpp_tracer.simdTarget() if cpp_tracer is not None
+                      and hasattr(cpp_tracer, 'simdTarget') else None}
+
+
+def compare(results, filename):
+    ''' Print the speedup of every (scene, backend) run against the
+        same run in a previous results file
+    '''
+    with open(filename) as file:
+        previous = json.load(file)
+    before = {(row['scene'], row['backend']): row for row in previous['runs']}
+    print(f'Compared with {filename} (commit {previous["environment"].get("commit")})')
+    for row in results['runs']:
+        old = before.get((row['scene'], row['backend']))
+        if old is None:
+            continue
+        print(f'{row["scene"]:22s} {row["backend"]:10s} {old["seconds"]:9.4f} s -> '
+              f'{row["seconds"]:9.4f} s  x{old["seconds"] / row["seconds"]:.2f}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--scenes', nargs='+',
+        default=['scene_tiny_2_3', 'scene_small_10_2k', 'scene_big_15k_2k', 'bunny_2k'],
+        help='example .drk scenes and .obj meshes, by name')
+    parser.add_argument('--sizes', nargs='*', type=int, default=[2000, 8000, 32000, 128000],
+        help='triangles of the synthetic sphere meshes')
+    parser.add_argument('--res', type=int, nargs=2, default=[160, 120],
+        help='camera resolution for the meshes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--fpga-accelerators', type=int, default=2)
+    parser.add_argument('--fpga-throughput', type=float, default=None,
+        help='ray-triangle tests per second of each simulated accelerator')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='previous results file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log.basicConfig(level=log.WARNING, format='%(levelname)s: %(message)s')
+    results = {'environment': environment(), 'runs': [], 'stages': [], 'encodings': []}
+    print(json.dumps(results['environment']))
+
+    with tempfile.TemporaryDirectory() as directory:
+        sources = []
+        for name in args.scenes:
+            if os.path.exists(os.path.join(EXAMPLES, name + '.drk')):
+                sources.append(lambda name=name: load_drk(name))
+            else:
+                path = os.path.join(directory, name + '.obj')
+                with open(os.path.join(EXAMPLES, name + '.obj'), 'rb') as source, \
+                        open(path, 'wb') as copy:
+                    copy.write(source.read())
+                sources.append(lambda name=name, path=path:
+                    load_mesh_scene(name, path, tuple(args.res)))
+        for size in args.sizes:
+            path = os.path.join(directory, f'sphere_{size}.obj')
+            sphere_obj(path, size)
+            sources.append(lambda size=size, path=path:
+                load_mesh_scene(f'sphere_{size}', path, tuple(args.res)))
+
+        for source in sources:
+            scene = source()
+            results['stages'].append(run_stages(scene, results))
+            results['runs'] += benchmark_scene(scene, args.backends, args)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    print(f'Results written to {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+    failed = [row for row in results['runs'] if row['mismatches'] and row['backend'] != 'python']
+    return 1 if any(row['reference'] == 'expected_intersects.txt' for row in failed) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
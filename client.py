@@ -3,7 +3,10 @@ import sys
 import json
 import socket
 import struct
+import numpy as np
 import logging as log
+import application.protocol as protocol
+import application.meshcache as meshcache
 from application.parser import Parser
 
 class Session:
@@ -24,20 +27,57 @@ class Session:
 		for i in range(self.num_rays):
 			yield self.input_file.readline()
 
+	def get_arrays(self, use_cache=True):
+		''' Triangle ids, triangles and rays of the session file as
+			the arrays sent by the binary protocol. With `use_cache`
+			they are compiled once into a cache next to the file
+		'''
+		if use_cache:
+			arrays = meshcache.load(self.input_filename, parse_session_file)
+		else:
+			arrays = parse_session_file(self.input_filename)
+		return (arrays['triangle_ids'], arrays['triangles'], arrays['rays'])
+
+
+def parse_session_file(filename):
+	''' Parse a .drk file in one pass: the number of triangles and
+		rays, the triangle ids, 9 coordinates per triangle and 6
+		values (origin, direction) per ray. Like the edge node, every
+		ray after the triangles is used, whatever the header says
+	'''
+	with open(filename, 'rb') as file:
+		data = np.fromstring(file.read(), dtype=np.float64, sep=' ')
+	num_tris = int(data[0])
+	tri_end = 2 + num_tris*10
+	return {
+		'triangle_ids': data[2 : 2 + num_tris].astype(np.int32),
+		'triangles'   : data[2 + num_tris : tri_end].astype(np.float32),
+		'rays'        : data[tri_end : ].astype(np.float32)}
+
+
 class RendererClient:
 	'''	Class responsible for the DarkRenderer client behavior.
 		This includes the TCP requests to the Fog/Cloud, task 
 		sending and receiving the results.
 	'''
 	def __init__(self, input_filename=None, output_filename=None, config=None):
-		self.sock = socket.socket(
-			socket.AF_INET, 
-			socket.SOCK_STREAM)
+		self.sock = None
 		self.config = config
 		
 		edge_ip   = config['edge']['ip']
 		edge_port = config['edge']['port']
 		self.edge_addr = (edge_ip, edge_port)
+		# 'binary' or 'text', the text protocol is kept for older servers
+		self.protocol = config['edge'].get('protocol', 'text')
+		# let the edge node reuse geometry it already has (binary only)
+		self.use_scene_cache = config['edge'].get('scene-cache', True)
+		# receive the results in chunks while they are computed (binary only)
+		self.use_streaming = config['edge'].get('stream', False)
+		# send the camera instead of its rays, the edge node generates
+		# them (binary only)
+		self.send_camera = config['edge'].get('camera-rays', False)
+		# compact encoding of the results (binary only)
+		self.encoding = protocol.Encoding.from_config(config['edge'].get('result-encoding'))
 
 		log.info(f"Reading filename {input_filename}")
 		if input_filename != None:
@@ -47,22 +87,194 @@ class RendererClient:
 
 	def _connect(self):
 		log.info(f'Connecting to edge node {self.edge_addr[0]}:{self.edge_addr[1]}')
+		self.sock = socket.socket(
+			socket.AF_INET, 
+			socket.SOCK_STREAM)
 		self.sock.connect(self.edge_addr)
 
 	def _cleanup(self):
 		self.sock.close()
 
 	def _send(self, data):
-		self.sock.send(data)
+		self.sock.sendall(data)
 
 	def _recv(self, size):
 		msg = self.sock.recv(size)
 		return msg
 
-	def compute_scene(self, scene):
+	def compute_scene(self, scene, on_chunk=None):
+		''' Request the closest hits of the scene camera rays.
+			Returns a dict with the 'triangles_hit' and
+			'intersections' of each pixel. `on_chunk(first, ids,
+			intersects)` is called with every range of results as it
+			arrives when streaming, or with all of them at the end
+		'''
 		# connect to the edge node
 		self._connect()
 
+		if self.protocol == 'binary':
+			result = self._compute_scene_binary(scene, on_chunk)
+		else:
+			result = self._compute_scene_text(scene)
+
+		self._cleanup()
+		if on_chunk is not None and not self._streams():
+			on_chunk(0, result['triangles_hit'], result['intersections'])
+		return result
+
+	def compute_occlusion(self, tri_ids, tris, rays, max_distances):
+		''' Any-hit query for shadow rays (binary protocol only).
+			Returns a boolean array telling for each ray if it hits
+			a triangle closer than its maximum distance
+		'''
+		if self.protocol != 'binary':
+			raise ValueError('Occlusion queries need the binary protocol')
+		self._connect()
+		try:
+			flags = protocol.FLAG_OCCLUSION
+			if self.use_scene_cache:
+				protocol.send_cached_scene(self.sock, tri_ids, tris, rays, flags=flags)
+			else:
+				protocol.send_scene(self.sock, tri_ids, tris, rays, flags)
+			protocol.send_max_distances(self.sock, max_distances)
+			occluded, compute_time = protocol.recv_occlusion(self.sock)
+			log.info(f'Occlusion received, edge computed it in {compute_time} seconds')
+		finally:
+			self._cleanup()
+		return occluded
+
+	def render_scene(self, scene, shadows=True):
+		''' Have the edge node trace and shade the whole frame of the
+			scene camera (binary protocol only), the rays never leave
+			it. Returns the (vres, hres, 3) uint8 image
+		'''
+		from application.wavefront import light_values
+		if self.protocol != 'binary':
+			raise ValueError('Rendering on the edge needs the binary protocol')
+		tri_ids, tris = scene.get_triangles_array()
+		material = scene.materials[0]
+		options = protocol.RENDER_SHADOWS if shadows else 0
+		self._connect()
+		try:
+			hit = protocol.send_render(
+				self.sock, tri_ids, tris,
+				scene.camera.parameters(),
+				(material.color, material.diffuse_coef),
+				light_values(scene.lights),
+				options)
+			log.info('Geometry found in the edge cache' if hit else 'Geometry uploaded')
+			image, compute_time = protocol.recv_image(self.sock)
+			log.info(f'Frame received, edge rendered it in {compute_time} seconds')
+		finally:
+			self._cleanup()
+		return image
+
+	def _result_flags(self):
+		flags = self.encoding.flags
+		if self.use_streaming:
+			flags |= protocol.FLAG_STREAM
+		return flags
+
+	def _streams(self):
+		return self.use_streaming and self.protocol == 'binary'
+
+	def compute_session(self):
+		''' Request the closest hits of the rays of the session
+			file, in the same format as compute_scene
+		'''
+		self._connect()
+
+		if self.protocol == 'binary':
+			use_cache = self.config.get('client', {}).get('mesh-cache', True)
+			result = self._compute_arrays_binary(*self.session.get_arrays(use_cache))
+		else:
+			self._send_scene_file()
+			log.info('Waiting for results')
+			compute_time = float(self._receive_results())
+			log.info(f'Edge computed the results in {compute_time} seconds')
+			result = json.loads(self._receive_results())
+
+		self._cleanup()
+		return result
+
+	def compute_camera(self, scene, tile=None, on_chunk=None):
+		''' Request the closest hits of the rays of the scene camera,
+			generated by the edge node, for the pixels of an (x, y,
+			width, height) `tile` or of the whole image (binary
+			protocol only). Results are in the scanline order of the
+			tile, as with compute_scene
+		'''
+		if self.protocol != 'binary':
+			raise ValueError('Camera queries need the binary protocol')
+		self._connect()
+		try:
+			result = self._compute_camera_binary(scene, tile, on_chunk)
+		finally:
+			self._cleanup()
+		if on_chunk is not None and not self._streams():
+			on_chunk(0, result['triangles_hit'], result['intersections'])
+		return result
+
+	def _compute_scene_binary(self, scene, on_chunk=None):
+		if self.send_camera:
+			return self._compute_camera_binary(scene, None, on_chunk)
+		tri_ids, tris = scene.get_triangles_array()
+		rays = scene.camera.get_rays_array()
+		return self._compute_arrays_binary(tri_ids, tris, rays, on_chunk)
+
+	def _compute_camera_binary(self, scene, tile=None, on_chunk=None):
+		tri_ids, tris = scene.get_triangles_array()
+		log.info('Sending camera')
+		flags = self._result_flags()
+		hit = protocol.send_camera_query(
+			self.sock, tri_ids, tris, scene.camera.parameters(), tile, flags=flags)
+		log.info('Geometry found in the edge cache' if hit else 'Geometry uploaded')
+		return self._receive_binary_results(scene.camera.num_rays(tile), on_chunk)
+
+	def _compute_arrays_binary(self, tri_ids, tris, rays, on_chunk=None):
+		log.info('Sending scene arrays')
+		flags = self._result_flags()
+		if self.use_scene_cache:
+			hit = protocol.send_cached_scene(self.sock, tri_ids, tris, rays, flags=flags)
+			log.info('Geometry found in the edge cache' if hit else 'Geometry uploaded')
+		else:
+			protocol.send_scene(self.sock, tri_ids, tris, rays, flags)
+		return self._receive_binary_results(np.size(rays) // protocol.NUM_RAY_ATTRS, on_chunk)
+
+	def _receive_binary_results(self, num_rays, on_chunk=None):
+		log.info('Waiting for results')
+		if self.use_streaming:
+			ids, intersects, compute_time = self._receive_result_stream(num_rays, on_chunk)
+		else:
+			ids, intersects, compute_time = protocol.recv_results(self.sock)
+		log.info(f'Results received, edge computed them in {compute_time} seconds')
+		return {
+			'intersections' : intersects,
+			'triangles_hit' : ids
+		}
+
+	def _receive_result_stream(self, num_rays, on_chunk=None):
+		''' Receive streamed results into arrays allocated once for
+			all the rays, passing each range to `on_chunk`
+		'''
+		from time import time
+		ids = np.full(num_rays, -1, dtype=protocol.ID_TYPE)
+		intersects = np.empty(num_rays, dtype=protocol.FLOAT_TYPE)
+		ti = time()
+		chunks = []
+
+		def received(first, last):
+			if not chunks:
+				log.info(f'First results received after {time() - ti} seconds')
+			chunks.append(first)
+			if on_chunk is not None:
+				on_chunk(first, ids[first:last], intersects[first:last])
+
+		compute_time = protocol.recv_result_stream(self.sock, ids, intersects, received)
+		log.info(f'Received {len(chunks)} result chunks')
+		return ids, intersects, compute_time
+
+	def _compute_scene_text(self, scene):
 		# preparing scene to send
 		num_tris, num_rays = len(scene.triangles), scene.camera.vres * scene.camera.hres
 		string_data  = f'{num_tris} {num_rays}\n' 
@@ -73,10 +285,10 @@ class RendererClient:
 		self._send_scene_string(string_data)
 
 		log.info('Waiting for results')
-		result = self._receive_results()
+		compute_time = float(self._receive_results())
+		log.info(f'Edge computed the results in {compute_time} seconds')
+		result = json.loads(self._receive_results())
 		log.info('Results received')
-
-		self._cleanup()
 		return result
 		
 	def _send_scene_string(self, string):
@@ -89,18 +301,11 @@ class RendererClient:
 	def _receive_results(self):
 		log.info("Start receiving results")
 
-		raw_size = self.sock.recv(4)
+		raw_size = protocol.recv_exactly(self.sock, 4)
 		size = struct.unpack('>I', raw_size)[0]
 		log.info(f'Finishing receiving scene file size: {size}B')
 
-		CHUNK_SIZE = 256
-		full_data = b''
-		while len(full_data) < size:
-			packet = self._recv(CHUNK_SIZE)
-			if not packet:
-				break
-			full_data += packet
-		return full_data.decode()
+		return protocol.recv_exactly(self.sock, size).decode()
 
 	def _send_scene_file(self):
 		log.info('Sending configuration file')
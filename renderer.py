@@ -12,18 +12,22 @@ def run_client(config):
 	import numpy as np
 	from PIL import Image
 	from application.raytracer.scene import Scene
-	from application.raytracer.geometry import Intersection
 	from time import time
 
 	hres, vres = parser.args.res
 	psize = parser.args.psize
 	
-	client = RendererClient(config=config)
+	if config.get('cluster', {}).get('nodes'):
+		# the frame is shared by several edge nodes
+		from application.cluster import Cluster
+		client = Cluster(config)
+	else:
+		client = RendererClient(config=config)
 	image_name = config['client']['output']
 	object_file = config['client']['mesh']
 	
 	ti = time()
-	scene = Scene(object_file)
+	scene = Scene(object_file, config['client'].get('mesh-cache', True))
 	scene.set_camera(
 		(hres, vres), 
 		np.array([0.0, 5.0, 5.0]),
@@ -32,35 +36,43 @@ def run_client(config):
 		200, psize)
 	log.info(f'Finished standalone setup in {time() - ti} seconds')
 
+	# pixels are shaded as their results arrive
+	image = np.zeros((vres, hres, 3), dtype=np.uint8)
+	def shade_chunk(first, triangle_ids, intersects):
+		scene.shade(triangle_ids, intersects, first, image)
+
 	ti = time()
-	res = json.loads(client.compute_scene(scene))
-	log.info(f'Finished intersection calculations in {time() - ti} seconds')
+	if config['client'].get('render-on-edge', False) and isinstance(client, RendererClient):
+		# the edge node traces and shades the frame, only pixels come back
+		image = client.render_scene(scene, config['client'].get('shadows', False))
+	elif config['client'].get('shadows', False):
+		# shadow rays of all the pixels are sent once per light
+		tri_ids, tris = scene.get_triangles_array()
+		def occluded(rays, max_distances):
+			return client.compute_occlusion(tri_ids, tris, rays, max_distances)
+		result = client.compute_scene(scene)
+		scene.shade(result['triangles_hit'], result['intersections'], 0, image, occluded)
+	else:
+		client.compute_scene(scene, on_chunk=shade_chunk)
+	log.info(f'Finished intersection and shading calculations in {time() - ti} seconds')
 	
 	ti = time()
-	final_img = Image.new('RGB', (scene.camera.hres, scene.camera.vres), (0,0,0))
-	pix = final_img.load()
-	for i, tid in enumerate(res['triangles_hit']):
-		x, y = i%scene.camera.hres, i//scene.camera.hres
-		pix[x,y] = (0, 0, 0)
-		if tid != -1:
-			ray = scene.camera.get_ray(x, y)
-			it = Intersection(
-				ray,
-				scene.triangles[tid],
-				res['intersections'][i])
-			col = (scene.materials[0].shade(it, scene.lights))
-			col = tuple((col*255).astype('int32'))
-			pix[x,y] = col
+	final_img = Image.fromarray(image, 'RGB')
 	
 	log.info(f'Saving {image_name}')
 	final_img.save(image_name)
-	log.info(f'Finished shading calculations in {time() - ti} seconds')
+	log.info(f'Saved the image in {time() - ti} seconds')
 
 def run_edge(config):
+	if parser.args.port is not None:
+		config['edge']['port'] = parser.args.port
 	dark_node = RendererServer(config)
 	try:
-		for i in range(60):
-			dark_node.start()
+		if config['edge'].get('concurrent', False):
+			dark_node.serve(max_requests=60)
+		else:
+			for i in range(60):
+				dark_node.start()
 	finally:
 	    dark_node.cleanup()
 
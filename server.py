@@ -1,10 +1,62 @@
 import json
+import queue
+import threading
 import numpy as np
 import logging as log
 import struct
 import application.tracers as tracer
+import application.protocol as protocol
+from application.cache import SceneCache
+from application.scheduling import Scheduler, CPUDevice, fpga_devices
+from application.calibration import ThroughputModel
+from application.coherence import RayOrder
+from application.metrics import Metrics
+from application.wavefront import FrameRenderer, scene_objects
+from application.raytracer.scene import Camera
 from application.parser import Parser
 
+class Request():
+    ''' State of one client request while it goes through the
+        receive, compute and send stages of the server
+    '''
+    def __init__(self, connection, client):
+        self.connection = connection
+        self.client = client
+        self.binary_protocol = False
+        # results are streamed in chunks as they are computed
+        self.stream = False
+        self.stream_lock = threading.Lock()
+        self.stream_error = None
+        # any-hit query of shadow rays, with a distance limit per ray
+        self.occlusion = False
+        self.max_distances = None
+        # (camera, material, lights, shadows) of a whole frame rendered
+        # by the server
+        self.render = None
+        # time, bytes and number of the streamed chunks
+        self.stream_time = 0.0
+        self.stream_bytes = 0
+        self.stream_chunks = 0
+        # encoding of the binary results, see application.encoding
+        self.encoding = protocol.RAW
+        # spans of the request, see application.metrics
+        self.trace = None
+        self.received_bytes = 0
+        self.cache_hit = None
+        # cached scene the geometry came from, if any
+        self.scene = None
+        self.triangle_ids = None
+        self.triangles    = None
+        self.rays         = None
+        self.result = None
+        self.compute_time = 0.0
+        self.error = None
+
+    @property
+    def name(self):
+        return f'{self.client[0]}:{self.client[1]}'
+
+
 class RendererServer():
 
     def __init__(self, config):        
@@ -18,162 +70,702 @@ class RendererServer():
         port = config['edge']['port']
         self.addr = (ip, port)
         self.sock.bind(self.addr)
+        # rays per result chunk streamed from the cpu tracer
+        self.stream_chunk = config['edge'].get('stream-chunk', 4096)
+        # bound of the blocks announced by the clients
+        protocol.set_max_block_size(config['edge'].get('max-block-megabytes', 1024) * 2**20)
         
-        self.connection = None
-        self.client_ip = None
-        
-        self.triangles    = []
-        self.triangle_ids = []
-        self.rays         = []
+        # parsed geometry (and derived structures) of recent requests
+        cache_size = config.get('scene-cache', {}).get('max-megabytes', 256)
+        self.scene_cache = SceneCache(cache_size * 2**20)
+
+        # per-request spans aggregated into histograms, served over
+        # http and optionally written to a JSONL trace file
+        metrics = config.get('metrics', {})
+        self.metrics = Metrics(metrics.get('trace-file'), metrics.get('enabled', True))
+        self.metrics.gauge('scene_cache_bytes', lambda: self.scene_cache.nbytes)
+        self.metrics.gauge('scene_cache_scenes', lambda: len(self.scene_cache))
+        self.metrics.counter('scene_cache_hits', lambda: self.scene_cache.hits)
+        self.metrics.counter('scene_cache_misses', lambda: self.scene_cache.misses)
+        if metrics.get('enabled', True) and metrics.get('http-port') is not None:
+            try:
+                self.metrics.serve(metrics.get('http-ip', '127.0.0.1'), metrics['http-port'])
+            except OSError as error:
+                log.warning(f'Metrics endpoint not started: {error}')
+
+        # the tracers keep per-scene state, so only one request
+        # is prepared and computed at a time
+        self._compute_lock = threading.Lock()
 
         processing = config['processing']
         mode = processing['mode']
         self.heterogeneous_mode = (mode == 'heterogeneous')
         self.cpu_active = mode in ['cpu', 'heterogeneous']
         self.fpga_active = mode in ['fpga', 'heterogeneous']
+        # rays are traced in scanline order or sorted for coherence
+        self.coherent_rays = processing.get('ray-order', 'scanline') == 'coherent'
+        self.ray_order_block = processing.get('ray-order-block', 65536)
         
         if self.heterogeneous_mode:
             self.fpga_load_fraction = processing['heterogeneous']['fpga-load']
+            self.scheduler = None
 
         if self.cpu_active:
             cpu_mode = processing['cpu']['mode']    
             use_python = (cpu_mode == 'python')
-            use_multicore = (cpu_mode == 'multicore')
+            use_bvh = (cpu_mode == 'bvh')
+            use_simd = (cpu_mode == 'simd')
+            use_multicore = cpu_mode in ['multicore', 'bvh', 'simd']
             self.cpu_tracer = tracer.TracerCPU(
                 use_multicore=use_multicore,
-                use_python=use_python)
+                use_python=use_python,
+                use_bvh=use_bvh,
+                use_simd=use_simd)
 
         if self.fpga_active:
             fpga_mode = processing['fpga']['mode']
             use_multi_fpga = (fpga_mode == 'multi')
+            overlay, xlnk = None, None
+            if processing['fpga'].get('simulate', False):
+                from application.simulation import SimulatedOverlay, SimulatedXlnk
+                log.warning('Using simulated FPGA accelerators')
+                xlnk = SimulatedXlnk()
+                overlay = SimulatedOverlay(xlnk,
+                    processing['fpga'].get('simulated-accelerators', 2),
+                    processing['fpga'].get('simulated-throughput'))
             self.fpga_tracer = tracer.TracerFPGA(
                 config['edge']['bitstream'],
-                use_multi_fpga=use_multi_fpga)
+                use_multi_fpga=use_multi_fpga,
+                overlay=overlay,
+                xlnk=xlnk,
+                batch_size=processing['fpga'].get('stream-batch'),
+                num_buffers=processing['fpga'].get('stream-buffers', 2),
+                use_interrupts=processing['fpga'].get('interrupts', False))
+
+        if self.heterogeneous_mode:
+            heterogeneous = processing['heterogeneous']
+            if heterogeneous.get('scheduler', 'static') == 'dynamic':
+                devices = [CPUDevice(self.cpu_tracer)] + fpga_devices(self.fpga_tracer)
+                self.scheduler = Scheduler(devices, heterogeneous.get('task-size', 4096))
+            else:
+                self.throughput_model = ThroughputModel(
+                    heterogeneous.get('calibration-file'),
+                    self._calibration_key())
         
     def cleanup(self):
         self.sock.close()
+        self.metrics.close()
+        if self.heterogeneous_mode and self.scheduler is None and self.throughput_model.unsaved:
+            self.throughput_model.save()
+        if self.fpga_active:
+            self.fpga_tracer.release()
+
+    def _calibration_key(self):
+        ''' Identifies the hardware setup the throughput model was
+            measured on: bitstream, accelerators and cpu mode
+        '''
+        import os
+        processing = self.config['processing']
+        fpga = processing['fpga']
+        if fpga.get('simulate', False):
+            bitstream = f"simulated-{fpga.get('simulated-throughput')}"
+        else:
+            bitstream = os.path.basename(self.config['edge']['bitstream'])
+        num_accelerators = len(self.fpga_tracer.accelerators)
+        return f"{bitstream}/{num_accelerators}-fpga/{processing['cpu']['mode']}"
+
+    def _fpga_load(self, num_rays, num_tris):
+        ''' Fraction of the rays computed by the FPGA. With fpga-load
+            set to "auto" it comes from the throughput model, which
+            starts from an even split until both devices were measured
+        '''
+        if self.fpga_load_fraction == 'auto':
+            return self.throughput_model.fpga_fraction(num_rays, num_tris, 0.5)
+        return self.fpga_load_fraction
         
     def start(self):
-        from time import time
-
+        ''' Serve one client request from start to end '''
         log.info("Waiting for client connection")
-        self._await_connection()
-        
-        log.info("Receiving scene file")
-        ti = time()
-        scene_data = self._receive_scene_data()
-        tf = time()
-        log.warning(f'Finished receiving data in {tf - ti} seconds')
-
-        log.info('Parsing scene data')
-        ti = time()
-        self._parse_scene_data(scene_data)
-        tf = time()
-        log.warning(f'Finished parsing scene data in {tf - ti} seconds')
-
-        log.info('Computing intersection')
-        ti = time()
-        result = self._compute()
-        tf = time()
-        log.warning(f'Finishing intersection calculation in {tf - ti} seconds')
-
-        time_msg = f'{tf - ti}'
+        request = self._await_connection()
+        if not self._receive(request):
+            return
+        try:
+            self._process(request)
+        except Exception as error:
+            log.exception(f'Failed to compute request from {request.name}')
+            self._fail(request, error)
+            return
+        self._reply(request)
+
+    def serve(self, max_requests=None):
+        ''' Serve requests concurrently in three stages connected
+            by queues: receiving/parsing (several threads), computing
+            (one thread, the tracers are shared) and sending results.
+            The queue in front of the compute stage is bounded, so
+            when it is full the receivers stop reading and clients
+            wait on their sockets and in the listen backlog.
+            Returns after `max_requests` requests, if given
+        '''
+        concurrency = self.config.get('concurrency', {})
+        num_receivers = concurrency.get('receivers', 2)
+        num_senders = concurrency.get('senders', 1)
+        accepted = queue.Queue(maxsize=num_receivers)
+        pending  = queue.Queue(maxsize=concurrency.get('max-pending', 4))
+        finished = queue.Queue()
+
+        receivers = [
+            threading.Thread(target=self._receive_stage, args=(accepted, pending))
+            for _ in range(num_receivers)]
+        computer = threading.Thread(target=self._compute_stage, args=(pending, finished))
+        senders = [
+            threading.Thread(target=self._send_stage, args=(finished,))
+            for _ in range(num_senders)]
+        for thread in receivers + [computer] + senders:
+            thread.daemon = True
+            thread.start()
+
+        log.info(f'Serving with {num_receivers} receivers and {num_senders} senders')
+        self.sock.listen(concurrency.get('backlog', 16))
+        served = 0
+        try:
+            while max_requests is None or served < max_requests:
+                connection, client = self.sock.accept()
+                log.info(f'Connection with {client[0]}:{client[1]}')
+                accepted.put(Request(connection, client))
+                served += 1
+        finally:
+            # drain the pipeline stage by stage
+            for _ in receivers:
+                accepted.put(None)
+            for thread in receivers:
+                thread.join()
+            pending.put(None)
+            computer.join()
+            for _ in senders:
+                finished.put(None)
+            for thread in senders:
+                thread.join()
+
+    def _receive_stage(self, accepted, pending):
+        for request in iter(accepted.get, None):
+            if self._receive(request):
+                # blocks while the compute stage is behind
+                pending.put(request)
+
+    def _compute_stage(self, pending, finished):
+        for request in iter(pending.get, None):
+            try:
+                self._process(request)
+            except Exception as error:
+                log.exception(f'Failed to compute request from {request.name}')
+                request.error = error
+            finished.put(request)
+
+    def _send_stage(self, finished):
+        for request in iter(finished.get, None):
+            if request.error is not None:
+                self._fail(request, request.error)
+            else:
+                self._reply(request)
+
+    def _receive(self, request):
+        ''' Receive and parse a request. Returns False if it was
+            rejected, after reporting the error to the client
+        '''
+        trace = request.trace = self.metrics.trace(request.name)
+        try:
+            log.info("Receiving scene file")
+            with trace.span('receive') as span:
+                prefix = protocol.recv_exactly(request.connection, 4)
+                request.binary_protocol = protocol.is_binary(prefix)
+                if request.binary_protocol:
+                    log.info('Client is using the binary protocol')
+                    self._receive_binary_scene(request, prefix)
+                else:
+                    scene_data = self._receive_scene_data(request, prefix)
+            span.count(bytes=request.received_bytes)
+            if request.cache_hit is not None:
+                span.count(cache_hit=int(request.cache_hit))
+            log.warning(f'Finished receiving data in {span.seconds} seconds')
+
+            if not request.binary_protocol:
+                log.info('Parsing scene data')
+                with trace.span('parse', bytes=len(scene_data)) as span:
+                    self._parse_scene_data(request, scene_data)
+                log.warning(f'Finished parsing scene data in {span.seconds} seconds')
+            return True
+        except (protocol.ProtocolError, OSError, ValueError) as error:
+            self._fail(request, error)
+            return False
+        except Exception as error:
+            # a receiver thread must outlive any request it gets
+            log.exception(f'Failed to receive request from {request.name}')
+            self._fail(request, error)
+            return False
+
+    def _process(self, request):
+        trace = request.trace
+        with self._compute_lock:
+            log.info('Preparing tracers')
+            with trace.span('prepare') as span:
+                self._prepare_tracers(request)
+            log.warning(f'Finished preparing tracers in {span.seconds} seconds')
+
+            log.info('Computing intersection')
+            if request.render is not None:
+                camera = request.render[0]
+                num_rays = camera.hres * camera.vres
+            else:
+                num_rays = len(request.rays) // self.NUM_RAY_ATTRS
+            with trace.span('compute',
+                    rays=num_rays,
+                    triangles=len(request.triangle_ids)) as span:
+                request.result = self._compute(request)
+            log.warning(f'Finishing intersection calculation in {span.seconds} seconds')
+            request.compute_time = span.seconds
+        # derived structures may have grown the cached scene
+        self.scene_cache.trim()
+
+    def _reply(self, request):
+        log.info('Preparing and sending results')
+        trace = request.trace
+        try:
+            if request.stream:
+                trace.add('stream', request.stream_time,
+                    bytes=request.stream_bytes, chunks=request.stream_chunks)
+            with trace.span('send') as span:
+                if request.render is not None:
+                    protocol.send_image(
+                        request.connection,
+                        request.result['image'],
+                        request.compute_time)
+                    span.count(bytes=request.result['image'].nbytes)
+                elif request.occlusion:
+                    protocol.send_occlusion(
+                        request.connection,
+                        request.result['occluded'],
+                        request.compute_time)
+                    span.count(bytes=(len(request.result['occluded']) + 7) // 8)
+                elif request.stream:
+                    protocol.send_result_end(
+                        request.connection,
+                        len(request.result['triangles_hit']),
+                        request.compute_time)
+                elif request.binary_protocol:
+                    span.count(bytes=protocol.send_results(
+                        request.connection,
+                        request.result['triangles_hit'],
+                        request.result['intersections'],
+                        request.compute_time,
+                        request.encoding))
+                else:
+                    span.count(bytes=self._send_text_results(request))
+            log.warning(f'Finished sending results in {span.seconds} seconds')
+        except OSError as error:
+            log.error(f'Failed to send results to {request.name}: {error}')
+            request.error = error
+        finally:
+            self._close(request)
+
+    def _fail(self, request, error):
+        log.error(f'Invalid request from {request.name}: {error}')
+        request.error = error
+        try:
+            protocol.send_error(request.connection, str(error))
+        except OSError:
+            pass
+        finally:
+            self._close(request)
+
+    def _close(self, request):
+        request.connection.close()
+        if request.trace is not None:
+            request.trace.finish(request.error or request.stream_error)
+        if request.scene is not None:
+            self.scene_cache.unpin(request.scene)
+            request.scene = None
+
+    def _receive_binary_scene(self, request, prefix):
+        msg_type, flags = protocol.recv_frame(request.connection, prefix)
+        request.occlusion = bool(flags & protocol.FLAG_OCCLUSION)
+        # occlusion results are a bitmask sent at once
+        request.stream = bool(flags & protocol.FLAG_STREAM) and not request.occlusion
+        # the encoding asked for, or the closest one available here
+        request.encoding = protocol.Encoding.from_flags(flags).supported()
+        if msg_type == protocol.MSG_SCENE:
+            request.triangle_ids, request.triangles, request.rays = \
+                protocol.recv_scene(request.connection)
+            request.received_bytes = request.triangle_ids.nbytes \
+                + request.triangles.nbytes + request.rays.nbytes
+        elif msg_type == protocol.MSG_SCENE_QUERY:
+            self._receive_cached_scene(request)
+        elif msg_type == protocol.MSG_RENDER:
+            self._receive_render(request)
+        elif msg_type == protocol.MSG_CAMERA_QUERY:
+            self._receive_camera_query(request)
+        else:
+            raise protocol.ProtocolError(f'Unexpected message {msg_type}')
+        # only the requests carrying rays have maximum distances
+        if request.occlusion and msg_type in (protocol.MSG_SCENE, protocol.MSG_SCENE_QUERY):
+            request.max_distances = protocol.recv_max_distances(
+                request.connection, len(request.rays) // self.NUM_RAY_ATTRS)
+            request.received_bytes += request.max_distances.nbytes
+
+    def _receive_cached_scene(self, request):
+        connection = request.connection
+        key, num_tris, num_rays = protocol.recv_scene_query(connection)
+        self._receive_geometry(request, key, num_tris)
+        request.rays = protocol.recv_rays(connection, num_rays)
+        request.received_bytes += request.rays.nbytes
+
+    def _receive_camera_query(self, request):
+        ''' Rays of a CAMERA_QUERY, generated here from the camera
+            instead of received
+        '''
+        if request.occlusion:
+            raise protocol.ProtocolError('Camera queries have no occlusion form')
+        key, num_tris, parameters, tile = protocol.recv_camera_query(request.connection)
+        request.received_bytes += protocol.CAMERA_QUERY.size + protocol.CAMERA.size
+        camera = Camera(*parameters)
+        x, y, width, height = tile or (0, 0, camera.hres, camera.vres)
+        if width <= 0 or height <= 0 or x + width > camera.hres or y + height > camera.vres:
+            raise protocol.ProtocolError(
+                f'Tile {tile} outside of the {camera.hres}x{camera.vres} image')
+        self._receive_geometry(request, key, num_tris)
+        with request.trace.span('generate') as span:
+            # written in place into the flat float32 array the tracers read
+            request.rays = np.empty(camera.num_rays(tile) * self.NUM_RAY_ATTRS, dtype=np.float32)
+            camera.get_rays(tile, out=request.rays.reshape(-1, self.NUM_RAY_ATTRS))
+            span.count(rays=camera.num_rays(tile))
+
+    def _receive_render(self, request):
+        key, num_tris, camera, material, lights, options = \
+            protocol.recv_render(request.connection)
+        if request.occlusion:
+            raise protocol.ProtocolError('Render requests have no occlusion form')
+        # the frame is sent as a whole once it is shaded
+        request.stream = False
+        request.render = scene_objects(camera, material, lights) \
+            + (bool(options & protocol.RENDER_SHADOWS),)
+        request.received_bytes += protocol.CAMERA.size + lights.nbytes
+        self._receive_geometry(request, key, num_tris)
+
+    def _receive_geometry(self, request, key, num_tris):
+        ''' Answer the cache status of a geometry hash, receive the
+            geometry on a miss and pin the scene to the request
+        '''
+        connection = request.connection
+        scene = self.scene_cache.get(key)
+        request.cache_hit = scene is not None
+        if scene is not None:
+            log.info(f'Scene {key.hex()} found in cache')
+            protocol.send_status(connection, protocol.SCENE_HIT)
+        else:
+            log.info(f'Scene {key.hex()} not cached, receiving geometry')
+            protocol.send_status(connection, protocol.SCENE_MISS)
+            triangle_ids, triangles = protocol.recv_geometry(connection, num_tris)
+            if protocol.geometry_hash(triangle_ids, triangles) != key:
+                raise protocol.ProtocolError('Geometry does not match its hash')
+            scene = self.scene_cache.put(key, triangle_ids, triangles)
+            request.received_bytes += triangle_ids.nbytes + triangles.nbytes
+
+        request.scene = scene
+        request.triangle_ids = scene.triangle_ids
+        request.triangles = scene.triangles
+
+    def _prepare_tracers(self, request):
+        # structures built for a cached scene are kept with it
+        derived = request.scene.derived if request.scene is not None else None
+        if self.cpu_active:
+            self.cpu_tracer.prepare(request.triangle_ids, request.triangles, derived)
+        if self.fpga_active:
+            self.fpga_tracer.prepare(request.triangle_ids, request.triangles, derived)
+
+    def _result_sender(self, request):
+        ''' Function sending a range of results of a streaming
+            request, callable from several threads. After a failed
+            send the remaining chunks are dropped, the error is
+            reported when the request is closed
+        '''
+        from time import perf_counter
+        def send_chunk(first_ray, ids, intersects):
+            with request.stream_lock:
+                if request.stream_error is not None:
+                    return
+                ti = perf_counter()
+                try:
+                    request.stream_bytes += protocol.send_result_chunk(
+                        request.connection, first_ray, ids, intersects, request.encoding)
+                except OSError as error:
+                    request.stream_error = error
+                request.stream_time += perf_counter() - ti
+                request.stream_chunks += 1
+        return send_chunk
+
+    def _compute_chunks(self, rays, triangle_ids, triangles, first_ray, on_result):
+        ''' Compute rays on the cpu tracer in chunks of stream-chunk
+            rays, handing each one to `on_result` when finished
+        '''
+        ids, intersects = [], []
+        for task in tracer.divide_tasks(rays, self.stream_chunk):
+            task_ids, task_inter = self.cpu_tracer.compute(
+                task.ray_data,
+                triangle_ids,
+                triangles)
+            on_result(first_ray + task.id*self.stream_chunk, task_ids, task_inter)
+            ids.append(task_ids)
+            intersects.append(task_inter)
+        if not ids:
+            return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+        return (np.concatenate(ids), np.concatenate(intersects))
+
+    def _send_text_results(self, request):
+        ''' Returns the number of bytes sent '''
+        time_msg = f'{request.compute_time}'
         size = len(time_msg)
         msg = struct.pack('>I', size) + time_msg.encode()
-        self.connection.send(msg)
+        request.connection.sendall(msg)
 
-        log.info('Preparing and sending results')
-        ti = time()
-        result = json.dumps(result)
-        size = len(result)
-        msg = struct.pack('>I', size) + result.encode()
-        self.connection.send(msg)
-        tf = time()
-        log.warning(f'Finished sending results in {tf - ti} seconds')
-
-    def _compute(self):
+        with request.trace.span('serialize') as span:
+            result = json.dumps({key: value.tolist() for key, value in request.result.items()})
+            size = len(result)
+            msg = struct.pack('>I', size) + result.encode()
+        span.count(bytes=len(msg))
+        request.connection.sendall(msg)
+        return 4 + len(time_msg) + len(msg)
+
+    def _compute(self, request, rays=None):
+        ''' Closest hits of the request rays, or of `rays` when given
+            (the waves of a rendered frame)
+        '''
         import numpy as np
+        from time import time
         log.info('Starting edge computation')
+        triangle_ids = request.triangle_ids
+        triangles = request.triangles
         intersects, ids = [], []
-        if self.heterogeneous_mode: # currently balancing 50%-50%
+        trace = request.trace
+        if rays is None:
+            if request.render is not None:
+                return self._render(request)
+            if request.occlusion:
+                return self._compute_occlusion(request)
+            rays = request.rays
+        on_result = self._result_sender(request) if request.stream else None
+        order = None
+        if self.coherent_rays:
+            with trace.span('sort') as span:
+                order = RayOrder(rays, self.ray_order_block)
+                rays = order.apply(rays)
+                if on_result is not None:
+                    on_result = order.restoring(on_result)
+            log.info(f'Sorted the rays in {span.seconds} seconds')
+        start = time()
+        if self.heterogeneous_mode and self.scheduler is not None:
+            log.info('Computing in heterogeneous mode with dynamic scheduling')
+            ids, intersects = self.scheduler.compute(
+                rays,
+                triangle_ids,
+                triangles,
+                on_result)
+            self._record_scheduler(trace, self.scheduler)
+
+        elif self.heterogeneous_mode: # static split by fpga-load
             log.info('Computing in heterogeneous mode')
-            num_rays = len(self.rays) // 6      
+            num_rays = len(rays) // 6
+            num_tris = len(triangle_ids)
+            fpga_load_fraction = self._fpga_load(num_rays, num_tris)
 
-            log.info(f'FPGA processing {self.fpga_load_fraction*100}% (self.fpga_load_fraction)')
-            fpga_load = int(np.floor(num_rays * self.fpga_load_fraction))
+            log.info(f'FPGA processing {fpga_load_fraction*100}% of the rays')
+            fpga_load = int(np.floor(num_rays * fpga_load_fraction))
             log.info(f'FPGA load is {fpga_load}/{num_rays} rays')
 
-            self.fpga_tracer.compute(
-                self.rays[:fpga_load*6],
-                self.triangle_ids,
-                self.triangles)
+            # the fpga share is filled, run and waited for in a thread
+            # while this one computes the cpu share
+            ti = time()
+            fpga_future = self.fpga_tracer.compute_async(
+                rays[:fpga_load*6],
+                triangle_ids,
+                triangles)
+            if on_result is not None:
+                # the fpga share goes out as soon as it is done
+                fpga_sent = threading.Event()
+                def send_fpga_share(future):
+                    if future.exception() is None:
+                        on_result(0, *future.result())
+                    fpga_sent.set()
+                fpga_future.add_done_callback(send_fpga_share)
+                cpu_ids, cpu_inter = self._compute_chunks(
+                    rays[fpga_load*6:],
+                    triangle_ids,
+                    triangles,
+                    fpga_load,
+                    on_result)
+            else:
+                cpu_ids, cpu_inter = self.cpu_tracer.compute(
+                    rays[fpga_load*6:],
+                    triangle_ids,
+                    triangles)
+            cpu_time = time() - ti
 
-            cpu_ids, cpu_inter = self.cpu_tracer.compute(
-                self.rays[fpga_load*6:],
-                self.triangle_ids,
-                self.triangles)
+            fpga_ids, fpga_inter = fpga_future.result()
+            if on_result is not None:
+                # callbacks may still be running after result() returns
+                fpga_sent.wait()
+            fpga_time = self.fpga_tracer.elapsed()
+            log.info(f'FPGA took {fpga_time} seconds and CPU {cpu_time} seconds')
+            wall_time = time() - start
+            self._record_device(trace, 'cpu', cpu_time, wall_time, num_rays - fpga_load)
+            self._record_accelerators(trace, wall_time)
 
-            while not self.fpga_tracer.is_done(): pass
-            fpga_ids, fpga_inter = self.fpga_tracer.get_results()
-            #print(fpga_ids, fpga_inter, cpu_ids, cpu_inter)
+            ids = np.concatenate((fpga_ids, cpu_ids))
+            intersects = np.concatenate((fpga_inter, cpu_inter))
 
-            ids = fpga_ids + cpu_ids
-            intersects = fpga_inter + cpu_inter
+            self.throughput_model.record('fpga', fpga_load, num_tris, fpga_time)
+            self.throughput_model.record('cpu', num_rays - fpga_load, num_tris, cpu_time)
 
+        elif self.fpga_active and on_result is not None:
+            log.info('Computing in fpga-only mode, streaming the results')
+            # the accelerators take stream-chunk tasks as they get free
+            scheduler = Scheduler(fpga_devices(self.fpga_tracer), self.stream_chunk)
+            ids, intersects = scheduler.compute(
+                rays,
+                triangle_ids,
+                triangles,
+                on_result)
+            self._record_scheduler(trace, scheduler)
         elif self.fpga_active:
             log.info('Computing in fpga-only mode')
             self.fpga_tracer.compute(
-                self.rays,
-                self.triangle_ids,
-                self.triangles)
+                rays,
+                triangle_ids,
+                triangles)
 
-            while not self.fpga_tracer.is_done(): 
-                pass
+            self.fpga_tracer.wait()
             ids, intersects = self.fpga_tracer.get_results()
+            self._record_accelerators(trace, time() - start)
+        elif on_result is not None:
+            log.info('Computing in cpu-only mode, streaming the results')
+            ids, intersects = self._compute_chunks(
+                rays,
+                triangle_ids,
+                triangles,
+                0,
+                on_result)
+            self._record_device(trace, 'cpu', time() - start, time() - start, len(ids))
         else:
             log.info('Computing in cpu-only mode')
             ids, intersects = self.cpu_tracer.compute(
-                self.rays,
-                self.triangle_ids,
-                self.triangles)
+                rays,
+                triangle_ids,
+                triangles)
+            self._record_device(trace, 'cpu', time() - start, time() - start, len(ids))
+
+        if order is not None:
+            ids, intersects = order.restore(ids, intersects)
 
         return {
             'intersections' : intersects,
             'triangles_hit' : ids
         } 
 
+    def _compute_occlusion(self, request, rays=None, max_distances=None):
+        ''' Any-hit query of the request shadow rays, or of `rays`
+            when given. Runs on the cpu tracer, whose kernels stop at
+            the first hit, when it is active; the accelerators only
+            find closest hits
+        '''
+        if rays is None:
+            rays, max_distances = request.rays, request.max_distances
+        from time import time
+        log.info('Computing occlusion of shadow rays')
+        start = time()
+        if self.cpu_active:
+            name, device = 'cpu', self.cpu_tracer
+        else:
+            name, device = 'fpga', self.fpga_tracer
+        occluded = device.occluded(
+            rays,
+            max_distances,
+            request.triangle_ids,
+            request.triangles)
+        self._record_device(request.trace, name, time() - start, time() - start, len(occluded))
+        return {'occluded': occluded}
+
+    def _render(self, request):
+        ''' Shaded frame of a RENDER request. The primary rays and the
+            shadow rays of each light are traced as waves by the same
+            tracers as the other requests
+        '''
+        camera, material, lights, shadows = request.render
+        frame = request.scene.derived.get('frame')
+        if frame is None:
+            frame = request.scene.derived['frame'] = FrameRenderer(
+                request.triangle_ids, request.triangles)
+        trace = request.trace
+
+        def closest(rays):
+            with trace.span('wave.primary', rays=len(rays) // self.NUM_RAY_ATTRS):
+                result = self._compute(request, rays)
+            return result['triangles_hit'], result['intersections']
+
+        def occluded(rays, max_distances):
+            with trace.span('wave.shadow', rays=len(max_distances)):
+                return self._compute_occlusion(request, rays, max_distances)['occluded']
+
+        log.info(f'Rendering a {camera.hres}x{camera.vres} frame')
+        image = frame.render(camera, material, lights, closest, occluded if shadows else None)
+        return {'image': image}
+
+    def _record_device(self, trace, name, busy_time, wall_time, num_rays,
+                       num_tasks=1, fill_time=0.0, drain_time=0.0):
+        ''' Span of a device in the last computation, with its share
+            of the wall time and, for the accelerators, the time spent
+            filling and draining their buffers
+        '''
+        utilization = min(busy_time / wall_time, 1.0) if wall_time > 0 else 0.0
+        trace.add(f'device.{name}', busy_time,
+            rays=num_rays, tasks=num_tasks, utilization=utilization)
+        if fill_time or drain_time:
+            trace.add(f'device.{name}.fill', fill_time)
+            trace.add(f'device.{name}.compute', max(busy_time - fill_time - drain_time, 0.0))
+            trace.add(f'device.{name}.drain', drain_time)
+
+    def _record_scheduler(self, trace, scheduler):
+        for device in scheduler.devices:
+            self._record_device(trace, device.name, device.busy_time, scheduler.wall_time,
+                device.num_rays, device.num_tasks, device.fill_time, device.drain_time)
+
+    def _record_accelerators(self, trace, wall_time):
+        for accel in self.fpga_tracer.active():
+            self._record_device(trace, accel.name, accel.elapsed or 0.0, wall_time,
+                accel.num_rays, 1, accel.fill_time, accel.drain_time)
+
     def _await_connection(self):
         self.sock.listen()
         print('Waiting for connection...')
-        self.connection, self.current_client = self.sock.accept()
-        print(f"Connection with {self.current_client[0]}:{self.current_client[1]}")
+        connection, client = self.sock.accept()
+        print(f"Connection with {client[0]}:{client[1]}")
+        return Request(connection, client)
 
-    def _receive_scene_data(self):
+    def _receive_scene_data(self, request, raw_size):
         log.info("Start reading scene file content")
 
-        raw_size = self.connection.recv(4)
         size = struct.unpack('>I', raw_size)[0]
         log.info(f'Finishing receiving scene file size: {size}B')
+        request.received_bytes = 4 + size
         
-        CHUNK_SIZE = 256*1024
-        full_data = b''
-        while len(full_data) < size:
-            packet = self.connection.recv(CHUNK_SIZE)
-            if not packet:
-                break
-            full_data += packet
-        return full_data.decode()
+        return protocol.recv_exactly(request.connection, size).decode()
 
     NUM_TRIANGLE_ATTRS = 9
     NUM_RAY_ATTRS = 6
 
-    def _parse_scene_data(self, scene_data):
-        data = scene_data.split()
+    def _parse_scene_data(self, request, scene_data):
+        # a single pass over the text, the blocks below are views
+        data = np.fromstring(scene_data, dtype=np.float64, sep=' ')
         task_data = data[2:]
-        self.num_tris = int(data[0])
-        self.num_rays = int(data[1])
-        tri_end = self.num_tris * (self.NUM_TRIANGLE_ATTRS+1)
-        self.triangle_ids = list(map(int, task_data[: self.num_tris]))
-        self.triangles    = list(map(float, task_data[self.num_tris : tri_end]))
-        self.rays         = list(map(float, task_data[tri_end : ]))
-
+        num_tris = int(data[0])
+        tri_end = num_tris * (self.NUM_TRIANGLE_ATTRS+1)
+        request.triangle_ids = task_data[: num_tris].astype(np.int32)
+        request.triangles    = task_data[num_tris : tri_end]
+        request.rays         = task_data[tri_end : ]
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.cache import SceneCache
+
+
+def test_unpinned_scene_is_evicted_when_over_the_limit():
+    tri_ids = np.arange(4, dtype=np.int32)
+    tris = np.zeros(4 * 9, dtype=np.float32)
+    cache = SceneCache(tri_ids.nbytes + tris.nbytes)
+    first = cache.put(b'first', tri_ids, tris)
+    second = cache.put(b'second', tri_ids.copy(), tris.copy())
+    # pinned by a request in flight, over the limit until released
+    assert b'first' in cache
+    cache.unpin(first)
+    assert b'first' not in cache
+    cache.unpin(second)
+    assert b'second' in cache
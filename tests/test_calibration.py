@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.calibration import ThroughputModel
+
+
+def test_zero_work_samples_are_ignored(tmp_path):
+    filename = str(tmp_path / 'calibration.json')
+    model = ThroughputModel(filename, 'key')
+    model.record('cpu', 1000, 0, 0.01)
+    model.record('fpga', 0, 500, 0.01)
+    assert not model.is_calibrated()
+    assert model.fpga_fraction(1000, 500, 0.3) == 0.3
+
+    model.record('cpu', 1000, 500, 1.0)
+    model.record('fpga', 1000, 500, 3.0)
+    assert model.fpga_fraction(1000, 500, 0.3) == 0.25
+
+
+def test_fraction_defaults_without_coefficients(tmp_path):
+    model = ThroughputModel(None, 'key')
+    # weights from an older file but no work in the sums
+    model.fits['cpu'].sums = [1.0, 0.0, 0.5, 0.0, 0.0]
+    model.fits['fpga'].sums = [1.0, 1e6, 1.0, 1e12, 1e6]
+    assert model.is_calibrated()
+    assert model.fpga_fraction(1000, 500, 0.4) == 0.4
+
+
+def test_saved_every_few_samples(tmp_path):
+    filename = str(tmp_path / 'calibration.json')
+    model = ThroughputModel(filename, 'key')
+    for _ in range(ThroughputModel.SAVE_EVERY - 1):
+        model.record('cpu', 1000, 500, 1.0)
+    assert not os.path.exists(filename)
+    model.record('cpu', 1000, 500, 1.0)
+    with open(filename) as file:
+        assert 'key' in json.load(file)
+    assert model.unsaved == 0
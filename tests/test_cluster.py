@@ -0,0 +1,73 @@
+import os
+import sys
+import socket
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import application.protocol as protocol
+from application.encoding import BLOCKS
+from application.cluster import Cluster
+from application.tracers import TracerCPU
+from server import RendererServer
+
+
+def broken_node():
+    ''' Node answering every request with results that fail to decode '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    encoding = protocol.Encoding('rle', 'float32', 'zlib')
+
+    def serve():
+        while True:
+            connection, _ = sock.accept()
+            with connection:
+                protocol.expect_frame(connection, protocol.MSG_SCENE_QUERY)
+                _, num_tris, num_rays = protocol.recv_scene_query(connection)
+                protocol.send_status(connection, protocol.SCENE_MISS)
+                protocol.recv_geometry(connection, num_tris)
+                protocol.recv_rays(connection, num_rays)
+                protocol.send_frame(connection, protocol.MSG_RESULT,
+                    protocol.RESULT.pack(num_rays, 0.0)
+                    + BLOCKS.pack(4, 4, 0.0, 0.0) + b'junkjunk',
+                    encoding.flags)
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()
+
+
+def test_undecodable_results_count_as_node_failures():
+    server = RendererServer({
+        'edge': {'ip': '127.0.0.1', 'port': 0},
+        'metrics': {'http-port': None},
+        'processing': {'mode': 'cpu', 'cpu': {'mode': 'python'}}})
+    server.sock.listen()
+    thread = threading.Thread(target=server.serve, kwargs={'max_requests': 100})
+    thread.daemon = True
+    thread.start()
+
+    good = server.sock.getsockname()
+    bad = broken_node()
+    cluster = Cluster({
+        'cluster': {
+            'nodes': [{'ip': ip, 'port': port} for ip, port in (good, bad)],
+            'min-shard-rays': 16, 'max-failures': 2, 'timeout': 10},
+        'edge': {'result-encoding': {'ids': 'rle', 'compression': 'zlib'}}})
+
+    random = np.random.RandomState(0)
+    tri_ids = np.arange(20, dtype=np.int32)
+    tris = random.uniform(-1, 1, 20 * 9).astype(np.float32)
+    rays = np.hstack((random.uniform(-1, 1, (200, 2)), np.full((200, 1), -3.0),
+        np.tile([0.0, 0.0, 1.0], (200, 1)))).astype(np.float32).ravel()
+    try:
+        result = cluster.compute(tri_ids, tris, rays)
+    finally:
+        server.cleanup()
+    ids, intersects = TracerCPU(use_python=True).compute(rays, tri_ids, tris)
+    np.testing.assert_array_equal(result['triangles_hit'], ids)
+    np.testing.assert_allclose(result['intersections'], intersects, rtol=1e-6)
+    assert not cluster.nodes[1].available
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.encoding import decode_ids, encode_ids
+
+
+def test_rle_round_trip():
+    ids = np.array([-1, -1, -1, 4, 4, 7, -1, -1], dtype=np.int32)
+    np.testing.assert_array_equal(decode_ids(encode_ids(ids, 'rle'), 'rle', len(ids)), ids)
+
+
+@pytest.mark.parametrize('lengths', [[3, 0xffffffff], [1, 1], [2, 2, 2]])
+def test_rle_lengths_are_checked_before_expanding(lengths):
+    values = np.zeros(len(lengths) - (len(lengths) % 2), dtype='<i4')
+    data = values.tobytes() + np.array(lengths, dtype='<u4').tobytes()
+    with pytest.raises(ValueError, match='Runs of'):
+        decode_ids(data, 'rle', 4)
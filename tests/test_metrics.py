@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.metrics import Metrics
+
+
+def metric_types(text):
+    return dict(line.split()[2:4] for line in text.splitlines() if line.startswith('# TYPE'))
+
+
+def test_growing_values_are_counters():
+    metrics = Metrics()
+    metrics.counter('scene_cache_hits', lambda: 3)
+    metrics.gauge('scene_cache_bytes', lambda: 1024)
+    trace = metrics.trace('client')
+    with trace.span('send', bytes=100):
+        pass
+    trace.finish()
+
+    text = metrics.render_text()
+    types = metric_types(text)
+    for name, kind in types.items():
+        if kind == 'counter':
+            assert name.endswith('_total')
+    assert types['raytracer_counter_total'] == 'counter'
+    assert types['raytracer_span_total'] == 'counter'
+    assert 'raytracer_counter_total{name="scene_cache_hits"} 3' in text
+    assert 'raytracer_gauge{name="scene_cache_bytes"} 1024' in text
+    assert 'raytracer_span_total{name="send.bytes"} 100' in text
+    assert 'raytracer_requests_total 1' in text
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.scheduling import CPUDevice, Scheduler, fpga_devices
+from application.simulation import SimulatedOverlay, SimulatedXlnk
+from application.tracers import TracerCPU, TracerFPGA
+
+
+def random_scene(num_tris, num_rays, seed=0):
+    ''' Triangles around the origin and rays shot at them from a
+        sphere, so about half of the rays hit something
+    '''
+    random = np.random.RandomState(seed)
+    centers = random.uniform(-1, 1, (num_tris, 1, 3))
+    tris = (centers + random.uniform(-0.3, 0.3, (num_tris, 3, 3))).astype(np.float32)
+    origins = random.normal(size=(num_rays, 3))
+    origins *= 4 / np.linalg.norm(origins, axis=1)[:, None]
+    directions = random.uniform(-1, 1, (num_rays, 3)) - origins
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    rays = np.hstack((origins, directions)).astype(np.float32)
+    tri_ids = np.arange(num_tris, dtype=np.int32)
+    return rays.ravel(), tri_ids, tris.ravel()
+
+
+@pytest.mark.parametrize('num_accelerators', [1, 2])
+def test_dynamic_schedule_matches_the_cpu(num_accelerators):
+    rays, tri_ids, tris = random_scene(50, 3000)
+    xlnk = SimulatedXlnk()
+    fpga = TracerFPGA('', use_multi_fpga=True,
+        overlay=SimulatedOverlay(xlnk, num_accelerators), xlnk=xlnk)
+    chunks = []
+    try:
+        fpga.prepare(tri_ids, tris, {})
+        devices = [CPUDevice(TracerCPU(use_python=True))] + fpga_devices(fpga)
+        scheduler = Scheduler(devices, task_size=256)
+        ids, intersects = scheduler.compute(rays, tri_ids, tris,
+            on_result=lambda first, ids, intersects: chunks.append((first, len(ids))))
+    finally:
+        fpga.release()
+
+    expected_ids, expected_intersects = TracerCPU(use_multicore=False).compute(rays, tri_ids, tris)
+    np.testing.assert_array_equal(ids, expected_ids)
+    np.testing.assert_allclose(intersects, expected_intersects, rtol=1e-4)
+    assert (expected_ids != -1).any() and (expected_ids == -1).any()
+    # every ray was reported once through on_result
+    assert sum(size for _, size in chunks) == len(rays) // 6
+    assert sorted(first for first, _ in chunks) == list(range(0, len(rays) // 6, 256))
+    assert sum(device.num_tasks for device in devices) == len(chunks)
@@ -0,0 +1,151 @@
+import os
+import sys
+import socket
+import threading
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import application.protocol as protocol
+from server import RendererServer
+
+TRI_IDS = np.array([7], dtype=np.int32)
+TRIS = np.array([-1, -1, 0, 1, -1, 0, 0, 1, 0], dtype=np.float32)
+RAYS = np.array([0, 0, -1, 0, 0, 1, 5, 5, -1, 0, 0, 1], dtype=np.float32)
+
+
+@pytest.fixture
+def server():
+    ''' Concurrent server with a single receiver thread, so a dead
+        receiver leaves the following requests unanswered
+    '''
+    config = {
+        'edge': {'ip': '127.0.0.1', 'port': 0},
+        'metrics': {'http-port': None},
+        'concurrency': {'receivers': 1},
+        'processing': {'mode': 'cpu', 'cpu': {'mode': 'python'}}}
+    srv = RendererServer(config)
+    yield srv
+    srv.cleanup()
+
+
+def serve(srv, num_requests):
+    # listening before the clients connect, serve() listens again
+    srv.sock.listen()
+    srv.thread = threading.Thread(target=srv.serve, kwargs={'max_requests': num_requests})
+    srv.thread.daemon = True
+    srv.thread.start()
+
+
+def connect(srv):
+    return socket.create_connection(srv.sock.getsockname()[:2], timeout=10)
+
+
+def request_hits(srv):
+    with connect(srv) as sock:
+        protocol.send_scene(sock, TRI_IDS, TRIS, RAYS)
+        ids, intersects, _ = protocol.recv_results(sock)
+    return ids, intersects
+
+
+def test_good_request_after_protocol_error(server):
+    serve(server, 2)
+    with connect(server) as sock:
+        # a RENDER asking for occlusion, which it has no rays for
+        camera = ((2, 2), np.zeros(3), np.array([0, 0, 1]), np.array([0, 1, 0]), 1.0, 0.1)
+        protocol.send_frame(sock, protocol.MSG_RENDER,
+            protocol.RENDER.pack(protocol.geometry_hash(TRI_IDS, TRIS), 1, 0, 0)
+            + protocol.pack_camera(*camera) + protocol.MATERIAL.pack(1, 1, 1, 1),
+            protocol.FLAG_OCCLUSION)
+        with pytest.raises(protocol.ProtocolError):
+            protocol.recv_status(sock)
+    ids, intersects = request_hits(server)
+    assert list(ids) == [7, -1]
+    assert intersects[0] == pytest.approx(1.0)
+    server.thread.join(10)
+
+
+def test_oversized_block_is_rejected_before_allocating(server):
+    serve(server, 2)
+    max_block_size = protocol.max_block_size
+    protocol.set_max_block_size(1 << 20)
+    try:
+        with connect(server) as sock:
+            protocol.send_frame(sock, protocol.MSG_SCENE, protocol.SCENE.pack(1 << 30, 1))
+            with pytest.raises(protocol.ProtocolError, match='exceeds the maximum'):
+                protocol.recv_results(sock)
+        ids, _ = request_hits(server)
+    finally:
+        protocol.set_max_block_size(max_block_size)
+    assert list(ids) == [7, -1]
+    server.thread.join(10)
+
+
+def test_streamed_render_is_sent_whole(server):
+    serve(server, 1)
+    camera = ((4, 3), np.array([0.0, 0.0, 1.0]), np.zeros(3), np.array([0.0, 1.0, 0.0]), 1.0, 0.5)
+    lights = np.array([[0, 0, 5, 1, 1, 1, 1]], dtype=np.float64)
+    with connect(server) as sock:
+        protocol.send_frame(sock, protocol.MSG_RENDER,
+            protocol.RENDER.pack(protocol.geometry_hash(TRI_IDS, TRIS), 1, 1, protocol.RENDER_SHADOWS)
+            + protocol.pack_camera(*camera) + protocol.MATERIAL.pack(1, 1, 1, 1),
+            protocol.FLAG_STREAM)
+        protocol.send_array(sock, lights, '<f8')
+        assert protocol.recv_status(sock) == protocol.SCENE_MISS
+        protocol.send_geometry(sock, TRI_IDS, TRIS)
+        image, _ = protocol.recv_image(sock)
+    assert image.shape == (3, 4, 3)
+    assert image.any()
+    server.thread.join(10)
+
+
+def test_good_request_after_unexpected_error(server, monkeypatch):
+    calls = []
+    recv_scene = protocol.recv_scene
+
+    def failing_recv_scene(sock):
+        # fails once the request was read, closing a socket with
+        # unread data would reset the connection
+        scene = recv_scene(sock)
+        calls.append(sock)
+        if len(calls) == 1:
+            raise TypeError('unexpected')
+        return scene
+    monkeypatch.setattr(protocol, 'recv_scene', failing_recv_scene)
+
+    serve(server, 2)
+    with connect(server) as sock:
+        protocol.send_scene(sock, TRI_IDS, TRIS, RAYS)
+        with pytest.raises(protocol.ProtocolError, match='unexpected'):
+            protocol.recv_results(sock)
+    ids, _ = request_hits(server)
+    assert list(ids) == [7, -1]
+    server.thread.join(10)
+    assert not server.thread.is_alive()
+
+
+def test_start_answers_a_failed_compute(server, monkeypatch):
+    compute = server._compute
+    calls = []
+
+    def failing_compute(request, rays=None):
+        calls.append(request)
+        if len(calls) == 1:
+            raise RuntimeError('compute failed')
+        return compute(request, rays)
+    monkeypatch.setattr(server, '_compute', failing_compute)
+
+    server.sock.listen()
+    thread = threading.Thread(target=lambda: [server.start() for _ in range(2)])
+    thread.daemon = True
+    thread.start()
+    with connect(server) as sock:
+        protocol.send_scene(sock, TRI_IDS, TRIS, RAYS)
+        with pytest.raises(protocol.ProtocolError, match='compute failed'):
+            protocol.recv_results(sock)
+    ids, _ = request_hits(server)
+    assert list(ids) == [7, -1]
+    thread.join(10)
+    assert not thread.is_alive()
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+from time import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.simulation import SimulatedOverlay, SimulatedXlnk
+from application.tracers import TracerCPU, TracerFPGA, load_cpp_tracer
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+SCENES = {
+    'scene_tiny_2_3'   : 'output_3_2.json',
+    'scene_small_10_2k': 'output_10_2k.json',
+    'scene_big_15k_2k' : 'expected_intersects.txt'}
+BACKENDS = {
+    'python'    : dict(use_python=True),
+    'singlecore': dict(use_multicore=False),
+    'multicore' : dict(use_multicore=True),
+    'bvh'       : dict(use_bvh=True),
+    'simd'      : dict(use_simd=True)}
+
+needs_cpp = pytest.mark.skipif(load_cpp_tracer() is None, reason='tracer.so is not built')
+
+
+def load_scene(name):
+    with open(os.path.join(EXAMPLES, name + '.drk')) as file:
+        data = np.array(file.read().split(), dtype=np.float64)
+    num_tris = int(data[0])
+    tri_end = 2 + num_tris * 10
+    return (
+        data[tri_end:].astype(np.float32),
+        data[2 : 2 + num_tris].astype(np.int32),
+        data[2 + num_tris : tri_end].astype(np.float32))
+
+
+def load_expected(name):
+    filename = os.path.join(EXAMPLES, SCENES[name])
+    if filename.endswith('.json'):
+        with open(filename) as file:
+            result = json.load(file)
+        return np.array(result['triangles_hit']), np.array(result['intersections'])
+    expected = np.loadtxt(filename, ndmin=2)
+    return expected[:, 0].astype(np.int32), expected[:, 1]
+
+
+def assert_same_hits(ids, intersects, reference):
+    ''' Same triangles, distances within 1e-4 (relative), the single
+        precision kernels round differently
+    '''
+    ref_ids, ref_intersects = reference
+    np.testing.assert_array_equal(np.asarray(ids), ref_ids)
+    hit = ref_ids != -1
+    np.testing.assert_allclose(np.asarray(intersects)[hit], ref_intersects[hit], rtol=1e-4)
+
+
+@pytest.mark.parametrize('scene', sorted(SCENES))
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_backend_matches_expected(backend, scene):
+    if backend != 'python' and load_cpp_tracer() is None:
+        pytest.skip('tracer.so is not built')
+    ids, intersects = TracerCPU(**BACKENDS[backend]).compute(*load_scene(scene))
+    assert_same_hits(ids, intersects, load_expected(scene))
+
+
+@needs_cpp
+@pytest.mark.parametrize('backend', ['python', 'bvh', 'simd'])
+def test_backend_matches_brute_force_on_a_mesh(backend):
+    ''' Camera rays on the bunny, with many shared edges and vertices
+        where the closest of equally distant triangles must win
+    '''
+    from application.raytracer.scene import Scene
+    scene = Scene(os.path.join(EXAMPLES, 'bunny_2k.obj'), use_cache=False)
+    scene.set_camera(
+        (64, 48), np.array([0.0, 5.0, 5.0]), np.array([0.0, 0.0, 0.3]),
+        np.array([0.0, 0.0, 1.0]), 1.0, 0.004)
+    tri_ids, tris = scene.get_triangles_array()
+    rays = scene.camera.get_rays_array()
+    reference = TracerCPU(use_multicore=False).compute(rays, tri_ids, tris)
+    ids, intersects = TracerCPU(**BACKENDS[backend]).compute(rays, tri_ids, tris)
+    assert_same_hits(ids, intersects, reference)
+
+
+def test_fpga_sees_triangles_changed_in_place():
+    xlnk = SimulatedXlnk()
+    fpga = TracerFPGA('', use_multi_fpga=False, overlay=SimulatedOverlay(xlnk, 1), xlnk=xlnk)
+    tri_ids = np.array([1], dtype=np.int32)
+    tris = np.array([-1, -1, 0, 1, -1, 0, 0, 1, 0], dtype=np.float32)
+    rays = np.array([0, 0, -1, 0, 0, 1], dtype=np.float32)
+    try:
+        fpga.compute(rays, tri_ids, tris)
+        fpga.wait()
+        assert fpga.get_results()[1][0] == 1.0
+
+        tris[2::3] = 2.0
+        fpga.compute(rays, tri_ids, tris)
+        fpga.wait()
+        assert fpga.get_results()[1][0] == 3.0
+    finally:
+        fpga.release()
+
+
+@pytest.mark.parametrize('use_interrupts', [False, True])
+def test_wait_times_out_on_a_stalled_accelerator(use_interrupts):
+    xlnk = SimulatedXlnk()
+    overlay = SimulatedOverlay(xlnk, 1)
+    fpga = TracerFPGA('', use_multi_fpga=False, overlay=overlay, xlnk=xlnk,
+        use_interrupts=use_interrupts)
+    assert fpga.accelerators[0].use_interrupts == use_interrupts
+    tri_ids = np.array([1], dtype=np.int32)
+    tris = np.array([-1, -1, 0, 1, -1, 0, 0, 1, 0], dtype=np.float32)
+    rays = np.array([0, 0, -1, 0, 0, 1], dtype=np.float32)
+    try:
+        # started, but never finishing nor raising its interrupt
+        overlay.intersectfpga_0._run = lambda: None
+        fpga.compute(rays, tri_ids, tris)
+        ti = time()
+        assert not fpga.wait(0.3)
+        assert 0.3 <= time() - ti < 2
+        assert not fpga.is_done()
+
+        # finishing late, the next wait sees it
+        overlay.intersectfpga_0._finish()
+        assert fpga.wait(2)
+    finally:
+        fpga.release()
+
+
+def test_uncached_triangles_reuse_the_fpga_buffers():
+    xlnk = SimulatedXlnk()
+    fpga = TracerFPGA('', use_multi_fpga=False, overlay=SimulatedOverlay(xlnk, 1), xlnk=xlnk)
+    rays = np.array([0, 0, -1, 0, 0, 1], dtype=np.float32)
+    try:
+        allocations = None
+        for num_tris, depth in ((2, 1.0), (1, 2.0), (2, 3.0)):
+            tri_ids = np.arange(num_tris, dtype=np.int32) + 1
+            tris = np.tile(np.array([-1, -1, depth, 1, -1, depth, 0, 1, depth], dtype=np.float32), num_tris)
+            fpga.prepare(tri_ids, tris, None)
+            fpga.compute(rays, tri_ids, tris)
+            fpga.wait()
+            assert fpga.get_results()[1][0] == depth + 1
+            if allocations is None:
+                allocations = xlnk.num_allocations
+        # the triangle sets fit the buffers of the first one
+        assert xlnk.num_allocations == allocations
+    finally:
+        fpga.release()